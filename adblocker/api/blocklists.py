@@ -7,6 +7,7 @@ from flask_httpauth import HTTPBasicAuth
 
 from adblocker.models.database import BlockList, db
 from adblocker.services.blocklist_manager import BlockListManager
+from adblocker.services.reload_coordinator import get_reload_coordinator
 
 # Create blueprint
 blocklist_bp = Blueprint('blocklists', __name__)
@@ -60,8 +61,8 @@ def get_blocklist(blocklist_id):
         blocklist = BlockList.query.get_or_404(blocklist_id)
         
         # Get additional status information
-        manager = BlockListManager(request.current_app.config)
-        status = manager.get_blocklist_status(blocklist_id)
+        with BlockListManager(request.current_app.config) as manager:
+            status = manager.get_blocklist_status(blocklist_id)
         
         return jsonify({
             'success': True,
@@ -96,15 +97,14 @@ def create_blocklist():
         enabled = data.get('enabled', True)
         
         # Create block list manager
-        manager = BlockListManager(request.current_app.config)
-        
-        # Add block list
-        success, message = manager.add_custom_blocklist(
-            name=name,
-            url=url,
-            category=category,
-            description=description
-        )
+        with BlockListManager(request.current_app.config) as manager:
+            # Add block list
+            success, message = manager.add_custom_blocklist(
+                name=name,
+                url=url,
+                category=category,
+                description=description
+            )
         
         if success:
             # Get created block list
@@ -157,9 +157,8 @@ def update_blocklist(blocklist_id):
         db.session.commit()
         
         # Update configuration
-        manager = BlockListManager(request.current_app.config)
-        manager.generate_combined_config()
-        manager.dnsmasq_manager.reload_dnsmasq()
+        with BlockListManager(request.current_app.config) as manager:
+            manager.apply_config_changes()
         
         return jsonify({
             'success': True,
@@ -179,8 +178,8 @@ def update_blocklist(blocklist_id):
 def delete_blocklist(blocklist_id):
     """Delete a block list"""
     try:
-        manager = BlockListManager(request.current_app.config)
-        success, message = manager.remove_blocklist(blocklist_id)
+        with BlockListManager(request.current_app.config) as manager:
+            success, message = manager.remove_blocklist(blocklist_id)
         
         if success:
             return jsonify({
@@ -204,8 +203,8 @@ def delete_blocklist(blocklist_id):
 def toggle_blocklist(blocklist_id):
     """Toggle block list enabled status"""
     try:
-        manager = BlockListManager(request.current_app.config)
-        success, message = manager.toggle_blocklist(blocklist_id)
+        with BlockListManager(request.current_app.config) as manager:
+            success, message = manager.toggle_blocklist(blocklist_id)
         
         if success:
             return jsonify({
@@ -229,8 +228,8 @@ def toggle_blocklist(blocklist_id):
 def update_blocklist_content(blocklist_id):
     """Update block list content from URL"""
     try:
-        manager = BlockListManager(request.current_app.config)
-        success, message = manager.update_blocklist(blocklist_id)
+        with BlockListManager(request.current_app.config) as manager:
+            success, message = manager.update_blocklist(blocklist_id)
         
         if success:
             return jsonify({
@@ -254,13 +253,37 @@ def update_blocklist_content(blocklist_id):
 def update_all_blocklists():
     """Update all enabled block lists"""
     try:
-        manager = BlockListManager(request.current_app.config)
-        updated_count = manager.update_all_blocklists()
+        with BlockListManager(request.current_app.config) as manager:
+            report = manager.update_all_blocklists()
+        
+        return jsonify({
+            'success': True,
+            'message': f"Updated {report['updated_count']} block lists",
+            'updated_count': report['updated_count'],
+            'report': report
+        })
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@blocklist_bp.route('/blocklists/reload-status', methods=['GET'])
+@auth.login_required
+def get_reload_status():
+    """Get pending and in-flight dnsmasq reload status"""
+    try:
+        coordinator = get_reload_coordinator()
+        if coordinator is None:
+            return jsonify({
+                'success': True,
+                'status': {'running': False, 'pending': [], 'in_flight': []}
+            })
         
         return jsonify({
             'success': True,
-            'message': f'Updated {updated_count} block lists',
-            'updated_count': updated_count
+            'status': coordinator.get_status()
         })
         
     except Exception as e:
@@ -293,8 +316,8 @@ def get_blocklist_categories():
 def get_blocklist_statistics():
     """Get block list statistics"""
     try:
-        manager = BlockListManager(request.current_app.config)
-        stats = manager.get_statistics()
+        with BlockListManager(request.current_app.config) as manager:
+            stats = manager.get_statistics()
         
         return jsonify({
             'success': True,
@@ -396,10 +419,9 @@ def add_predefined_blocklist():
         db.session.commit()
         
         # Download content
-        manager = BlockListManager(request.current_app.config)
-        manager.download_blocklist(blocklist.id)
-        manager.generate_combined_config()
-        manager.dnsmasq_manager.reload_dnsmasq()
+        with BlockListManager(request.current_app.config) as manager:
+            manager.download_blocklist(blocklist.id)
+            manager.apply_config_changes()
         
         return jsonify({
             'success': True,
@@ -8,7 +8,15 @@ from datetime import datetime, timedelta, date
 from sqlalchemy import func, desc
 
 from adblocker.models.database import QueryStat, SummaryStat, BlockList, db
+from adblocker.models.database import drop_query_partitions, list_query_partitions, delete_hourly_rollups
+from adblocker.models.database import count_query_stats
+from adblocker.models.database import delete_query_sketches
+from adblocker.models.database import TIME_BUCKET_SECONDS
 from adblocker.services.dnsmasq_manager import DnsmasqManager
+from adblocker.services.query_logger import get_active_query_logger
+from adblocker.services.stats_queries import top_counts, blocklist_counts, bucket_counts
+from adblocker.services.sketches import SKETCH_TOP_BLOCKED_DOMAINS, SKETCH_TOP_CLIENTS, SKETCH_TOP_DOMAINS
+from adblocker.services.sketches import approx_overview, approx_top
 
 # Create blueprint
 stats_bp = Blueprint('stats', __name__)
@@ -21,6 +29,43 @@ def verify_password(username, password):
     return (username == current_app.config['BASIC_AUTH_USERNAME'] and
             password == current_app.config['BASIC_AUTH_PASSWORD'])
 
+def _approx_requested():
+    """Whether sketch-based estimates were asked for with ?approx=1"""
+    return request.args.get('approx', '0').lower() in ('1', 'true')
+
+def _exact_overview(start_date):
+    """Query counts for the overview, counted from query stats since start_date"""
+    # Get query statistics
+    total_queries = QueryStat.query.filter(
+        QueryStat.timestamp >= start_date
+    ).count()
+    
+    blocked_queries = QueryStat.query.filter(
+        QueryStat.timestamp >= start_date,
+        QueryStat.blocked == True
+    ).count()
+    
+    # Get unique domains
+    unique_domains = db.session.query(
+        func.count(func.distinct(QueryStat.domain))
+    ).filter(
+        QueryStat.timestamp >= start_date
+    ).scalar()
+    
+    # Get unique clients
+    unique_clients = db.session.query(
+        func.count(func.distinct(QueryStat.client_ip))
+    ).filter(
+        QueryStat.timestamp >= start_date
+    ).scalar()
+    
+    return {
+        'total_queries': total_queries,
+        'blocked_queries': blocked_queries,
+        'unique_domains': unique_domains,
+        'unique_clients': unique_clients
+    }
+
 @stats_bp.route('/statistics/overview', methods=['GET'])
 @auth.login_required
 def get_overview_statistics():
@@ -30,34 +75,16 @@ def get_overview_statistics():
         days = request.args.get('days', 7, type=int)
         start_date = datetime.utcnow() - timedelta(days=days)
         
-        # Get query statistics
-        total_queries = QueryStat.query.filter(
-            QueryStat.timestamp >= start_date
-        ).count()
-        
-        blocked_queries = QueryStat.query.filter(
-            QueryStat.timestamp >= start_date,
-            QueryStat.blocked == True
-        ).count()
+        if _approx_requested():
+            # Estimates from the hourly sketches, see services.sketches for error bounds
+            counts = approx_overview(start_date, datetime.utcnow())
+        else:
+            counts = _exact_overview(start_date)
         
         # Calculate block percentage
         block_percentage = 0
-        if total_queries > 0:
-            block_percentage = round((blocked_queries / total_queries) * 100, 2)
-        
-        # Get unique domains
-        unique_domains = db.session.query(
-            func.count(func.distinct(QueryStat.domain))
-        ).filter(
-            QueryStat.timestamp >= start_date
-        ).scalar()
-        
-        # Get unique clients
-        unique_clients = db.session.query(
-            func.count(func.distinct(QueryStat.client_ip))
-        ).filter(
-            QueryStat.timestamp >= start_date
-        ).scalar()
+        if counts['total_queries'] > 0:
+            block_percentage = round((counts['blocked_queries'] / counts['total_queries']) * 100, 2)
         
         # Get service status
         dnsmasq_manager = DnsmasqManager(request.current_app.config)
@@ -69,15 +96,13 @@ def get_overview_statistics():
         return jsonify({
             'success': True,
             'statistics': {
-                'total_queries': total_queries,
-                'blocked_queries': blocked_queries,
+                **counts,
                 'block_percentage': block_percentage,
-                'unique_domains': unique_domains,
-                'unique_clients': unique_clients,
                 'dnsmasq_status': dnsmasq_status,
                 'active_blocklists': active_blocklists,
                 'period_days': days
-            }
+            },
+            'approximate': _approx_requested()
         })
         
     except Exception as e:
@@ -130,8 +155,8 @@ def get_recent_queries():
         # Get queries
         queries = query.order_by(desc(QueryStat.timestamp)).offset(offset).limit(limit).all()
         
-        # Get total count
-        total = query.count()
+        # Get total count; counting through the view would read every row
+        total = count_query_stats(blocked_only)
         
         return jsonify({
             'success': True,
@@ -157,35 +182,37 @@ def get_top_domains():
         blocked_only = request.args.get('blocked_only', 'false').lower() == 'true'
         days = request.args.get('days', 7, type=int)
         
-        start_date = datetime.utcnow() - timedelta(days=days)
-        
-        # Build query
-        query = db.session.query(
-            QueryStat.domain,
-            func.count(QueryStat.id).label('count')
-        ).filter(
-            QueryStat.timestamp >= start_date
-        )
-        
-        if blocked_only:
-            query = query.filter(QueryStat.blocked == True)
-        
-        # Get results
-        results = query.group_by(
-            QueryStat.domain
-        ).order_by(desc('count')).limit(limit).all()
+        end_date = datetime.utcnow()
+        start_date = end_date - timedelta(days=days)
         
-        return jsonify({
-            'success': True,
-            'domains': [
+        if _approx_requested():
+            # Estimates from the hourly sketches; counts exceed the true ones by at most max_overcount
+            sketch = SKETCH_TOP_BLOCKED_DOMAINS if blocked_only else SKETCH_TOP_DOMAINS
+            domains = [
+                {
+                    'domain': domain,
+                    'count': count,
+                    'max_overcount': max_overcount
+                }
+                for domain, count, max_overcount in approx_top(sketch, start_date, end_date, limit)
+            ]
+        else:
+            # Whole hours come from the hourly rollups, the partial edges from raw rows
+            results = top_counts('domain', start_date, end_date, blocked_only=blocked_only, limit=limit)
+            domains = [
                 {
                     'domain': result.domain,
                     'count': result.count
                 }
                 for result in results
-            ],
+            ]
+        
+        return jsonify({
+            'success': True,
+            'domains': domains,
             'blocked_only': blocked_only,
-            'period_days': days
+            'period_days': days,
+            'approximate': _approx_requested()
         })
         
     except Exception as e:
@@ -203,28 +230,35 @@ def get_top_clients():
         limit = request.args.get('limit', 20, type=int)
         days = request.args.get('days', 7, type=int)
         
-        start_date = datetime.utcnow() - timedelta(days=days)
-        
-        # Get results
-        results = db.session.query(
-            QueryStat.client_ip,
-            func.count(QueryStat.id).label('count')
-        ).filter(
-            QueryStat.timestamp >= start_date
-        ).group_by(
-            QueryStat.client_ip
-        ).order_by(desc('count')).limit(limit).all()
+        end_date = datetime.utcnow()
+        start_date = end_date - timedelta(days=days)
         
-        return jsonify({
-            'success': True,
-            'clients': [
+        if _approx_requested():
+            # Estimates from the hourly sketches; counts exceed the true ones by at most max_overcount
+            clients = [
+                {
+                    'client_ip': client_ip,
+                    'count': count,
+                    'max_overcount': max_overcount
+                }
+                for client_ip, count, max_overcount in approx_top(SKETCH_TOP_CLIENTS, start_date, end_date, limit)
+            ]
+        else:
+            # Whole hours come from the hourly rollups, the partial edges from raw rows
+            results = top_counts('client_ip', start_date, end_date, limit=limit)
+            clients = [
                 {
                     'client_ip': result.client_ip,
                     'count': result.count
                 }
                 for result in results
-            ],
-            'period_days': days
+            ]
+        
+        return jsonify({
+            'success': True,
+            'clients': clients,
+            'period_days': days,
+            'approximate': _approx_requested()
         })
         
     except Exception as e:
@@ -241,21 +275,11 @@ def get_blocklist_performance():
         # Get query parameters
         days = request.args.get('days', 7, type=int)
         
-        start_date = datetime.utcnow() - timedelta(days=days)
+        end_date = datetime.utcnow()
+        start_date = end_date - timedelta(days=days)
         
-        # Get block list performance
-        results = db.session.query(
-            BlockList.name,
-            BlockList.category,
-            func.count(QueryStat.id).label('blocked_count')
-        ).join(
-            QueryStat, BlockList.id == QueryStat.block_list_id
-        ).filter(
-            QueryStat.timestamp >= start_date,
-            QueryStat.blocked == True
-        ).group_by(
-            BlockList.id
-        ).order_by(desc('blocked_count')).all()
+        # Get block list performance from the hourly rollups
+        results = blocklist_counts(start_date, end_date)
         
         return jsonify({
             'success': True,
@@ -279,35 +303,36 @@ def get_blocklist_performance():
 @stats_bp.route('/statistics/hourly', methods=['GET'])
 @auth.login_required
 def get_hourly_statistics():
-    """Get hourly statistics for the last 24 hours"""
+    """Get query counts per time bucket (hour by default) for the last 24 hours"""
     try:
         # Get query parameters
         hours = request.args.get('hours', 24, type=int)
+        bucket = request.args.get('bucket', 'hour')
         
-        start_date = datetime.utcnow() - timedelta(hours=hours)
+        if bucket not in TIME_BUCKET_SECONDS:
+            return jsonify({
+                'success': False,
+                'error': f"Invalid bucket, expected one of: {', '.join(TIME_BUCKET_SECONDS)}"
+            }), 400
         
-        # Get hourly statistics
-        results = db.session.query(
-            func.date_trunc('hour', QueryStat.timestamp).label('hour'),
-            func.count(QueryStat.id).label('total_queries'),
-            func.sum(func.case([(QueryStat.blocked == True, 1)], else_=0)).label('blocked_queries')
-        ).filter(
-            QueryStat.timestamp >= start_date
-        ).group_by(
-            func.date_trunc('hour', QueryStat.timestamp)
-        ).order_by('hour').all()
+        end_date = datetime.utcnow()
+        start_date = end_date - timedelta(hours=hours)
+        
+        # Get bucketed statistics from the hourly rollups
+        results = bucket_counts(start_date, end_date, bucket)
         
         return jsonify({
             'success': True,
             'hourly_stats': [
                 {
-                    'hour': result.hour.isoformat(),
-                    'total_queries': result.total_queries,
-                    'blocked_queries': result.blocked_queries or 0,
-                    'block_percentage': round((result.blocked_queries or 0) / result.total_queries * 100, 2) if result.total_queries > 0 else 0
+                    'hour': bucket_start.isoformat(),
+                    'total_queries': total_queries,
+                    'blocked_queries': blocked_queries,
+                    'block_percentage': round(blocked_queries / total_queries * 100, 2) if total_queries > 0 else 0
                 }
-                for result in results
+                for bucket_start, total_queries, blocked_queries in results
             ],
+            'bucket': bucket,
             'period_hours': hours
         })
         
@@ -317,6 +342,101 @@ def get_hourly_statistics():
             'error': str(e)
         }), 500
 
+def _percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+@stats_bp.route('/statistics/upstreams', methods=['GET'])
+@auth.login_required
+def get_upstream_statistics():
+    """Get response latency percentiles per upstream server"""
+    try:
+        # Get query parameters
+        hours = request.args.get('hours', 24, type=int)
+        
+        start_date = datetime.utcnow() - timedelta(hours=hours)
+        
+        # Forwarded queries per upstream, including those never answered
+        forwarded_counts = dict(db.session.query(
+            QueryStat.upstream,
+            func.count(QueryStat.id)
+        ).filter(
+            QueryStat.timestamp >= start_date,
+            QueryStat.upstream.isnot(None)
+        ).group_by(
+            QueryStat.upstream
+        ).all())
+        
+        # Latencies of answered queries, sorted per upstream
+        results = db.session.query(
+            QueryStat.upstream,
+            QueryStat.response_ms
+        ).filter(
+            QueryStat.timestamp >= start_date,
+            QueryStat.upstream.isnot(None),
+            QueryStat.response_ms.isnot(None)
+        ).order_by(
+            QueryStat.upstream,
+            QueryStat.response_ms
+        ).all()
+        
+        latencies = {}
+        for upstream, response_ms in results:
+            latencies.setdefault(upstream, []).append(response_ms)
+        
+        upstreams = []
+        for upstream, forwarded in sorted(forwarded_counts.items()):
+            values = latencies.get(upstream, [])
+            upstreams.append({
+                'upstream': upstream,
+                'forwarded_queries': forwarded,
+                'answered_queries': len(values),
+                'unanswered_queries': forwarded - len(values),
+                'avg_ms': round(sum(values) / len(values), 2) if values else None,
+                'p50_ms': _percentile(values, 50),
+                'p90_ms': _percentile(values, 90),
+                'p99_ms': _percentile(values, 99),
+                'max_ms': values[-1] if values else None
+            })
+        
+        return jsonify({
+            'success': True,
+            'upstreams': upstreams,
+            'period_hours': hours
+        })
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@stats_bp.route('/statistics/ingest', methods=['GET'])
+@auth.login_required
+def get_ingest_statistics():
+    """Get query log ingest metrics: buffer depth, flush latency and drops"""
+    try:
+        query_logger = get_active_query_logger()
+        if query_logger is None:
+            return jsonify({
+                'success': True,
+                'ingest': {'running': False}
+            })
+        
+        return jsonify({
+            'success': True,
+            'ingest': query_logger.get_ingest_metrics()
+        })
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 @stats_bp.route('/statistics/export', methods=['GET'])
 @auth.login_required
 def export_statistics():
@@ -377,15 +497,13 @@ def clear_statistics():
         
         if days:
             # Clear data older than specified days
-            cutoff_date = datetime.utcnow() - timedelta(days=days)
-            
-            # Delete query stats
-            deleted_queries = QueryStat.query.filter(
-                QueryStat.timestamp < cutoff_date
-            ).delete()
+            # Drop query stat partitions of whole days before the cutoff
+            cutoff_summary_date = date.today() - timedelta(days=days)
+            deleted_queries = drop_query_partitions(before=cutoff_summary_date, count_rows=True)
+            delete_hourly_rollups(before=datetime.combine(cutoff_summary_date, datetime.min.time()))
+            delete_query_sketches(before=datetime.combine(cutoff_summary_date, datetime.min.time()))
             
             # Delete summary stats
-            cutoff_summary_date = date.today() - timedelta(days=days)
             deleted_summary = SummaryStat.query.filter(
                 SummaryStat.date < cutoff_summary_date
             ).delete()
@@ -400,7 +518,9 @@ def clear_statistics():
             })
         else:
             # Clear all statistics
-            deleted_queries = QueryStat.query.delete()
+            deleted_queries = drop_query_partitions(count_rows=True)
+            delete_hourly_rollups()
+            delete_query_sketches()
             deleted_summary = SummaryStat.query.delete()
             
             db.session.commit()
@@ -437,6 +557,9 @@ def get_statistics_health():
         db_path = current_app.config['DATABASE_PATH']
         db_size = db_path.stat().st_size if db_path.exists() else 0
         
+        # Daily query stat partitions
+        partitions = list_query_partitions()
+        
         return jsonify({
             'success': True,
             'health': {
@@ -445,7 +568,9 @@ def get_statistics_health():
                 'oldest_query': oldest_query.isoformat() if oldest_query else None,
                 'newest_query': newest_query.isoformat() if newest_query else None,
                 'database_size_bytes': db_size,
-                'database_size_mb': round(db_size / (1024 * 1024), 2)
+                'database_size_mb': round(db_size / (1024 * 1024), 2),
+                'query_partitions': len(partitions),
+                'oldest_partition': min(partitions).isoformat() if partitions else None
             }
         })
         
@@ -5,13 +5,14 @@ A web interface for managing DNS ad-blocking on Raspberry Pi
 """
 
 import os
-from datetime import datetime
+from datetime import datetime, date, timedelta
 from flask import Flask, render_template, jsonify, request
 from functools import wraps
 from flask_httpauth import HTTPBasicAuth
 
 from config.flask_config import get_config
-from models.database import init_database, db, clean_expired_entries, clean_old_stats
+from models.database import init_database, db, clean_expired_entries, clean_old_stats, reconcile_summary_stats
+from models.database import run_sqlite_maintenance
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -24,6 +25,10 @@ auth = HTTPBasicAuth()
 # Initialize database
 init_database(app)
 
+# Coalesce config rebuilds and dnsmasq reloads on a background thread
+from adblocker.services.reload_coordinator import init_reload_coordinator
+init_reload_coordinator(app)
+
 # Authentication verification
 @auth.verify_password
 def verify_password(username, password):
@@ -125,16 +130,54 @@ def setup_background_tasks():
         id='clean_expired_entries'
     )
     
-    # Clean old stats weekly
+    # Drop expired query stat partitions and summaries daily
+    def clean_stats():
+        with app.app_context():
+            clean_old_stats(
+                app.config['STATS_RETENTION_DAYS'],
+                query_days_to_keep=app.config['QUERY_LOG_RETENTION_DAYS']
+            )
+    
     scheduler.add_job(
-        func=lambda: clean_old_stats(app.config['STATS_RETENTION_DAYS']),
+        func=clean_stats,
         trigger='cron',
-        day_of_week=0,
         hour=3,
         minute=0,
         id='clean_old_stats'
     )
     
+    # Keep the WAL file short and the query planner statistics current
+    def sqlite_maintenance():
+        with app.app_context():
+            run_sqlite_maintenance(app.config['SQLITE_CHECKPOINT_MODE'])
+    
+    scheduler.add_job(
+        func=sqlite_maintenance,
+        trigger='interval',
+        minutes=app.config['SQLITE_MAINTENANCE_INTERVAL'],
+        id='sqlite_maintenance'
+    )
+    
+    # Reconcile the incrementally maintained daily summaries against query_stats
+    def reconcile_summaries(days_ago):
+        with app.app_context():
+            reconcile_summary_stats(date.today() - timedelta(days=days_ago))
+    
+    scheduler.add_job(
+        func=lambda: reconcile_summaries(0),
+        trigger='cron',
+        minute=30,
+        id='reconcile_today_summary'
+    )
+    
+    scheduler.add_job(
+        func=lambda: reconcile_summaries(1),
+        trigger='cron',
+        hour=0,
+        minute=15,
+        id='reconcile_yesterday_summary'
+    )
+    
     scheduler.start()
 
 # Health check endpoint
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Block list download benchmark for PiDNS Ad-Blocker
+Serves fixture lists from a local HTTP stand-in server with artificial
+delays and compares sequential and concurrent fetching
+
+Run from the repository root:
+    python -m adblocker.benchmarks.bench_blocklist_downloads --lists 8 --delay 0.5
+"""
+
+import argparse
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from adblocker.services.blocklist_fetcher import BlockListFetcher
+from adblocker.services.domain_cache import DomainCache
+
+
+def build_fixture(list_index, domain_count):
+    """Build the body of one fixture hosts list"""
+    lines = [f"# Fixture block list {list_index}"]
+    lines.extend(f"0.0.0.0 ads{i}.list{list_index}.example.com" for i in range(domain_count))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def start_stand_in_server(fixtures, delay):
+    """Start a local HTTP server serving /list/<n>.txt after an artificial delay"""
+
+    class FixtureHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            body = fixtures.get(self.path)
+            if body is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def run_fetch(jobs, workers, per_host_limit):
+    """Fetch all jobs into a scratch directory and return (seconds, results)"""
+    with tempfile.TemporaryDirectory(prefix='pidns-bench-') as scratch:
+        fetcher = BlockListFetcher(
+            scratch,
+            DomainCache(scratch),
+            max_workers=workers,
+            per_host_limit=per_host_limit
+        )
+        try:
+            start = time.perf_counter()
+            results = fetcher.fetch_all(jobs)
+            return time.perf_counter() - start, results
+        finally:
+            fetcher.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark concurrent block list downloads')
+    parser.add_argument('--lists', type=int, default=8, help='Number of fixture lists')
+    parser.add_argument('--domains', type=int, default=20000, help='Domains per fixture list')
+    parser.add_argument('--delay', type=float, default=0.5, help='Artificial server delay in seconds')
+    parser.add_argument('--workers', type=int, default=4, help='Concurrent download workers')
+    parser.add_argument('--per-host', type=int, default=4, help='Concurrent downloads per host')
+    args = parser.parse_args()
+
+    fixtures = {f"/list/{i}.txt": build_fixture(i, args.domains) for i in range(args.lists)}
+    server = start_stand_in_server(fixtures, args.delay)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    jobs = [
+        {'id': i, 'name': f"Fixture {i}", 'url': f"{base_url}/list/{i}.txt"}
+        for i in range(args.lists)
+    ]
+
+    try:
+        sequential, _ = run_fetch(jobs, workers=1, per_host_limit=1)
+        concurrent, results = run_fetch(jobs, workers=args.workers, per_host_limit=args.per_host)
+    finally:
+        server.shutdown()
+
+    failed = [r for r in results if not r['success']]
+    print(f"Lists:      {args.lists} x {args.domains} domains, {args.delay}s server delay")
+    print(f"Sequential: {sequential:.2f}s")
+    print(f"Concurrent: {concurrent:.2f}s ({args.workers} workers, {args.per_host} per host)")
+    print(f"Speed-up:   {sequential / concurrent:.1f}x")
+    print(f"Failures:   {len(failed)}")
+    for result in failed:
+        print(f"  {result['name']}: {result['error']}")
+
+
+if __name__ == '__main__':
+    main()
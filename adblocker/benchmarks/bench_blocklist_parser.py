@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Block list parser micro-benchmark for PiDNS Ad-Blocker
+Generates a synthetic hosts file and reports parser throughput in lines/sec
+
+Run from the repository root:
+    python -m adblocker.benchmarks.bench_blocklist_parser --lines 1000000
+"""
+
+import argparse
+import os
+import random
+import string
+import tempfile
+import time
+
+from adblocker.services.blocklist_parser import iter_file_domains
+
+
+def generate_hosts_file(path, line_count, seed=42):
+    """Write a synthetic hosts file mixing the formats seen in real lists"""
+    rng = random.Random(seed)
+    alphabet = string.ascii_lowercase + string.digits
+    tlds = ('com', 'net', 'org', 'io', 'co.uk', 'info')
+
+    def random_domain():
+        labels = [
+            ''.join(rng.choice(alphabet) for _ in range(rng.randint(3, 12)))
+            for _ in range(rng.randint(1, 3))
+        ]
+        return '.'.join(labels) + '.' + rng.choice(tlds)
+
+    with open(path, 'w') as f:
+        f.write('# Synthetic benchmark hosts file\n')
+        for i in range(line_count):
+            roll = rng.random()
+            if roll < 0.70:
+                f.write(f"0.0.0.0 {random_domain()}\n")
+            elif roll < 0.80:
+                f.write(f"127.0.0.1 {random_domain()}\n")
+            elif roll < 0.88:
+                f.write(f"||{random_domain()}^\n")
+            elif roll < 0.96:
+                f.write(f"{random_domain()}\n")
+            elif roll < 0.98:
+                f.write(f"# comment {i}\n")
+            else:
+                f.write("\n")
+
+
+def run_benchmark(path, line_count, rounds):
+    """Parse the file several times and report the best throughput"""
+    best = None
+    domain_count = 0
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+        domains = set(iter_file_domains(path))
+        elapsed = time.perf_counter() - start
+        domain_count = len(domains)
+        best = elapsed if best is None else min(best, elapsed)
+
+    print(f"Lines:          {line_count}")
+    print(f"Unique domains: {domain_count}")
+    print(f"Best time:      {best:.3f}s over {rounds} round(s)")
+    print(f"Throughput:     {line_count / best:,.0f} lines/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the block list parser')
+    parser.add_argument('--lines', type=int, default=1000000, help='Number of synthetic lines')
+    parser.add_argument('--rounds', type=int, default=3, help='Number of timed rounds')
+    parser.add_argument('--file', help='Parse an existing block list instead of a synthetic one')
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, 'rb') as f:
+            line_count = sum(1 for _ in f)
+        run_benchmark(args.file, line_count, args.rounds)
+        return
+
+    fd, path = tempfile.mkstemp(prefix='pidns-bench-', suffix='.hosts')
+    os.close(fd)
+    try:
+        generate_hosts_file(path, args.lines)
+        run_benchmark(path, args.lines + 1, args.rounds)
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
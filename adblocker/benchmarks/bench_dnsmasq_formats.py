@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+dnsmasq output format benchmark for PiDNS Ad-Blocker
+Generates every adblock output backend from the same synthetic domain set
+and compares file size, generation time, `dnsmasq --test` parse time and the
+resident memory of a dnsmasq instance spawned on a local port
+
+Run from the repository root (dnsmasq must be installed for the last two):
+    python -m adblocker.benchmarks.bench_dnsmasq_formats --domains 500000
+"""
+
+import argparse
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from adblocker.services.dnsmasq_manager import DnsmasqManager, ADBLOCK_OUTPUT_FORMATS
+
+TLDS = ['com', 'net', 'org', 'io', 'info', 'co.uk', 'de', 'ru']
+WORDS = ['ads', 'track', 'pixel', 'metrics', 'cdn', 'banner', 'stats', 'beacon', 'promo', 'tag']
+
+
+def generate_domains(count, seed=1):
+    """Generate a deterministic set of unique blocked domains"""
+    rng = random.Random(seed)
+    domains = set()
+    while len(domains) < count:
+        labels = [f"{rng.choice(WORDS)}{rng.randrange(100000)}" for _ in range(rng.randint(1, 3))]
+        domains.add('.'.join(labels + [rng.choice(TLDS)]))
+    return domains
+
+
+def build_manager(scratch, output_format):
+    """Create a DnsmasqManager writing into a scratch conf-dir"""
+    config_dir = Path(scratch) / output_format / 'dnsmasq.d'
+    config = SimpleNamespace(
+        DNSMASQ_CONFIG_DIR=config_dir,
+        ADBLOCK_CONFIG_FILE=config_dir / 'adblock.conf',
+        ADBLOCK_HOSTS_FILE=config_dir.parent / 'adblock.hosts',
+        WHITELIST_CONFIG_FILE=config_dir / 'whitelist.conf',
+        BLACKLIST_CONFIG_FILE=config_dir / 'blacklist.conf',
+        DNSMASQ_SERVICE='dnsmasq',
+        ADBLOCK_OUTPUT_FORMAT=output_format,
+        # Keep the domain set identical across backends
+        ADBLOCK_COLLAPSE_SUBDOMAINS=False
+    )
+    return DnsmasqManager(config)
+
+
+def output_size(manager):
+    """Total size in bytes of the files the backend produced"""
+    size = manager.adblock_config.stat().st_size
+    if manager.adblock_hosts.exists():
+        size += manager.adblock_hosts.stat().st_size
+    return size
+
+
+def dns_query(name):
+    """Build a minimal A query packet"""
+    header = struct.pack('>HHHHHH', 0x5044, 0x0100, 1, 0, 0, 0)
+    question = b''.join(bytes([len(label)]) + label.encode('ascii') for label in name.split('.'))
+    return header + question + b'\x00' + struct.pack('>HH', 1, 1)
+
+
+def free_udp_port():
+    """Pick a free local UDP port"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def read_rss_kb(pid):
+    """Read the resident set size of a process from /proc"""
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return None
+
+
+def dnsmasq_command(dnsmasq, manager, extra=()):
+    """Command line loading only the generated adblock config"""
+    return [
+        dnsmasq,
+        f'--conf-file={manager.adblock_config}',
+        '--no-resolv',
+        '--no-hosts',
+        '--keep-in-foreground',
+        '--pid-file=',
+        *extra
+    ]
+
+
+def time_dnsmasq_test(dnsmasq, manager):
+    """Time `dnsmasq --test` on the generated config"""
+    start = time.perf_counter()
+    result = subprocess.run(dnsmasq_command(dnsmasq, manager, ['--test']), capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip())
+    return elapsed
+
+
+def measure_running_dnsmasq(dnsmasq, manager, probe_domain, timeout):
+    """Spawn dnsmasq on a local port, wait until it answers, return (startup seconds, RSS KiB)"""
+    port = free_udp_port()
+    command = dnsmasq_command(dnsmasq, manager, [
+        f'--port={port}',
+        '--listen-address=127.0.0.1',
+        '--bind-interfaces',
+        '--cache-size=0'
+    ])
+
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(0.1)
+            query = dns_query(probe_domain)
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError(process.stderr.read().decode(errors='replace').strip())
+                if time.perf_counter() - start > timeout:
+                    raise RuntimeError("dnsmasq did not answer in time")
+                try:
+                    sock.sendto(query, ('127.0.0.1', port))
+                    sock.recvfrom(512)
+                    break
+                except OSError:
+                    continue
+        startup = time.perf_counter() - start
+        return startup, read_rss_kb(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark dnsmasq adblock output formats')
+    parser.add_argument('--domains', type=int, default=200000, help='Number of synthetic blocked domains')
+    parser.add_argument('--formats', nargs='+', default=list(ADBLOCK_OUTPUT_FORMATS),
+                        choices=ADBLOCK_OUTPUT_FORMATS, help='Output formats to compare')
+    parser.add_argument('--dnsmasq', default=shutil.which('dnsmasq'), help='Path to the dnsmasq binary')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Seconds to wait for dnsmasq to start')
+    args = parser.parse_args()
+
+    domains = generate_domains(args.domains)
+    probe_domain = next(iter(domains))
+    print(f"Domains: {len(domains)}")
+    if not args.dnsmasq:
+        print("dnsmasq not found, only measuring generation time and file size")
+
+    print(f"{'format':<18}{'size MiB':>10}{'write s':>10}{'test s':>10}{'start s':>10}{'RSS MiB':>10}")
+    with tempfile.TemporaryDirectory(prefix='pidns-bench-') as scratch:
+        for output_format in args.formats:
+            manager = build_manager(scratch, output_format)
+
+            start = time.perf_counter()
+            if not manager.generate_adblock_config(domains):
+                print(f"{output_format:<18}generation failed")
+                continue
+            write_time = time.perf_counter() - start
+            size = output_size(manager) / (1024 * 1024)
+
+            test_time = startup = rss = None
+            if args.dnsmasq:
+                try:
+                    test_time = time_dnsmasq_test(args.dnsmasq, manager)
+                    startup, rss_kb = measure_running_dnsmasq(args.dnsmasq, manager, probe_domain, args.timeout)
+                    rss = rss_kb / 1024 if rss_kb else None
+                except Exception as e:
+                    print(f"{output_format:<18}dnsmasq failed: {e}")
+                    continue
+
+            def column(value):
+                return f"{value:>10.2f}" if value is not None else f"{'-':>10}"
+
+            print(f"{output_format:<18}{column(size)}{column(write_time)}{column(test_time)}"
+                  f"{column(startup)}{column(rss)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Query stat flush benchmark for PiDNS Ad-Blocker
+Compares rows/sec of the old ORM flush (QueryStat objects handed to
+bulk_save_objects on a plain query_stats table) with the Core executemany
+flush into daily partitions, each on a file-backed SQLite database
+
+Run from the repository root:
+    python -m adblocker.benchmarks.bench_query_flush --rows 5000 --flushes 10
+"""
+
+import argparse
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from flask import Flask
+
+from adblocker.models.database import QueryStat, db, init_query_partitions, insert_query_stat_rows
+from adblocker.services.query_logger import build_query_stat_rows
+
+
+def generate_queries(count, seed=1):
+    """Generate queued query records like the correlator produces"""
+    rng = random.Random(seed)
+    start = datetime.now() - timedelta(hours=1)
+    queries = []
+    for i in range(count):
+        blocked = rng.random() < 0.2
+        queries.append({
+            'type': 'blocked' if blocked else 'query',
+            'timestamp': start + timedelta(milliseconds=i * 50),
+            'domain': f"host{rng.randrange(5000)}.example{rng.randrange(50)}.com",
+            'client_ip': f"192.168.1.{rng.randrange(2, 250)}",
+            'query_type': rng.choice(['A', 'AAAA', 'HTTPS']),
+            'outcome': 'blocked' if blocked else rng.choice(['cached', 'forwarded']),
+            'upstream': None if blocked else '192.0.2.53',
+            'response_ms': None if blocked else round(rng.uniform(5, 80), 3),
+        })
+    return queries
+
+
+def orm_flush(queries):
+    """The previous flush: one QueryStat instance per query, then bulk_save_objects"""
+    query_stats = []
+    for query in queries:
+        query_stats.append(QueryStat(
+            timestamp=query['timestamp'],
+            domain=query['domain'],
+            client_ip=query['client_ip'] or 'unknown',
+            query_type=query['query_type'] or 'A',
+            outcome=query['outcome'],
+            upstream=query['upstream'],
+            response_ms=query['response_ms'],
+            blocked=query['type'] == 'blocked',
+            block_list_id=None
+        ))
+    db.session.bulk_save_objects(query_stats)
+    db.session.commit()
+
+
+def core_flush(queries):
+    """The current flush: column dicts and one Core executemany per day partition"""
+    insert_query_stat_rows(build_query_stat_rows(queries, {}))
+    db.session.commit()
+
+
+def measure(flush, batches):
+    """Run every batch as one flush and return rows/sec"""
+    rows = sum(len(batch) for batch in batches)
+    start = time.perf_counter()
+    for batch in batches:
+        flush(batch)
+    return rows / (time.perf_counter() - start)
+
+
+def make_app(db_path):
+    """Create a Flask app bound to a scratch SQLite database"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{db_path}"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark QueryStat flush paths')
+    parser.add_argument('--rows', type=int, default=5000, help='Rows per flush')
+    parser.add_argument('--flushes', type=int, default=10, help='Flushes per path')
+    args = parser.parse_args()
+
+    batches = [generate_queries(args.rows, seed=i) for i in range(args.flushes)]
+
+    with tempfile.TemporaryDirectory(prefix='pidns-bench-') as scratch:
+        legacy_app = make_app(Path(scratch) / 'legacy.db')
+        with legacy_app.app_context():
+            # Plain query_stats table, as before partitioning
+            db.create_all()
+            orm_rate = measure(orm_flush, batches)
+
+        app = make_app(Path(scratch) / 'bench.db')
+        with app.app_context():
+            init_query_partitions()
+            db.create_all()
+            core_rate = measure(core_flush, batches)
+            total = QueryStat.query.count()
+
+    print(f"Flushes:   {args.flushes} x {args.rows} rows (file-backed SQLite)")
+    print(f"ORM:       {orm_rate:,.0f} rows/sec")
+    print(f"Core:      {core_rate:,.0f} rows/sec")
+    print(f"Speed-up:  {core_rate / orm_rate:.1f}x")
+    print(f"Rows:      {total}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Query sketch benchmark for PiDNS Ad-Blocker
+Ingests synthetic queries in QueryLogger-sized batches, then compares the
+exact statistics queries with the sketch-based ?approx=1 answers: p95
+latency, distinct-count error, top-domain recall and whether every
+approximate count stays within its reported bound. Also reports what the
+sketches add to each flush.
+
+Run from the repository root:
+    python -m adblocker.benchmarks.bench_sketches --days 7 --rows-per-day 50000
+"""
+
+import argparse
+import random
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from flask import Flask
+from sqlalchemy import func
+
+from adblocker.config.flask_config import Config
+from adblocker.models.database import QueryStat, db, init_database
+from adblocker.models.database import add_hourly_rollups, insert_query_stat_rows
+from adblocker.services.sketches import SKETCH_TOP_DOMAINS, add_query_sketches, approx_overview, approx_top
+from adblocker.services.stats_queries import top_counts
+
+
+def populate(days, rows_per_day, batch_size, seed=1):
+    """Ingest synthetic queries in flush-sized batches; returns the exact domain counts and sketch time"""
+    rng = random.Random(seed)
+    end = datetime.now().replace(minute=0, second=0, microsecond=0)
+    start = end - timedelta(days=days)
+    timestamps = sorted(start + timedelta(seconds=rng.uniform(0, days * 86400)) for _ in range(days * rows_per_day))
+
+    domains = Counter()
+    sketch_seconds = 0.0
+    for offset in range(0, len(timestamps), batch_size):
+        rows = []
+        for timestamp in timestamps[offset:offset + batch_size]:
+            domain = f"host{int(rng.paretovariate(0.8)) % 50000}.example{rng.randrange(4)}.com"
+            rows.append({
+                'timestamp': timestamp,
+                'domain': domain,
+                'client_ip': f"192.168.{rng.randrange(4)}.{rng.randrange(2, 250)}",
+                'query_type': 'A',
+                'outcome': 'forwarded',
+                'upstream': '192.0.2.53',
+                'response_ms': rng.uniform(5, 80),
+                'blocked': rng.random() < 0.2,
+                'block_list_id': None
+            })
+            domains[domain] += 1
+        add_hourly_rollups(rows)
+        started = time.perf_counter()
+        add_query_sketches(rows)
+        sketch_seconds += time.perf_counter() - started
+        insert_query_stat_rows(rows)
+        db.session.commit()
+    return start, end, domains, sketch_seconds
+
+
+def exact_unique(start, end):
+    """COUNT(DISTINCT) of domains and clients, as the overview runs it"""
+    return tuple(
+        db.session.query(func.count(func.distinct(column))).filter(
+            QueryStat.timestamp >= start,
+            QueryStat.timestamp < end
+        ).scalar()
+        for column in (QueryStat.domain, QueryStat.client_ip)
+    )
+
+
+def p95(func_, repeats):
+    """95th percentile wall time of repeated calls, in milliseconds"""
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        func_()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings[max(0, int(len(timings) * 0.95 + 0.5) - 1)] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sketch-based approximate statistics')
+    parser.add_argument('--days', type=int, default=7, help='Days of queries (and window size)')
+    parser.add_argument('--rows-per-day', type=int, default=50000, help='Queries per day')
+    parser.add_argument('--batch', type=int, default=Config.QUERY_LOG_BATCH_SIZE, help='Rows per flush')
+    parser.add_argument('--repeats', type=int, default=10, help='Timed runs per query')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='pidns-bench-') as scratch:
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{Path(scratch) / 'bench.db'}"
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        app.config['SQLITE_PRAGMAS'] = Config.SQLITE_PRAGMAS
+        init_database(app)
+
+        with app.app_context():
+            start, end, domains, sketch_seconds = populate(args.days, args.rows_per_day, args.batch)
+            total = sum(domains.values())
+
+            unique_domains, unique_clients = exact_unique(start, end)
+            estimates = approx_overview(start, end)
+            approx_domains = approx_top(SKETCH_TOP_DOMAINS, start, end, 20)
+            exact_top = {domain for domain, _ in domains.most_common(20)}
+            within_bounds = all(
+                count - max_overcount <= domains[domain] <= count
+                for domain, count, max_overcount in approx_top(SKETCH_TOP_DOMAINS, start, end, 200)
+            )
+
+            exact_overview_ms = p95(lambda: exact_unique(start, end), args.repeats)
+            approx_overview_ms = p95(lambda: approx_overview(start, end), args.repeats)
+            exact_top_ms = p95(lambda: top_counts('domain', start, end), args.repeats)
+            approx_top_ms = p95(lambda: approx_top(SKETCH_TOP_DOMAINS, start, end, 20), args.repeats)
+
+    batches = -(-total // args.batch)
+    print(f"Window:          {args.days} days, {total:,} queries, {len(domains):,} domains")
+    print(f"Ingest:          sketches add {sketch_seconds / batches * 1000:.1f} ms per {args.batch}-row flush")
+    print(f"Unique domains:  exact {unique_domains:,}, approx {estimates['unique_domains']:,} "
+          f"({(estimates['unique_domains'] - unique_domains) / unique_domains:+.2%})")
+    print(f"Unique clients:  exact {unique_clients:,}, approx {estimates['unique_clients']:,} "
+          f"({(estimates['unique_clients'] - unique_clients) / unique_clients:+.2%})")
+    print(f"Totals:          {'exact' if estimates['total_queries'] == total else 'DIFFERENT'}")
+    print(f"Top 20 domains:  {len(exact_top & {domain for domain, _, _ in approx_domains})}/20 recalled, "
+          f"counts {'within' if within_bounds else 'OUTSIDE'} reported bounds")
+    print(f"Overview p95:    COUNT(DISTINCT) {exact_overview_ms:.1f} ms, sketches {approx_overview_ms:.1f} ms")
+    print(f"Top domains p95: rollups {exact_top_ms:.1f} ms, sketches {approx_top_ms:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+SQLite concurrency stress test for PiDNS Ad-Blocker
+Runs a query-logger style writer flushing batches into query_stats while
+reader threads run statistics queries, once with SQLite's default pragmas
+(rollback journal) and once with Config.SQLITE_PRAGMAS (WAL), and reports
+how many reads completed during writes, their latency and lock errors
+
+Each write transaction runs several insert statements and is then held
+open for --hold seconds before it commits, like a flush that still has
+summaries, rollups and sketches to update. Once its changes outgrow the
+default 2 MB page cache, a rollback-journal writer takes the EXCLUSIVE lock
+until commit and readers stall; in WAL mode they keep reading. Exits
+non-zero unless readers make progress inside write transactions with
+SQLITE_PRAGMAS and stall or fail without them.
+
+Run from the repository root:
+    python -m adblocker.benchmarks.bench_sqlite_concurrency --seconds 10 --readers 4
+"""
+
+import argparse
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from flask import Flask
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
+
+from adblocker.config.flask_config import Config
+from adblocker.models.database import QueryStat, db, init_database, insert_query_stat_rows
+
+
+def make_app(db_path, pragmas):
+    """Create a Flask app on a scratch database with the given pragmas"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{db_path}"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLITE_PRAGMAS'] = pragmas
+    init_database(app)
+    return app
+
+
+def generate_rows(count, rng):
+    """Query stat rows spread over the last hour"""
+    now = datetime.now()
+    return [{
+        'timestamp': now - timedelta(seconds=rng.randrange(3600)),
+        'domain': f"host{rng.randrange(2000)}.example.com",
+        'client_ip': f"192.168.1.{rng.randrange(2, 50)}",
+        'query_type': 'A',
+        'outcome': 'forwarded',
+        'upstream': '192.0.2.53',
+        'response_ms': rng.uniform(5, 80),
+        'blocked': rng.random() < 0.2,
+        'block_list_id': None
+    } for _ in range(count)]
+
+
+def writer(app, stop, batch_size, statements, hold, stats, writing):
+    """Flush multi-statement transactions back to back, like QueryLogger catching up on a backlog"""
+    rng = random.Random(1)
+    with app.app_context():
+        while not stop.is_set():
+            batches = [generate_rows(batch_size, rng) for _ in range(statements)]
+            start = time.perf_counter()
+            try:
+                for rows in batches:
+                    insert_query_stat_rows(rows)
+                # The write transaction is open and holds its locks until commit
+                writing.set()
+                time.sleep(hold)
+                db.session.commit()
+                stats['batches'] += 1
+            except OperationalError:
+                db.session.rollback()
+                stats['errors'] += 1
+            finally:
+                writing.clear()
+            stats['latencies'].append(time.perf_counter() - start)
+
+
+def reader(app, stop, stats, writing):
+    """Run the overview and top-domains queries in a loop"""
+    since = datetime.now() - timedelta(hours=1)
+    with app.app_context():
+        while not stop.is_set():
+            start = time.perf_counter()
+            during_write = writing.is_set()
+            try:
+                db.session.query(func.count(QueryStat.id)).filter(QueryStat.timestamp >= since).scalar()
+                db.session.query(QueryStat.domain, func.count(QueryStat.id)).filter(
+                    QueryStat.timestamp >= since
+                ).group_by(QueryStat.domain).order_by(func.count(QueryStat.id).desc()).limit(20).all()
+                stats['reads'] += 1
+                # Started and finished while a write transaction was open
+                if during_write and writing.is_set():
+                    stats['during_writes'] += 1
+            except OperationalError:
+                stats['errors'] += 1
+            finally:
+                db.session.rollback()
+            stats['latencies'].append(time.perf_counter() - start)
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile in milliseconds"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, int(len(values) * percent / 100 + 0.5) - 1)] * 1000
+
+
+def run(label, db_path, pragmas, args):
+    """Run writer and readers concurrently and print their results"""
+    app = make_app(db_path, pragmas)
+    with app.app_context():
+        # Something to read from the start
+        insert_query_stat_rows(generate_rows(args.batch, random.Random(0)))
+        db.session.commit()
+
+    stop = threading.Event()
+    writing = threading.Event()
+    write_stats = {'batches': 0, 'errors': 0, 'latencies': []}
+    read_stats = [{'reads': 0, 'during_writes': 0, 'errors': 0, 'latencies': []} for _ in range(args.readers)]
+    threads = [threading.Thread(
+        target=writer, args=(app, stop, args.batch, args.statements, args.hold, write_stats, writing)
+    )]
+    threads += [threading.Thread(target=reader, args=(app, stop, stats, writing)) for stats in read_stats]
+
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    read_latencies = [latency for stats in read_stats for latency in stats['latencies']]
+    result = {
+        'transactions': write_stats['batches'],
+        'reads': sum(stats['reads'] for stats in read_stats),
+        'during_writes': sum(stats['during_writes'] for stats in read_stats),
+        'errors': sum(stats['errors'] for stats in read_stats)
+    }
+    print(f"{label}")
+    print(f"  writer:  {write_stats['batches']} transactions of {args.statements} x {args.batch} rows, "
+          f"{write_stats['errors']} lock errors, p99 {percentile(write_stats['latencies'], 99):.1f} ms")
+    print(f"  readers: {result['reads']} reads ({result['during_writes']} within a write transaction), "
+          f"{result['errors']} lock errors, "
+          f"p50 {percentile(read_latencies, 50):.1f} ms, p99 {percentile(read_latencies, 99):.1f} ms")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stress SQLite with concurrent query_stats readers and a writer')
+    parser.add_argument('--seconds', type=float, default=10, help='Duration of each run')
+    parser.add_argument('--readers', type=int, default=4, help='Reader threads')
+    parser.add_argument('--batch', type=int, default=5000, help='Rows per insert statement')
+    parser.add_argument('--statements', type=int, default=6, help='Insert statements per write transaction')
+    parser.add_argument('--hold', type=float, default=1.0, help='Seconds a write transaction stays open before commit')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='pidns-bench-') as scratch:
+        # No busy_timeout override beyond the driver's own 5s default
+        default = run('Default pragmas (rollback journal)', Path(scratch) / 'default.db', {}, args)
+        tuned = run('Config.SQLITE_PRAGMAS (WAL)', Path(scratch) / 'tuned.db', Config.SQLITE_PRAGMAS, args)
+
+    failures = []
+    if not tuned['transactions']:
+        failures.append("no write transaction committed with SQLITE_PRAGMAS")
+    if tuned['errors'] or not tuned['during_writes']:
+        failures.append("readers did not make progress during writes with SQLITE_PRAGMAS")
+    if default['during_writes'] and not default['errors']:
+        failures.append("readers were not held back by writes with default pragmas; "
+                        "raise --batch or --statements so a transaction outgrows the page cache")
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
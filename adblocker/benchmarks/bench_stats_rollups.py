@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Hourly rollup benchmark for PiDNS Ad-Blocker
+Compares p95 latency of the 7-day statistics views computed from raw
+query_stats rows with the rollup-backed queries the API now uses, and
+checks that both return the same counts
+
+Run from the repository root:
+    python -m adblocker.benchmarks.bench_stats_rollups --days 7 --rows-per-day 50000
+"""
+
+import argparse
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from flask import Flask
+from sqlalchemy import func
+
+from adblocker.config.flask_config import Config
+from adblocker.models.database import QueryStat, db, init_database
+from adblocker.models.database import add_hourly_rollups, insert_query_stat_rows
+from adblocker.services.stats_queries import bucket_counts, top_counts
+
+
+def populate(days, rows_per_day, seed=1):
+    """Ingest synthetic queries the way QueryLogger flushes them"""
+    rng = random.Random(seed)
+    now = datetime.now()
+    for day in range(days):
+        rows = [{
+            'timestamp': now - timedelta(days=day, seconds=rng.randrange(86400)),
+            'domain': f"host{int(rng.paretovariate(1.0)) % 3000}.example.com",
+            'client_ip': f"192.168.1.{rng.randrange(2, 17)}",
+            'query_type': 'A',
+            'outcome': 'forwarded',
+            'upstream': '192.0.2.53',
+            'response_ms': rng.uniform(5, 80),
+            'blocked': rng.random() < 0.2,
+            'block_list_id': None
+        } for _ in range(rows_per_day)]
+        add_hourly_rollups(rows)
+        insert_query_stat_rows(rows)
+        db.session.commit()
+
+
+def raw_top_domains(start, end):
+    """The previous /statistics/top-domains query over raw rows"""
+    return db.session.query(
+        QueryStat.domain,
+        func.count(QueryStat.id).label('count')
+    ).filter(
+        QueryStat.timestamp >= start,
+        QueryStat.timestamp < end
+    ).group_by(QueryStat.domain).order_by(func.count(QueryStat.id).desc(), QueryStat.domain).limit(20).all()
+
+
+def raw_hourly(start, end):
+    """Hourly totals over raw rows, bucketed in Python"""
+    hours = {}
+    for (timestamp,) in db.session.query(QueryStat.timestamp).filter(
+        QueryStat.timestamp >= start,
+        QueryStat.timestamp < end
+    ):
+        hour = timestamp.replace(minute=0, second=0, microsecond=0)
+        hours[hour] = hours.get(hour, 0) + 1
+    return hours
+
+
+def p95(func_, repeats):
+    """95th percentile wall time of repeated calls, in milliseconds"""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func_()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[max(0, int(len(timings) * 0.95 + 0.5) - 1)] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark rollup-backed statistics queries')
+    parser.add_argument('--days', type=int, default=7, help='Days of queries (and window size)')
+    parser.add_argument('--rows-per-day', type=int, default=50000, help='Queries per day')
+    parser.add_argument('--repeats', type=int, default=20, help='Timed runs per query')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='pidns-bench-') as scratch:
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{Path(scratch) / 'bench.db'}"
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        app.config['SQLITE_PRAGMAS'] = Config.SQLITE_PRAGMAS
+        init_database(app)
+
+        with app.app_context():
+            populate(args.days, args.rows_per_day)
+            end = datetime.now()
+            start = end - timedelta(days=args.days)
+
+            # Ties are broken differently, so compare the counts per rank
+            raw_counts = [count for _, count in raw_top_domains(start, end)]
+            rollup_counts = [count for _, count in top_counts('domain', start, end)]
+            hourly_match = {hour: total for hour, total, _ in bucket_counts(start, end)} == raw_hourly(start, end)
+
+            raw_top_ms = p95(lambda: raw_top_domains(start, end), args.repeats)
+            rollup_top_ms = p95(lambda: top_counts('domain', start, end), args.repeats)
+            raw_hourly_ms = p95(lambda: raw_hourly(start, end), args.repeats)
+            rollup_hourly_ms = p95(lambda: bucket_counts(start, end), args.repeats)
+
+    print(f"Window:       {args.days} days, {args.days * args.rows_per_day:,} queries")
+    print(f"Top domains:  raw p95 {raw_top_ms:.1f} ms, rollups p95 {rollup_top_ms:.1f} ms "
+          f"({'same' if raw_counts == rollup_counts else 'DIFFERENT'} counts)")
+    print(f"Hourly:       raw p95 {raw_hourly_ms:.1f} ms, rollups p95 {rollup_hourly_ms:.1f} ms "
+          f"({'same' if hourly_match else 'DIFFERENT'} counts)")
+
+
+if __name__ == '__main__':
+    main()
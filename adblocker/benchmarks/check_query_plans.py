@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Query plan check for PiDNS Ad-Blocker
+Calls each statistics endpoint against a scratch SQLite database, captures
+the SQL it runs against query_stats and asserts with EXPLAIN QUERY PLAN that
+no query partition is read without an index. Exits non-zero on failure.
+
+Run from the repository root:
+    python -m adblocker.benchmarks.check_query_plans --days 3
+"""
+
+import argparse
+import base64
+import random
+import sys
+import tempfile
+from datetime import date, datetime, time, timedelta
+from pathlib import Path
+
+from flask import Flask
+from sqlalchemy import event
+
+from adblocker.api.statistics import stats_bp
+from adblocker.config.flask_config import get_config
+from adblocker.models.database import QUERY_PARTITION_PREFIX, db, init_database, insert_query_stat_rows
+
+# Statistics endpoints that read query_stats
+ENDPOINTS = [
+    '/api/statistics/overview',
+    '/api/statistics/recent-queries',
+    '/api/statistics/recent-queries?blocked_only=true',
+    '/api/statistics/top-domains',
+    '/api/statistics/top-domains?blocked_only=true',
+    '/api/statistics/top-clients',
+    '/api/statistics/blocklist-performance',
+    '/api/statistics/hourly',
+    '/api/statistics/upstreams',
+]
+
+USERNAME = 'admin'
+PASSWORD = 'password'
+
+
+def make_app(scratch):
+    """Create an app with the statistics API on a scratch database"""
+    app = Flask(__name__)
+    app.config.from_object(get_config())
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{Path(scratch) / 'plans.db'}"
+    app.config['DATABASE_PATH'] = Path(scratch) / 'plans.db'
+    app.config['BASIC_AUTH_USERNAME'] = USERNAME
+    app.config['BASIC_AUTH_PASSWORD'] = PASSWORD
+    app.register_blueprint(stats_bp, url_prefix='/api')
+    init_database(app)
+    return app
+
+
+def populate(days, rows_per_day, seed=1):
+    """Fill one partition per day with synthetic queries"""
+    rng = random.Random(seed)
+    start = datetime.combine(date.today() - timedelta(days=days - 1), time())
+    for day in range(days):
+        rows = []
+        for i in range(rows_per_day):
+            blocked = rng.random() < 0.2
+            rows.append({
+                'timestamp': start + timedelta(days=day, seconds=i * 86400 // rows_per_day),
+                'domain': f"host{rng.randrange(500)}.example.com",
+                'client_ip': f"192.168.1.{rng.randrange(2, 50)}",
+                'query_type': 'A',
+                'outcome': 'blocked' if blocked else 'forwarded',
+                'upstream': None if blocked else '192.0.2.53',
+                'response_ms': None if blocked else rng.uniform(5, 80),
+                'blocked': blocked,
+                'block_list_id': None
+            })
+        insert_query_stat_rows(rows)
+    db.session.commit()
+
+
+def capture_statements(app, client):
+    """Call every endpoint and collect the query_stats statements it ran"""
+    statements = {}
+    current = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if 'query_stats' in statement and statement.lstrip().upper().startswith('SELECT'):
+            current.append((statement, parameters))
+
+    auth = base64.b64encode(f"{USERNAME}:{PASSWORD}".encode()).decode()
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            for endpoint in ENDPOINTS:
+                current.clear()
+                response = client.get(endpoint, headers={'Authorization': f"Basic {auth}"})
+                statements[endpoint] = (response.status_code, list(current))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    return statements
+
+
+def unindexed_reads(plan):
+    """Plan lines that read a query partition without an index"""
+    return [
+        detail for detail in plan
+        if QUERY_PARTITION_PREFIX in detail and detail.startswith('SCAN') and 'INDEX' not in detail
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check statistics queries use the query_stats indexes')
+    parser.add_argument('--days', type=int, default=3, help='Daily partitions to create')
+    parser.add_argument('--rows', type=int, default=2000, help='Rows per partition')
+    args = parser.parse_args()
+
+    failures = 0
+    with tempfile.TemporaryDirectory(prefix='pidns-plans-') as scratch:
+        app = make_app(scratch)
+        with app.app_context():
+            populate(args.days, args.rows)
+
+        statements = capture_statements(app, app.test_client())
+
+        with app.app_context():
+            connection = db.session.connection()
+            for endpoint, (status, queries) in statements.items():
+                if not queries:
+                    print(f"FAIL  {endpoint}: no query_stats statement ran (HTTP {status})")
+                    failures += 1
+                    continue
+
+                for statement, parameters in queries:
+                    try:
+                        rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+                    except Exception as e:
+                        print(f"FAIL  {endpoint}: cannot plan statement: {e}")
+                        db.session.rollback()
+                        connection = db.session.connection()
+                        failures += 1
+                        continue
+
+                    plan = [row[-1] for row in rows]
+                    scans = unindexed_reads(plan)
+                    if scans:
+                        print(f"FAIL  {endpoint}: {'; '.join(scans)}")
+                        failures += 1
+                    else:
+                        reads = [detail for detail in plan if QUERY_PARTITION_PREFIX in detail]
+                        print(f"ok    {endpoint}: {reads[0] if reads else 'no partition read'}")
+
+    print(f"{failures} failing statement(s)")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
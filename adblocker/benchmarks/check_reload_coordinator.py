@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Reload coordinator check for PiDNS Ad-Blocker
+Runs a coordinator rebuild against a real Flask app whose dnsmasq paths point
+into a scratch directory, then asserts that every config file was written,
+that a failed reload is retried until it succeeds, and that an unchanged pass
+afterwards skips the reload. Exits non-zero on failure.
+
+dnsmasq is not reloaded for real: stub dnsmasq and systemctl scripts are put
+first on PATH, failing at first and succeeding once the check switches them.
+
+Run from the repository root:
+    python -m adblocker.benchmarks.check_reload_coordinator
+"""
+
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from flask import Flask
+
+from adblocker.config.flask_config import get_config
+from adblocker.models.database import Blacklist, Whitelist, db, init_database
+from adblocker.services.dnsmasq_manager import RELOAD_PENDING_MARKER
+from adblocker.services.reload_coordinator import RELOAD_TARGETS, ReloadCoordinator
+
+STUB_COMMANDS = ('dnsmasq', 'systemctl')
+
+
+def make_app(scratch):
+    """Create an app whose database and dnsmasq files live under scratch"""
+    scratch = Path(scratch)
+    config_dir = scratch / 'dnsmasq.d'
+    config_dir.mkdir()
+
+    app = Flask(__name__)
+    app.config.from_object(get_config())
+    app.config['DATABASE_PATH'] = scratch / 'reload.db'
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{scratch / 'reload.db'}"
+    app.config['DNSMASQ_CONFIG_DIR'] = str(config_dir)
+    app.config['ADBLOCK_CONFIG_FILE'] = str(config_dir / 'adblock.conf')
+    app.config['WHITELIST_CONFIG_FILE'] = str(config_dir / 'whitelist.conf')
+    app.config['BLACKLIST_CONFIG_FILE'] = str(config_dir / 'blacklist.conf')
+    app.config['ADBLOCK_HOSTS_FILE'] = scratch / 'adblock.hosts'
+    app.config['BLOCKLISTS_DIR'] = scratch / 'blocklists'
+    app.config['DOMAIN_INDEX_FILE'] = scratch / 'domain_index.db'
+    init_database(app)
+
+    with app.app_context():
+        db.session.add(Whitelist(domain='allowed.example.com'))
+        db.session.add(Blacklist(domain='denied.example.com'))
+        db.session.commit()
+    return app
+
+
+def write_stubs(bin_dir, exit_code):
+    """Make the stub dnsmasq and systemctl commands exit with exit_code"""
+    for name in STUB_COMMANDS:
+        stub = bin_dir / name
+        stub.write_text(f"#!/bin/sh\nexit {exit_code}\n")
+        stub.chmod(0o755)
+
+
+def wait_for(coordinator, predicate, timeout=30):
+    """Poll the coordinator status until predicate holds; returns the status"""
+    deadline = time.monotonic() + timeout
+    while True:
+        status = coordinator.get_status()
+        if predicate(status):
+            return status
+        if time.monotonic() > deadline:
+            raise AssertionError(f"coordinator did not reach the expected state within {timeout}s: {status}")
+        time.sleep(0.05)
+
+
+def run_pass(coordinator):
+    """Queue every target and wait for the worker to finish the rebuild"""
+    coordinator.request(*RELOAD_TARGETS)
+    if not coordinator.wait_idle(timeout=30):
+        raise AssertionError("rebuild did not finish within 30s")
+    return coordinator.get_status()
+
+
+def main():
+    failures = []
+    with tempfile.TemporaryDirectory() as scratch:
+        bin_dir = Path(scratch) / 'bin'
+        bin_dir.mkdir()
+        write_stubs(bin_dir, 1)
+        os.environ['PATH'] = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+
+        app = make_app(scratch)
+        marker = Path(app.config['DNSMASQ_CONFIG_DIR']) / RELOAD_PENDING_MARKER
+        coordinator = ReloadCoordinator(app, debounce_seconds=0, retry_seconds=0.1, max_retry_seconds=0.2)
+        coordinator.start()
+        try:
+            # With dnsmasq failing, the worker keeps retrying on its own
+            coordinator.request(*RELOAD_TARGETS)
+            failing = wait_for(coordinator, lambda status: status['reload_count'] >= 2)
+            marker_while_failing = marker.exists()
+
+            write_stubs(bin_dir, 0)
+            first = wait_for(coordinator, lambda status: status['last_success'] and not status['pending'])
+            second = run_pass(coordinator)
+        finally:
+            coordinator.stop(timeout=5)
+
+        config = app.config
+        print(f"failing:     reloads={failing['reload_count']} pending={failing['reload_pending']} "
+              f"failures={failing['consecutive_failures']}")
+        print(f"recovered:   reloads={first['reload_count']} success={first['last_success']} "
+              f"error={first['last_error']}")
+        print(f"second pass: reloads={second['reload_count']} success={second['last_success']} "
+              f"error={second['last_error']}")
+
+        for status in (failing, first, second):
+            if status['last_error']:
+                failures.append(f"rebuild raised: {status['last_error']}")
+
+        if failing['last_success'] is not False or not failing['reload_pending']:
+            failures.append("failed reload was not reported as pending")
+        if not marker_while_failing:
+            failures.append(f"{RELOAD_PENDING_MARKER} missing while the reload was failing")
+        if first['reload_pending'] or marker.exists():
+            failures.append("reload still pending after dnsmasq recovered")
+
+        expected = {
+            config['WHITELIST_CONFIG_FILE']: 'allowed.example.com',
+            config['BLACKLIST_CONFIG_FILE']: 'denied.example.com',
+            config['ADBLOCK_CONFIG_FILE']: None,
+        }
+        for path, domain in expected.items():
+            path = Path(path)
+            if not path.exists():
+                failures.append(f"{path.name} was not written")
+            elif domain and domain not in path.read_text():
+                failures.append(f"{path.name} does not mention {domain}")
+
+        if first['reload_count'] <= failing['reload_count']:
+            failures.append("failed reload was not retried after dnsmasq recovered")
+        if second['reload_count'] != first['reload_count'] or not second['last_success']:
+            failures.append("unchanged second pass did not skip the reload")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if failures:
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Time bucket check for PiDNS Ad-Blocker
+Ingests synthetic queries into a scratch SQLite database (or the database
+given with --database-url, e.g. a PostgreSQL test server) and checks that
+bucket_counts returns the same per-minute, hour, day and week counts as
+bucketing the same timestamps in Python. Exits non-zero on failure.
+
+Run from the repository root:
+    python -m adblocker.benchmarks.check_time_buckets
+    python -m adblocker.benchmarks.check_time_buckets --database-url postgresql://localhost/adblocker_test
+"""
+
+import argparse
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from flask import Flask
+from sqlalchemy.dialects import postgresql
+
+from adblocker.models.database import TIME_BUCKET_SECONDS, QueryStat, db, init_database, time_bucket
+from adblocker.models.database import add_hourly_rollups, insert_query_stat_rows
+from adblocker.services.stats_queries import bucket_counts
+
+
+def bucket_floor(timestamp, unit):
+    """Reference bucketing in Python"""
+    if unit == 'minute':
+        return timestamp.replace(second=0, microsecond=0)
+    if unit == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    day = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    if unit == 'day':
+        return day
+    return day - timedelta(days=day.weekday())
+
+
+def generate_timestamps(start, end, count, seed=1):
+    """Random timestamps in [start, end) plus ones on bucket edges"""
+    rng = random.Random(seed)
+    span = (end - start).total_seconds()
+    timestamps = [start + timedelta(seconds=rng.uniform(0, span)) for _ in range(count)]
+
+    # Exactly on, and just before, each midnight (weeks start on one of them)
+    day = bucket_floor(start, 'day') + timedelta(days=1)
+    while day < end:
+        timestamps += [day, day - timedelta(microseconds=1), day + timedelta(minutes=59, seconds=59)]
+        day += timedelta(days=1)
+    return [timestamp for timestamp in timestamps if start <= timestamp < end]
+
+
+def ingest(timestamps, seed=1):
+    """Store the timestamps the way QueryLogger flushes a batch"""
+    rng = random.Random(seed)
+    rows = [{
+        'timestamp': timestamp,
+        'domain': f"host{rng.randrange(50)}.example.com",
+        'client_ip': f"192.168.1.{rng.randrange(2, 10)}",
+        'query_type': 'A',
+        'outcome': 'forwarded',
+        'upstream': '192.0.2.53',
+        'response_ms': rng.uniform(5, 80),
+        'blocked': rng.random() < 0.2,
+        'block_list_id': None
+    } for timestamp in timestamps]
+    add_hourly_rollups(rows)
+    insert_query_stat_rows(rows)
+    db.session.commit()
+    return rows
+
+
+def expected_counts(rows, unit, start, end):
+    """Python (bucket, total, blocked) rows for a window"""
+    buckets = {}
+    for row in rows:
+        if start <= row['timestamp'] < end:
+            total, blocked = buckets.get(bucket_floor(row['timestamp'], unit), (0, 0))
+            buckets[bucket_floor(row['timestamp'], unit)] = (total + 1, blocked + int(row['blocked']))
+    return [(bucket, total, blocked) for bucket, (total, blocked) in sorted(buckets.items())]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check SQL time bucketing against Python')
+    parser.add_argument('--database-url', help='Database to run against instead of a scratch SQLite file')
+    parser.add_argument('--days', type=int, default=20, help='Days of queries')
+    parser.add_argument('--rows', type=int, default=20000, help='Random queries')
+    args = parser.parse_args()
+
+    failures = 0
+    with tempfile.TemporaryDirectory(prefix='pidns-buckets-') as scratch:
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = args.database_url or f"sqlite:///{Path(scratch) / 'buckets.db'}"
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        init_database(app)
+
+        with app.app_context():
+            print(f"Dialect: {db.engine.dialect.name}")
+            end = datetime.now().replace(microsecond=0)
+            start = end - timedelta(days=args.days)
+            rows = ingest(generate_timestamps(start, end, args.rows))
+
+            # Windows aligned to hours and not, and within a single hour
+            windows = [
+                (start, end),
+                (start + timedelta(minutes=17, seconds=3), end - timedelta(minutes=41)),
+                (bucket_floor(end, 'hour') - timedelta(hours=30), bucket_floor(end, 'hour')),
+                (end - timedelta(minutes=50), end - timedelta(minutes=10)),
+            ]
+            for unit in TIME_BUCKET_SECONDS:
+                for window_start, window_end in windows:
+                    actual = bucket_counts(window_start, window_end, unit)
+                    expected = expected_counts(rows, unit, window_start, window_end)
+                    if actual == expected:
+                        print(f"ok    {unit:6} {window_start} .. {window_end}: {len(actual)} buckets")
+                    else:
+                        mismatched = [pair for pair in zip(actual, expected) if pair[0] != pair[1]]
+                        print(f"FAIL  {unit:6} {window_start} .. {window_end}: {len(actual)} buckets, "
+                              f"expected {len(expected)}, first mismatch {mismatched[:1]}")
+                        failures += 1
+
+    if not args.database_url:
+        # Without a server, at least check the PostgreSQL expression compiles to date_trunc
+        for unit in TIME_BUCKET_SECONDS:
+            sql = str(time_bucket(QueryStat.timestamp, unit, 'postgresql').compile(
+                dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}
+            ))
+            if sql == f"date_trunc('{unit}', query_stats.timestamp)":
+                print(f"ok    postgresql {unit}: {sql}")
+            else:
+                print(f"FAIL  postgresql {unit}: {sql}")
+                failures += 1
+
+    print(f"{failures} failing check(s)")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,6 +22,19 @@ class Config:
     DATABASE_PATH = BASE_DIR / 'data' / 'adblocker.db'
     SQLALCHEMY_DATABASE_URI = f'sqlite:///{DATABASE_PATH}'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Applied to every new SQLite connection, in this order. WAL lets readers
+    # run while the query logger writes; busy_timeout (ms) makes writers wait
+    # for each other instead of failing with "database is locked"
+    SQLITE_PRAGMAS = {
+        'busy_timeout': 5000,
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',  # durable at checkpoints; safe with WAL
+        'cache_size': -8000,  # KiB when negative, i.e. 8 MB per connection
+        'mmap_size': 64 * 1024 * 1024,
+        'temp_store': 'MEMORY'
+    }
+    SQLITE_MAINTENANCE_INTERVAL = 15  # minutes between wal_checkpoint + optimize runs
+    SQLITE_CHECKPOINT_MODE = 'TRUNCATE'  # PASSIVE, FULL, RESTART or TRUNCATE
 
     # Ad-blocker settings
     ADBLOCKER_TITLE = 'PiDNS Ad-Blocker Management'
@@ -33,10 +46,29 @@ class Config:
     WHITELIST_CONFIG_FILE = os.path.join(DNSMASQ_CONFIG_DIR, 'whitelist.conf')
     BLACKLIST_CONFIG_FILE = os.path.join(DNSMASQ_CONFIG_DIR, 'blacklist.conf')
     DNSMASQ_SERVICE = 'dnsmasq'
+    # adblock.conf output backend: 'address' (0.0.0.0 + :: lines), 'address-null'
+    # (single address=/domain/# line), 'address-nxdomain' (address=/domain/),
+    # 'local' (local=/domain/) or 'hosts' (addn-hosts file, exact names only).
+    # Compare them with adblocker/benchmarks/bench_dnsmasq_formats.py
+    ADBLOCK_OUTPUT_FORMAT = 'address'
+    # Hosts file for the 'hosts' backend; must live outside DNSMASQ_CONFIG_DIR
+    ADBLOCK_HOSTS_FILE = BASE_DIR / 'data' / 'adblock.hosts'
+    # Drop blocked domains already covered by a blocked parent domain
+    ADBLOCK_COLLAPSE_SUBDOMAINS = True
+    # Quiet period before queued config changes are rebuilt and dnsmasq reloaded
+    RELOAD_DEBOUNCE_SECONDS = 2.0
+    # Delay before a failed rebuild or reload is retried; doubles per failure up to the maximum
+    RELOAD_RETRY_SECONDS = 5.0
+    RELOAD_MAX_RETRY_SECONDS = 300.0
     
     # Block list settings
     BLOCKLISTS_DIR = BASE_DIR / 'data' / 'blocklists'
+    DOMAIN_INDEX_FILE = BASE_DIR / 'data' / 'domain_index.db'
     BLOCKLIST_UPDATE_INTERVAL = 24  # hours
+    BLOCKLIST_DOWNLOAD_WORKERS = 4  # concurrent downloads
+    BLOCKLIST_DOWNLOAD_PER_HOST = 2  # concurrent downloads per host
+    BLOCKLIST_DOWNLOAD_TIMEOUT = 30  # seconds
+    BLOCKLIST_MAX_BYTES = 64 * 1024 * 1024  # abort larger (decompressed) downloads
     
     # Predefined block list categories
     BLOCKLIST_CATEGORIES = {
@@ -111,7 +143,18 @@ class Config:
     BASIC_AUTH_PASSWORD = os.environ.get('ADBLOCKER_PASSWORD') or 'password'
     
     # Logging
+    # Upstream latencies need sub-second timestamps: log through rsyslog with
+    # RFC 3339 timestamps (RSYSLOG_FileFormat) rather than dnsmasq's log-facility
     DNSMASQ_LOG_FILE = '/var/log/dnsmasq.log'
+    QUERY_LOG_CHECKPOINT_INTERVAL = 5  # seconds between saved log offsets
+    QUERY_LOG_READ_CHUNK_SIZE = 1024 * 1024  # bytes of log read at a time
+    QUERY_LOG_CORRELATION_WINDOW = 10  # seconds a query waits for its answer line
+    QUERY_LOG_BATCH_SIZE = 1000  # buffered queries that trigger a flush
+    QUERY_LOG_FLUSH_INTERVAL = 60  # seconds between time-based flushes
+    QUERY_LOG_BUFFER_SIZE = 50000  # queries held in memory before the overflow policy applies
+    QUERY_LOG_OVERFLOW_POLICY = 'drop_oldest'  # drop, drop_oldest, sample or spill
+    QUERY_LOG_SPILL_FILE = BASE_DIR / 'data' / 'query_spill.jsonl'
+    QUERY_LOG_SPILL_MAX_BYTES = 64 * 1024 * 1024
     QUERY_LOG_RETENTION_DAYS = 30
     
     # Statistics
@@ -2,12 +2,53 @@
 Database models for PiDNS Ad-Blocker
 """
 
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table, cast, event, func, inspect, select, text
+import heapq
 import json
+import logging
+
+# Blocked domains kept in SummaryStat.top_blocked_domains
+TOP_BLOCKED_DOMAINS_LIMIT = 10
+
+# Query stats live in one table per day, e.g. query_stats_p20240105, and are
+# read through a query_stats view over all of them
+QUERY_PARTITION_PREFIX = 'query_stats_p'
+QUERY_PARTITION_DATE_FORMAT = '%Y%m%d'
+QUERY_STATS_META_TABLE = 'query_stats_meta'
+LEGACY_QUERY_STATS_TABLE = 'query_stats_legacy'
+
+# Column groups indexed in every partition. Every statistics query filters on
+# a timestamp range, and `blocked` is tested from the index before the row is
+# read. Reads go through the query_stats view, whose UNION ALL selects every
+# column, so (timestamp, domain) or (timestamp, client_ip) indexes would never
+# be covering and are left out
+QUERY_PARTITION_INDEXES = (
+    ('timestamp', 'blocked'),
+)
+
+# Bucket widths accepted by time_bucket, in seconds
+TIME_BUCKET_SECONDS = {
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400,
+    'week': 604800,
+}
+# The Unix epoch was a Thursday; weeks start on Monday 1970-01-05 like date_trunc('week')
+WEEK_EPOCH_OFFSET = 4 * 86400
 
 db = SQLAlchemy()
 
+logger = logging.getLogger(__name__)
+
+# Rollup key values standing in for NULL, which would defeat the unique key
+ROLLUP_NO_CLIENT = ''
+ROLLUP_NO_BLOCK_LIST = 0
+
+# PRAGMA wal_checkpoint modes
+SQLITE_CHECKPOINT_MODES = ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE')
+
 class BlockList(db.Model):
     """Block list model"""
     __tablename__ = 'block_lists'
@@ -19,6 +60,9 @@ class BlockList(db.Model):
     enabled = db.Column(db.Boolean, default=True)
     last_updated = db.Column(db.DateTime)
     entry_count = db.Column(db.Integer, default=0)
+    content_hash = db.Column(db.String(64))  # SHA-256 of the raw list content
+    etag = db.Column(db.String(255))  # HTTP validators for conditional refreshes
+    last_modified = db.Column(db.String(64))
     description = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -111,7 +155,7 @@ class Blacklist(db.Model):
         return f'<Blacklist {self.domain}>'
 
 class QueryStat(db.Model):
-    """Query statistics model"""
+    """Query statistics model (read-only view over the daily partitions)"""
     __tablename__ = 'query_stats'
     
     id = db.Column(db.Integer, primary_key=True)
@@ -119,6 +163,9 @@ class QueryStat(db.Model):
     domain = db.Column(db.String(255), nullable=False)
     client_ip = db.Column(db.String(45))  # IPv6 compatible
     query_type = db.Column(db.String(10), default='A')
+    outcome = db.Column(db.String(16))  # blocked, cached, forwarded or local
+    upstream = db.Column(db.String(64))  # server a forwarded query went to
+    response_ms = db.Column(db.Float)  # time from forwarding to the upstream reply
     blocked = db.Column(db.Boolean, default=False)
     block_list_id = db.Column(db.Integer, db.ForeignKey('block_lists.id'))
     
@@ -130,6 +177,9 @@ class QueryStat(db.Model):
             'domain': self.domain,
             'client_ip': self.client_ip,
             'query_type': self.query_type,
+            'outcome': self.outcome,
+            'upstream': self.upstream,
+            'response_ms': self.response_ms,
             'blocked': self.blocked,
             'block_list_id': self.block_list_id,
             'block_list_name': self.block_list.name if self.block_list else None
@@ -138,6 +188,40 @@ class QueryStat(db.Model):
     def __repr__(self):
         return f'<QueryStat {self.domain}>'
 
+class HourlyRollup(db.Model):
+    """Query counts per hour, domain, client, outcome and block list, maintained at ingest"""
+    __tablename__ = 'query_rollups_hourly'
+    __table_args__ = (
+        db.UniqueConstraint('hour', 'domain', 'client_ip', 'blocked', 'block_list_id', name='uq_query_rollups_hourly'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    hour = db.Column(db.DateTime, nullable=False)  # start of the hour
+    domain = db.Column(db.String(255), nullable=False)
+    client_ip = db.Column(db.String(45), nullable=False, default=ROLLUP_NO_CLIENT)
+    blocked = db.Column(db.Boolean, nullable=False, default=False)
+    block_list_id = db.Column(db.Integer, nullable=False, default=ROLLUP_NO_BLOCK_LIST)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<HourlyRollup {self.hour} {self.domain}>'
+
+class QuerySketch(db.Model):
+    """Serialized sketch of one hour or day of queries, see services.sketches"""
+    __tablename__ = 'query_sketches'
+    __table_args__ = (
+        db.UniqueConstraint('period', 'start', 'name', name='uq_query_sketches'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String(8), nullable=False)  # hour or day
+    start = db.Column(db.DateTime, nullable=False)  # start of the hour or day
+    name = db.Column(db.String(32), nullable=False)  # e.g. unique_domains or top_domains
+    data = db.Column(db.LargeBinary, nullable=False)
+    
+    def __repr__(self):
+        return f'<QuerySketch {self.period} {self.start} {self.name}>'
+
 class SummaryStat(db.Model):
     """Summary statistics model"""
     __tablename__ = 'summary_stats'
@@ -193,6 +277,16 @@ def init_database(app):
     db.init_app(app)
     
     with app.app_context():
+        # Tune every connection before the first one is opened
+        configure_sqlite(db.engine, app.config.get('SQLITE_PRAGMAS'))
+        
+        # Bring an existing database up to date before anything reads it
+        from .migrations import run_migrations
+        run_migrations()
+        
+        # Create the query_stats view first so create_all leaves it alone
+        init_query_partitions()
+        
         # Create tables
         db.create_all()
         
@@ -232,17 +326,409 @@ def clean_expired_entries():
     
     db.session.commit()
 
-def clean_old_stats(days_to_keep=90):
+def clean_old_stats(days_to_keep=90, query_days_to_keep=None):
     """Clean up old statistics entries"""
-    from datetime import timedelta
+    # Query stats go a whole day partition at a time
+    if query_days_to_keep is None:
+        query_days_to_keep = days_to_keep
+    drop_query_partitions(before=date.today() - timedelta(days=query_days_to_keep))
     
-    cutoff_date = datetime.utcnow() - timedelta(days=days_to_keep)
-    
-    # Clean old query stats
-    QueryStat.query.filter(QueryStat.timestamp < cutoff_date).delete()
-    
-    # Clean old summary stats
+    # Clean old summary stats, hourly rollups and sketches
     cutoff_summary_date = date.today() - timedelta(days=days_to_keep)
+    cutoff_hour = datetime.combine(cutoff_summary_date, datetime.min.time())
     SummaryStat.query.filter(SummaryStat.date < cutoff_summary_date).delete()
+    delete_hourly_rollups(before=cutoff_hour)
+    delete_query_sketches(before=cutoff_hour)
     
-    db.session.commit()
\ No newline at end of file
+    db.session.commit()
+
+def query_partition_name(day):
+    """Get the name of the query stats partition holding a date"""
+    return QUERY_PARTITION_PREFIX + day.strftime(QUERY_PARTITION_DATE_FORMAT)
+
+def query_partition_day(name):
+    """Get the date of a query stats partition name, or None for other tables"""
+    if not name.startswith(QUERY_PARTITION_PREFIX):
+        return None
+    try:
+        return datetime.strptime(name[len(QUERY_PARTITION_PREFIX):], QUERY_PARTITION_DATE_FORMAT).date()
+    except ValueError:
+        return None
+
+def _query_partition_table(name):
+    """Build the Table of a partition: QueryStat's columns without the foreign key"""
+    table = Table(name, MetaData(), *[
+        Column(column.name, column.type, primary_key=column.primary_key,
+               nullable=column.nullable, autoincrement=False)
+        for column in QueryStat.__table__.columns
+    ])
+    for columns in QUERY_PARTITION_INDEXES:
+        Index(f"{name}_{'_'.join(columns)}_idx", *[table.c[column] for column in columns])
+    return table
+
+def _query_stats_meta_table():
+    """Build the Table holding the global query stat id counter"""
+    return Table(
+        QUERY_STATS_META_TABLE, MetaData(),
+        Column('key', String(32), primary_key=True),
+        Column('value', Integer, nullable=False)
+    )
+
+def list_query_partitions():
+    """Get the existing query stats partitions as {date: table name}"""
+    partitions = {}
+    for name in inspect(db.session.connection()).get_table_names():
+        day = query_partition_day(name)
+        if day is not None:
+            partitions[day] = name
+    return dict(sorted(partitions.items()))
+
+def count_query_stats(blocked_only=False):
+    """Count stored queries one partition at a time, so each count is read from the partition's index"""
+    connection = db.session.connection()
+    condition = ' WHERE blocked = 1' if blocked_only else ''
+    return sum(
+        connection.execute(text(f"SELECT COUNT(*) FROM {name}{condition}")).scalar_one()
+        for name in list_query_partitions().values()
+    )
+
+def _rebuild_query_stats_view(partitions):
+    """Point the query_stats view at the given partitions"""
+    connection = db.session.connection()
+    columns = ', '.join(column.name for column in QueryStat.__table__.columns)
+    selects = ' UNION ALL '.join(f"SELECT {columns} FROM {name}" for name in partitions.values())
+    connection.execute(text(f"DROP VIEW IF EXISTS {QueryStat.__tablename__}"))
+    connection.execute(text(f"CREATE VIEW {QueryStat.__tablename__} AS {selects}"))
+
+def ensure_query_partitions(days):
+    """Create any missing partitions for the given dates within the current transaction"""
+    partitions = list_query_partitions()
+    missing = [day for day in set(days) if day not in partitions]
+    if not missing:
+        return
+    
+    connection = db.session.connection()
+    for day in missing:
+        name = query_partition_name(day)
+        _query_partition_table(name).create(connection, checkfirst=True)
+        partitions[day] = name
+    _rebuild_query_stats_view(dict(sorted(partitions.items())))
+
+def allocate_query_stat_ids(count):
+    """Reserve a block of ids that are unique across all partitions"""
+    connection = db.session.connection()
+    connection.execute(
+        text(f"UPDATE {QUERY_STATS_META_TABLE} SET value = value + :count WHERE key = 'next_id'"),
+        {'count': count}
+    )
+    next_id = connection.execute(
+        text(f"SELECT value FROM {QUERY_STATS_META_TABLE} WHERE key = 'next_id'")
+    ).scalar_one()
+    return range(next_id - count, next_id)
+
+def insert_query_stat_rows(rows):
+    """Insert QueryStat column dicts into their day partitions (caller commits)"""
+    if not rows:
+        return
+    
+    by_day = {}
+    for row in rows:
+        by_day.setdefault(row['timestamp'].date(), []).append(row)
+    ensure_query_partitions(by_day)
+    
+    ids = iter(allocate_query_stat_ids(len(rows)))
+    connection = db.session.connection()
+    for day, day_rows in by_day.items():
+        for row in day_rows:
+            row['id'] = next(ids)
+        connection.execute(_query_partition_table(query_partition_name(day)).insert(), day_rows)
+
+def drop_query_partitions(before=None, count_rows=False):
+    """
+    Drop whole query stats partitions, all of them or those for dates before `before`
+    
+    Dropping a table costs the same however many rows it holds, unlike a
+    DELETE, so retention never scans query rows. Returns the number of rows
+    dropped when count_rows is set, otherwise the number of partitions.
+    """
+    partitions = list_query_partitions()
+    doomed = {day: name for day, name in partitions.items() if before is None or day < before}
+    if not doomed:
+        return 0
+    
+    connection = db.session.connection()
+    dropped_rows = 0
+    if count_rows:
+        for name in doomed.values():
+            dropped_rows += connection.execute(text(f"SELECT COUNT(*) FROM {name}")).scalar_one()
+    
+    # The view always needs one partition to select from
+    remaining = {day: name for day, name in partitions.items() if day not in doomed}
+    if not remaining:
+        today = date.today()
+        remaining = {today: query_partition_name(today)}
+        doomed.pop(today, None)
+        if today not in partitions:
+            _query_partition_table(remaining[today]).create(connection)
+        else:
+            connection.execute(text(f"DELETE FROM {remaining[today]}"))
+    
+    _rebuild_query_stats_view(remaining)
+    for name in doomed.values():
+        connection.execute(text(f"DROP TABLE {name}"))
+    return dropped_rows if count_rows else len(doomed)
+
+def init_query_partitions():
+    """Set up the partitioned query_stats storage, migrating a plain query_stats table once"""
+    connection = db.session.connection()
+    meta_table = _query_stats_meta_table()
+    meta_table.create(connection, checkfirst=True)
+    
+    next_id = 1
+    if QueryStat.__tablename__ in inspect(connection).get_table_names():
+        next_id = _migrate_legacy_query_stats()
+    
+    connection.execute(
+        text(f"INSERT INTO {QUERY_STATS_META_TABLE} (key, value) "
+             f"SELECT 'next_id', :next_id WHERE NOT EXISTS "
+             f"(SELECT 1 FROM {QUERY_STATS_META_TABLE} WHERE key = 'next_id')"),
+        {'next_id': next_id}
+    )
+    
+    # Always have today's partition, so the view has something to select from
+    ensure_query_partitions([date.today()])
+    db.session.commit()
+
+def _migrate_legacy_query_stats():
+    """Move the rows of a plain query_stats table into day partitions; returns the next free id"""
+    connection = db.session.connection()
+    connection.execute(text(f"ALTER TABLE {QueryStat.__tablename__} RENAME TO {LEGACY_QUERY_STATS_TABLE}"))
+    legacy = Table(LEGACY_QUERY_STATS_TABLE, MetaData(), autoload_with=connection)
+    columns = [column.name for column in QueryStat.__table__.columns]
+    
+    days = sorted(
+        date.fromisoformat(str(day))
+        for (day,) in connection.execute(select(func.date(legacy.c.timestamp)).distinct())
+        if day is not None
+    )
+    ensure_query_partitions(days)
+    
+    for day in days:
+        start, end = day_bounds(day)
+        partition = _query_partition_table(query_partition_name(day))
+        connection.execute(partition.insert().from_select(
+            columns,
+            select(*[legacy.c[column] for column in columns]).where(
+                legacy.c.timestamp >= start,
+                legacy.c.timestamp < end
+            )
+        ))
+    
+    max_id = connection.execute(select(func.max(legacy.c.id))).scalar()
+    legacy.drop(connection)
+    return (max_id or 0) + 1
+
+def configure_sqlite(engine, pragmas):
+    """Apply the given PRAGMAs to every new connection of a SQLite engine"""
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+    
+    statements = [f"PRAGMA {name} = {value}" for name, value in pragmas.items()]
+    
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+    
+    # Connections opened before the hook existed would miss the pragmas
+    engine.dispose()
+
+def run_sqlite_maintenance(checkpoint_mode='TRUNCATE'):
+    """Checkpoint the WAL back into the database file and refresh planner statistics"""
+    engine = db.engine
+    if engine.dialect.name != 'sqlite':
+        return None
+    if checkpoint_mode not in SQLITE_CHECKPOINT_MODES:
+        raise ValueError(f"Unknown WAL checkpoint mode: {checkpoint_mode}")
+    
+    with engine.connect() as connection:
+        busy, wal_pages, checkpointed = connection.exec_driver_sql(
+            f"PRAGMA wal_checkpoint({checkpoint_mode})"
+        ).one()
+        connection.exec_driver_sql('PRAGMA optimize')
+    
+    if busy:
+        logger.warning(f"WAL checkpoint was blocked; {checkpointed} of {wal_pages} pages written back")
+    return {'busy': bool(busy), 'wal_pages': wal_pages, 'checkpointed_pages': checkpointed}
+
+def day_bounds(day):
+    """Get the [start, end) datetimes of a date"""
+    start = datetime.combine(day, datetime.min.time())
+    return start, start + timedelta(days=1)
+
+def add_summary_counts(day, total_queries, blocked_queries, unique_clients=None, top_blocked_domains=None):
+    """
+    Add a batch's counts to a day's summary row, creating it if needed
+    
+    Counters are incremented in SQL (total = total + ?), so the cost depends
+    on the batch only, not on how many queries the day already has.
+    """
+    table = SummaryStat.__table__
+    values = {
+        'total_queries': table.c.total_queries + total_queries,
+        'blocked_queries': table.c.blocked_queries + blocked_queries
+    }
+    if unique_clients is not None:
+        values['unique_clients'] = unique_clients
+    if top_blocked_domains is not None:
+        values['top_blocked_domains'] = json.dumps(top_blocked_domains)
+    
+    result = db.session.execute(table.update().where(table.c.date == day).values(**values))
+    if result.rowcount == 0:
+        db.session.execute(table.insert().values(
+            date=day,
+            total_queries=total_queries,
+            blocked_queries=blocked_queries,
+            unique_clients=unique_clients or 0,
+            top_blocked_domains=json.dumps(top_blocked_domains) if top_blocked_domains else None,
+            created_at=datetime.utcnow()
+        ))
+
+def hour_floor(timestamp):
+    """Get the start of the hour a datetime falls in"""
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+def time_bucket(column, unit, dialect=None):
+    """
+    SQL expression for the start of the minute, hour, day or week a DateTime
+    column falls in, for GROUP BY
+    
+    PostgreSQL uses date_trunc. SQLite has no equivalent, so the column is
+    turned into integer epoch seconds, rounded down to the bucket width and
+    formatted back into a datetime. Weeks start on Monday on both. `dialect`
+    defaults to the dialect of the session's bind.
+    """
+    if unit not in TIME_BUCKET_SECONDS:
+        raise ValueError(f"Unknown time bucket: {unit}")
+    if dialect is None:
+        dialect = db.session.get_bind().dialect.name
+    
+    if dialect == 'postgresql':
+        return func.date_trunc(unit, column, type_=DateTime)
+    
+    seconds = TIME_BUCKET_SECONDS[unit]
+    # DateTime is stored as 'YYYY-MM-DD HH:MM:SS.ffffff'; strftime would round
+    # the fraction (23:59:59.9999 into the next day), so cut it off first
+    epoch = cast(func.strftime('%s', func.substr(column, 1, 19)), Integer)
+    if unit == 'week':
+        bucket = (epoch - WEEK_EPOCH_OFFSET) // seconds * seconds + WEEK_EPOCH_OFFSET
+    else:
+        bucket = epoch // seconds * seconds
+    return func.datetime(bucket, 'unixepoch', type_=DateTime)
+
+def add_hourly_rollups(rows):
+    """
+    Add a batch of QueryStat column dicts to the hourly rollups (caller commits)
+    
+    The batch is counted per rollup key first, then upserted with
+    count = count + excluded.count, so each key costs one statement row.
+    """
+    counts = {}
+    for row in rows:
+        key = (
+            hour_floor(row['timestamp']),
+            row['domain'],
+            row['client_ip'] or ROLLUP_NO_CLIENT,
+            bool(row['blocked']),
+            row['block_list_id'] or ROLLUP_NO_BLOCK_LIST
+        )
+        counts[key] = counts.get(key, 0) + 1
+    if not counts:
+        return
+    
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as upsert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as upsert
+    
+    table = HourlyRollup.__table__
+    statement = upsert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=['hour', 'domain', 'client_ip', 'blocked', 'block_list_id'],
+        set_={'count': table.c.count + statement.excluded['count']}
+    )
+    db.session.execute(statement, [
+        {'hour': hour, 'domain': domain, 'client_ip': client_ip, 'blocked': blocked,
+         'block_list_id': block_list_id, 'count': count}
+        for (hour, domain, client_ip, blocked, block_list_id), count in counts.items()
+    ])
+
+def delete_query_sketches(before=None):
+    """Delete the sketches of hours and days starting before `before`, or all of them (caller commits)"""
+    query = QuerySketch.query
+    if before is not None:
+        query = query.filter(QuerySketch.start < before)
+    return query.delete()
+
+def delete_hourly_rollups(before=None):
+    """Delete the rollups of hours before `before`, or all of them (caller commits)"""
+    query = HourlyRollup.query
+    if before is not None:
+        query = query.filter(HourlyRollup.hour < before)
+    return query.delete()
+
+def get_day_clients(day):
+    """Get the distinct client IPs seen on a date"""
+    start, end = day_bounds(day)
+    rows = db.session.query(QueryStat.client_ip).filter(
+        QueryStat.timestamp >= start,
+        QueryStat.timestamp < end
+    ).distinct()
+    return {client_ip for (client_ip,) in rows}
+
+def get_day_blocked_counts(day):
+    """Get how often each domain was blocked on a date"""
+    start, end = day_bounds(day)
+    rows = db.session.query(
+        QueryStat.domain,
+        db.func.count(QueryStat.id)
+    ).filter(
+        QueryStat.timestamp >= start,
+        QueryStat.timestamp < end,
+        QueryStat.blocked == True
+    ).group_by(QueryStat.domain)
+    return dict(rows.all())
+
+def top_blocked_domains(blocked_counts, limit=TOP_BLOCKED_DOMAINS_LIMIT):
+    """Format the most blocked domains for SummaryStat.top_blocked_domains"""
+    ranked = heapq.nsmallest(limit, blocked_counts.items(), key=lambda item: (-item[1], item[0]))
+    return [{'domain': domain, 'count': count} for domain, count in ranked]
+
+def reconcile_summary_stats(day=None):
+    """Recompute a day's summary from query_stats, correcting any drift in the incremental counters"""
+    day = day or date.today()
+    start, end = day_bounds(day)
+    
+    day_queries = QueryStat.query.filter(QueryStat.timestamp >= start, QueryStat.timestamp < end)
+    total_queries = day_queries.count()
+    blocked_queries = day_queries.filter(QueryStat.blocked == True).count()
+    
+    summary = SummaryStat.query.filter_by(date=day).first()
+    if not summary:
+        if total_queries == 0:
+            return None
+        summary = SummaryStat(date=day)
+        db.session.add(summary)
+    
+    summary.total_queries = total_queries
+    summary.blocked_queries = blocked_queries
+    summary.unique_clients = len(get_day_clients(day))
+    summary.set_top_blocked_domains(top_blocked_domains(get_day_blocked_counts(day)))
+    
+    db.session.commit()
+    return summary
@@ -0,0 +1,121 @@
+"""
+Schema migrations for PiDNS Ad-Blocker
+Versioned upgrades for existing databases; create_all only adds missing tables
+"""
+
+import logging
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+
+# Relative, so this shares the database module (and its db) app.py imported as models.database
+from .database import BlockList, HourlyRollup, QueryStat, db
+from .database import add_hourly_rollups, list_query_partitions, _query_partition_table
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION_TABLE = 'schema_version'
+
+# Query stat rows read per batch when backfilling
+BACKFILL_BATCH_SIZE = 10000
+
+
+def _schema_version_table():
+    """Build the Table recording applied migrations"""
+    return Table(
+        SCHEMA_VERSION_TABLE, MetaData(),
+        Column('version', Integer, primary_key=True),
+        Column('description', String(255), nullable=False),
+        Column('applied_at', DateTime, nullable=False)
+    )
+
+
+def _add_missing_columns(model, column_names):
+    """ALTER TABLE ADD COLUMN for model columns an existing table lacks"""
+    connection = db.session.connection()
+    table_name = model.__tablename__
+    inspector = inspect(connection)
+    if table_name not in inspector.get_table_names():
+        return
+
+    existing = {column['name'] for column in inspector.get_columns(table_name)}
+    for name in column_names:
+        if name in existing:
+            continue
+        column_type = model.__table__.c[name].type.compile(dialect=connection.dialect)
+        connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {name} {column_type}"))
+        logger.info(f"Added column {table_name}.{name}")
+
+
+def _add_refresh_and_outcome_columns():
+    """Columns added to models after their tables were first created"""
+    _add_missing_columns(BlockList, ('content_hash', 'etag', 'last_modified'))
+    # Still a plain table until init_query_partitions moves it into partitions
+    _add_missing_columns(QueryStat, ('outcome', 'upstream', 'response_ms'))
+
+
+def _add_composite_partition_indexes():
+    """Replace the single timestamp index of existing partitions with QUERY_PARTITION_INDEXES"""
+    connection = db.session.connection()
+    for name in list_query_partitions().values():
+        connection.execute(text(f"DROP INDEX IF EXISTS {name}_timestamp_idx"))
+        for index in _query_partition_table(name).indexes:
+            index.create(connection, checkfirst=True)
+
+
+def _backfill_hourly_rollups():
+    """Create the hourly rollups and count the query stats already stored into them"""
+    connection = db.session.connection()
+    HourlyRollup.__table__.create(connection, checkfirst=True)
+
+    inspector = inspect(connection)
+    if QueryStat.__tablename__ not in inspector.get_table_names() + inspector.get_view_names():
+        return
+
+    columns = [QueryStat.timestamp, QueryStat.domain, QueryStat.client_ip, QueryStat.blocked, QueryStat.block_list_id]
+    result = db.session.execute(select(*columns).execution_options(yield_per=BACKFILL_BATCH_SIZE))
+    for rows in result.partitions():
+        add_hourly_rollups([row._asdict() for row in rows])
+
+
+# (version, description, upgrade function), applied in order exactly once
+MIGRATIONS = [
+    (1, 'Add block list refresh and query outcome columns', _add_refresh_and_outcome_columns),
+    (2, 'Composite (timestamp, blocked) index on query stat partitions', _add_composite_partition_indexes),
+    (3, 'Hourly query rollups', _backfill_hourly_rollups),
+]
+
+
+def get_schema_version():
+    """Get the highest applied migration version, 0 for a database without any"""
+    connection = db.session.connection()
+    table = _schema_version_table()
+    table.create(connection, checkfirst=True)
+    return connection.execute(select(db.func.max(table.c.version))).scalar() or 0
+
+
+def run_migrations():
+    """Apply pending migrations, each in its own transaction"""
+    current = get_schema_version()
+    db.session.commit()
+
+    table = _schema_version_table()
+    applied = []
+    for version, description, upgrade in MIGRATIONS:
+        if version <= current:
+            continue
+        try:
+            upgrade()
+            db.session.connection().execute(table.insert().values(
+                version=version,
+                description=description,
+                applied_at=datetime.utcnow()
+            ))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Failed to apply schema migration {version}: {e}")
+            raise
+        logger.info(f"Applied schema migration {version}: {description}")
+        applied.append(version)
+    return applied
@@ -0,0 +1,233 @@
+"""
+Block list fetcher for PiDNS Ad-Blocker
+Downloads block lists concurrently over a pooled HTTP session
+"""
+
+import hashlib
+import itertools
+import logging
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from adblocker.services.blocklist_parser import iter_domains
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = 'PiDNS-AdBlocker/1.0'
+STREAM_CHUNK_SIZE = 64 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+class BlockListFetcher:
+    """
+    Fetches block lists and writes their raw file and parsed-domain artifact.
+
+    The fetcher never touches the database: callers pass plain job dicts
+    (id, name, url, content_hash, entry_count, etag, last_modified) and get
+    plain result dicts back, so downloads can run on worker threads while
+    all DB writes stay with the caller.
+
+    Refreshes are conditional: when the cached artifact for the job's
+    content hash exists, If-None-Match / If-Modified-Since are sent and a
+    304 (or a body with an identical hash) is reported as changed=False.
+    """
+
+    def __init__(self, blocklists_dir, domain_cache, max_workers=4, per_host_limit=2, timeout=30,
+                 max_bytes=None):
+        self.blocklists_dir = Path(blocklists_dir)
+        self.domain_cache = domain_cache
+        self.max_workers = max(1, max_workers)
+        self.per_host_limit = max(1, per_host_limit)
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+
+        # One keep-alive connection pool shared by all worker threads
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._host_slots = {}
+        self._host_slots_lock = threading.Lock()
+
+    def close(self):
+        """Close the pooled HTTP session"""
+        self.session.close()
+
+    def _host_slot(self, url):
+        """Get the semaphore limiting concurrent requests to a URL's host"""
+        host = urlparse(url).netloc.lower()
+        with self._host_slots_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self._host_slots[host]
+
+    def _conditional_headers(self, job):
+        """Build validator headers for a job whose current content is cached"""
+        headers = {}
+        raw_file = self.blocklists_dir / f"blocklist_{job['id']}.txt"
+        if not raw_file.exists() or not self.domain_cache.has(job['id'], job.get('content_hash')):
+            return headers
+
+        if job.get('etag'):
+            headers['If-None-Match'] = job['etag']
+        if job.get('last_modified'):
+            headers['If-Modified-Since'] = job['last_modified']
+        return headers
+
+    def _check_size(self, size, job):
+        """Abort a download that has grown past the configured cap"""
+        if self.max_bytes and size > self.max_bytes:
+            raise ValueError(f"Block list {job['name']} exceeds the {self.max_bytes} byte size limit")
+
+    def _iter_body(self, response, job):
+        """
+        Yield the decoded response body in chunks.
+
+        Content-Encoding is decoded by requests itself; a body that is a gzip
+        file in its own right (e.g. a .gz list) is inflated incrementally,
+        never producing more than one chunk of output per step.
+        """
+        chunks = response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+        first = next(chunks, b'')
+
+        if first[:2] != GZIP_MAGIC:
+            if first:
+                yield first
+            yield from chunks
+            return
+
+        logger.debug(f"Inflating gzip body for {job['name']}")
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        for chunk in itertools.chain([first], chunks):
+            data = chunk
+            while data:
+                output = decoder.decompress(data, STREAM_CHUNK_SIZE)
+                if output:
+                    yield output
+                data = decoder.unconsumed_tail
+        tail = decoder.flush()
+        if tail:
+            yield tail
+
+    def _iter_lines(self, chunks, sink):
+        """Split body chunks into lines, handing every chunk to sink first"""
+        pending = b''
+        for chunk in chunks:
+            sink(chunk)
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            yield from lines
+        if pending:
+            yield pending
+
+    def fetch(self, job):
+        """
+        Download and cache a single block list, returning a result dict.
+
+        The body is streamed: each chunk is written to a temporary raw file,
+        hashed and parsed in the same pass, so peak memory does not grow with
+        the size of the list. The raw file and artifact are moved into place
+        atomically only when the content actually changed.
+        """
+        result = {
+            'id': job['id'],
+            'name': job['name'],
+            'success': False,
+            'changed': False,
+            'not_modified': False,
+            'content_hash': job.get('content_hash'),
+            'entry_count': job.get('entry_count') or 0,
+            'etag': job.get('etag'),
+            'last_modified': job.get('last_modified'),
+            'bytes': 0,
+            'elapsed': 0.0,
+            'error': None
+        }
+        start = time.monotonic()
+
+        file_path = self.blocklists_dir / f"blocklist_{job['id']}.txt"
+        tmp_path = file_path.with_name(file_path.name + '.tmp')
+        pending_path = None
+
+        try:
+            with self._host_slot(job['url']):
+                logger.info(f"Downloading block list: {job['name']}")
+                response = self.session.get(
+                    job['url'],
+                    timeout=self.timeout,
+                    headers=self._conditional_headers(job),
+                    stream=True
+                )
+
+                with response:
+                    if response.status_code == 304:
+                        logger.info(f"Block list {job['name']} not modified upstream")
+                        result['not_modified'] = True
+                        result['success'] = True
+                        result['elapsed'] = round(time.monotonic() - start, 3)
+                        return result
+
+                    response.raise_for_status()
+                    self._check_size(int(response.headers.get('Content-Length') or 0), job)
+
+                    digest = hashlib.sha256()
+                    with open(tmp_path, 'wb') as raw_file:
+                        def sink(chunk):
+                            result['bytes'] += len(chunk)
+                            self._check_size(result['bytes'], job)
+                            digest.update(chunk)
+                            raw_file.write(chunk)
+
+                        lines = self._iter_lines(self._iter_body(response, job), sink)
+                        pending_path, entry_count = self.domain_cache.write_pending(
+                            job['id'], iter_domains(lines)
+                        )
+
+            result['etag'] = response.headers.get('ETag')
+            result['last_modified'] = response.headers.get('Last-Modified')
+
+            # An identical body needs no replacement, combine or reload
+            content_hash = digest.hexdigest()
+            if content_hash == job.get('content_hash') and self.domain_cache.has(job['id'], content_hash):
+                logger.info(f"Block list {job['name']} content unchanged")
+                self.domain_cache.discard(pending_path)
+                tmp_path.unlink()
+                result['success'] = True
+                result['elapsed'] = round(time.monotonic() - start, 3)
+                return result
+
+            os.replace(tmp_path, file_path)
+            self.domain_cache.publish(pending_path, job['id'], content_hash)
+
+            result['entry_count'] = entry_count
+            result['content_hash'] = content_hash
+            result['changed'] = True
+            result['success'] = True
+
+        except Exception as e:
+            if pending_path is not None:
+                self.domain_cache.discard(pending_path)
+            tmp_path.unlink(missing_ok=True)
+            result['error'] = str(e)
+            logger.error(f"Failed to download block list {job['name']}: {e}")
+
+        result['elapsed'] = round(time.monotonic() - start, 3)
+        return result
+
+    def fetch_all(self, jobs):
+        """Download several block lists concurrently and return their results in job order"""
+        if not jobs:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(jobs))) as executor:
+            return list(executor.map(self.fetch, jobs))
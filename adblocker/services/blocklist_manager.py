@@ -4,178 +4,234 @@ Handles downloading, processing, and updating of block lists
 """
 
 import os
-import re
-import requests
+import time
 import logging
 from pathlib import Path
 from datetime import datetime, timedelta
 from urllib.parse import urlparse
-import gzip
 
-from adblocker.models.database import BlockList, db
+from adblocker.models.database import BlockList, Whitelist, db
 from adblocker.services.dnsmasq_manager import DnsmasqManager
+from adblocker.services.blocklist_parser import iter_domains, iter_file_domains, is_valid_domain
+from adblocker.services.domain_cache import DomainCache, hash_file
+from adblocker.services.domain_index import DomainIndex
+from adblocker.services.blocklist_fetcher import BlockListFetcher
+from adblocker.services.reload_coordinator import request_reload, BLOCKLISTS
 
 logger = logging.getLogger(__name__)
 
 class BlockListManager:
     """Manages block lists for ad-blocking"""
     
-    def __init__(self, config):
+    def __init__(self, config, dnsmasq_manager=None):
         self.config = config
         self.blocklists_dir = Path(config.BLOCKLISTS_DIR)
         self.blocklists_dir.mkdir(parents=True, exist_ok=True)
-        self.dnsmasq_manager = DnsmasqManager(config)
+        # Share the caller's manager so its pending-reload flag sees our writes
+        self.dnsmasq_manager = dnsmasq_manager or DnsmasqManager(config)
+        self.domain_cache = DomainCache(self.blocklists_dir)
+        self.domain_index = DomainIndex(config.DOMAIN_INDEX_FILE, self.domain_cache)
+        self.fetcher = BlockListFetcher(
+            self.blocklists_dir,
+            self.domain_cache,
+            max_workers=config.BLOCKLIST_DOWNLOAD_WORKERS,
+            per_host_limit=config.BLOCKLIST_DOWNLOAD_PER_HOST,
+            timeout=config.BLOCKLIST_DOWNLOAD_TIMEOUT,
+            max_bytes=config.BLOCKLIST_MAX_BYTES
+        )
+    
+    def close(self):
+        """Close the fetcher's HTTP session and the domain index connection"""
+        self.fetcher.close()
+        self.domain_index.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def _fetch_job(self, blocklist):
+        """Build a database-free fetch job for a block list"""
+        return {
+            'id': blocklist.id,
+            'name': blocklist.name,
+            'url': blocklist.url,
+            'content_hash': blocklist.content_hash,
+            'entry_count': blocklist.entry_count,
+            'etag': blocklist.etag,
+            'last_modified': blocklist.last_modified
+        }
+    
+    def _apply_fetch_result(self, blocklist, result):
+        """Record a successful fetch on its block list (caller commits)"""
+        if not result['success']:
+            return False
         
-        # Domain patterns for different file formats
-        self.domain_patterns = [
-            # Standard hosts file format
-            r'^0\.0\.0\.0\s+([^\s]+)',
-            r'^127\.0\.0\.1\s+([^\s]+)',
-            r'^::\s+([^\s]+)',
-            # Plain domain lists
-            r'^([a-zA-Z0-9.-]+\.[a-zA-Z]{2,})\s*$',
-            # AdBlock format (||domain.com^)
-            r'^\|\|([a-zA-Z0-9.-]+\.[a-zA-Z]{2,})\^',
-            # Other common formats
-            r'^([^\s]+\.[a-zA-Z]{2,})\s+',
-        ]
+        blocklist.last_updated = datetime.utcnow()
+        blocklist.entry_count = result['entry_count']
+        blocklist.content_hash = result['content_hash']
+        blocklist.etag = result['etag']
+        blocklist.last_modified = result['last_modified']
+        
+        if result['changed']:
+            logger.info(f"Downloaded block list {blocklist.name} with {result['entry_count']} domains")
+        return True
     
-    def download_blocklist(self, blocklist_id):
-        """Download a specific block list"""
+    def _download_blocklist(self, blocklist_id):
+        """Download a specific block list and return the fetch result, or None on failure"""
         blocklist = BlockList.query.get(blocklist_id)
         if not blocklist or not blocklist.url:
             logger.error(f"Block list {blocklist_id} not found or no URL")
-            return False
+            return None
         
         try:
-            logger.info(f"Downloading block list: {blocklist.name}")
-            
-            # Download the block list
-            response = requests.get(
-                blocklist.url,
-                timeout=30,
-                headers={'User-Agent': 'PiDNS-AdBlocker/1.0'}
-            )
-            response.raise_for_status()
-            
-            # Check if content is gzipped
-            content = response.content
-            if response.headers.get('content-encoding') == 'gzip':
-                try:
-                    content = gzip.decompress(content)
-                except:
-                    logger.warning(f"Failed to decompress gzipped content for {blocklist.name}")
-            
-            # Save to file
-            file_path = self.blocklists_dir / f"blocklist_{blocklist_id}.txt"
-            with open(file_path, 'wb') as f:
-                f.write(content)
+            result = self.fetcher.fetch(self._fetch_job(blocklist))
+            if not self._apply_fetch_result(blocklist, result):
+                return None
             
-            # Parse and count domains
-            domains = self.parse_blocklist_content(content.decode('utf-8', errors='ignore'))
-            
-            # Update block list info
-            blocklist.last_updated = datetime.utcnow()
-            blocklist.entry_count = len(domains)
             db.session.commit()
-            
-            logger.info(f"Downloaded block list {blocklist.name} with {len(domains)} domains")
-            return True
+            return result
             
         except Exception as e:
             logger.error(f"Failed to download block list {blocklist.name}: {e}")
-            return False
+            db.session.rollback()
+            return None
+    
+    def download_blocklist(self, blocklist_id):
+        """Download a specific block list"""
+        return self._download_blocklist(blocklist_id) is not None
     
     def parse_blocklist_content(self, content):
         """Parse block list content and extract domains"""
-        domains = set()
-        
-        for line in content.splitlines():
-            line = line.strip()
-            
-            # Skip comments and empty lines
-            if not line or line.startswith('#') or line.startswith('!'):
-                continue
-            
-            # Try to extract domain using various patterns
-            for pattern in self.domain_patterns:
-                match = re.search(pattern, line)
-                if match:
-                    domain = match.group(1).lower().strip()
-                    
-                    # Validate domain
-                    if self.is_valid_domain(domain):
-                        domains.add(domain)
-                    break
-        
-        return list(domains)
+        if isinstance(content, (str, bytes)):
+            content = content.splitlines()
+        return list(set(iter_domains(content)))
     
     def is_valid_domain(self, domain):
         """Check if a domain is valid"""
-        if not domain or len(domain) < 4:
-            return False
-        
-        # Skip localhost and local domains
-        if domain.endswith('.local') or domain.endswith('.localhost'):
-            return False
-        
-        # Skip IP addresses
-        if re.match(r'^\d+\.\d+\.\d+\.\d+$', domain):
-            return False
+        return is_valid_domain(domain.lower() if domain else domain)
+    
+    def ensure_domain_cache(self, blocklist):
+        """Make sure a block list has a parsed-domain artifact, building it from the raw file if needed"""
+        if self.domain_cache.has(blocklist.id, blocklist.content_hash):
+            return True
         
-        # Basic domain validation
-        if not re.match(r'^[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$', domain):
+        file_path = self.blocklists_dir / f"blocklist_{blocklist.id}.txt"
+        if not file_path.exists():
             return False
         
-        # Skip domains with too many subdomains
-        if domain.count('.') > 5:
-            return False
+        # Raw file predates the cache (or the artifact was removed): parse it once
+        content_hash = hash_file(file_path)
+        if not self.domain_cache.has(blocklist.id, content_hash):
+            self.domain_cache.write(blocklist.id, content_hash, iter_file_domains(file_path))
         
+        blocklist.content_hash = content_hash
+        db.session.commit()
         return True
     
     def update_all_blocklists(self):
-        """Update all enabled block lists"""
-        enabled_blocklists = BlockList.query.filter_by(enabled=True).all()
-        updated_count = 0
+        """
+        Update all enabled block lists
         
-        for blocklist in enabled_blocklists:
-            if self.download_blocklist(blocklist.id):
+        Downloads run concurrently; the database update, combined config
+        generation and dnsmasq reload each happen once after all fetches finish,
+        and are skipped entirely when no list changed upstream.
+        Returns an aggregated report of the run.
+        """
+        start = time.monotonic()
+        enabled_blocklists = [bl for bl in BlockList.query.filter_by(enabled=True).all() if bl.url]
+        
+        results = self.fetcher.fetch_all([self._fetch_job(bl) for bl in enabled_blocklists])
+        
+        updated_count = 0
+        changed_count = 0
+        for blocklist, result in zip(enabled_blocklists, results):
+            if self._apply_fetch_result(blocklist, result):
                 updated_count += 1
+                if result['changed']:
+                    changed_count += 1
+        db.session.commit()
         
-        # Generate combined configuration
-        self.generate_combined_config()
+        if changed_count:
+            # Regenerate the combined configuration and reload dnsmasq
+            self.apply_config_changes()
+        else:
+            logger.info("No block list changed upstream, skipping config generation and reload")
         
-        # Reload dnsmasq
-        self.dnsmasq_manager.reload_dnsmasq()
+        report = {
+            'total': len(results),
+            'updated_count': updated_count,
+            'changed_count': changed_count,
+            'unchanged_count': updated_count - changed_count,
+            'failed_count': len(results) - updated_count,
+            'duration_seconds': round(time.monotonic() - start, 3),
+            'results': results
+        }
         
-        logger.info(f"Updated {updated_count} block lists")
-        return updated_count
+        logger.info(f"Updated {updated_count} of {len(results)} block lists in {report['duration_seconds']}s")
+        return report
     
-    def generate_combined_config(self):
-        """Generate combined block list configuration"""
+    def generate_combined_config(self, force=False):
+        """
+        Generate combined block list configuration
+        
+        The output is only rewritten when the effective domain set changed,
+        unless force is set (e.g. after whitelist changes affect collapsing).
+        """
         try:
-            # Get all domains from enabled block lists
-            all_domains = set()
+            # Work out which parsed-domain artifacts should be counted
+            desired_lists = {}
             
             enabled_blocklists = BlockList.query.filter_by(enabled=True).all()
             for blocklist in enabled_blocklists:
-                file_path = self.blocklists_dir / f"blocklist_{blocklist.id}.txt"
-                if file_path.exists():
-                    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                        content = f.read()
-                        domains = self.parse_blocklist_content(content)
-                        all_domains.update(domains)
-            
-            # Generate dnsmasq configuration
-            self.dnsmasq_manager.generate_adblock_config(list(all_domains))
-            
-            logger.info(f"Generated combined config with {len(all_domains)} domains")
+                if self.ensure_domain_cache(blocklist):
+                    desired_lists[blocklist.id] = blocklist.content_hash
+            
+            # Apply only the per-list deltas to the reference-counted index
+            changed = self.domain_index.sync(desired_lists)
+            
+            # Artifacts for superseded content are no longer referenced by the index
+            self.prune_domain_cache()
+            
+            # Generate dnsmasq configuration only when the effective set changed
+            domain_count = self.domain_index.count()
+            if changed or force or not self.dnsmasq_manager.adblock_output_exists():
+                whitelist_domains = [entry.domain for entry in Whitelist.query.all() if not entry.is_expired()]
+                self.dnsmasq_manager.generate_adblock_config(
+                    self.domain_index.iter_domains(),
+                    presorted=True,
+                    whitelist_domains=whitelist_domains
+                )
+                logger.info(f"Generated combined config with {domain_count} domains")
+            else:
+                logger.info(f"Combined config unchanged ({domain_count} domains)")
             return True
             
         except Exception as e:
             logger.error(f"Failed to generate combined config: {e}")
             return False
     
+    def prune_domain_cache(self):
+        """Remove parsed-domain artifacts that no longer match a block list's current content"""
+        blocklist_ids = set()
+        for blocklist in BlockList.query.all():
+            blocklist_ids.add(str(blocklist.id))
+            self.domain_cache.remove(blocklist.id, keep_hash=blocklist.content_hash)
+        
+        # Lists deleted since the last sync are no longer counted by the index
+        for blocklist_id in self.domain_cache.cached_ids() - blocklist_ids:
+            self.domain_cache.remove(blocklist_id)
+    
+    def apply_config_changes(self):
+        """Regenerate the combined configuration and reload dnsmasq if it changed"""
+        # Let the reload coordinator batch this with other changes when running
+        if request_reload(BLOCKLISTS):
+            return True
+        
+        self.generate_combined_config()
+        return self.dnsmasq_manager.reload_if_needed()
+    
     def get_blocklist_status(self, blocklist_id):
         """Get status of a specific block list"""
         blocklist = BlockList.query.get(blocklist_id)
@@ -233,8 +289,7 @@ class BlockListManager:
             
             # Download the block list
             if self.download_blocklist(blocklist.id):
-                self.generate_combined_config()
-                self.dnsmasq_manager.reload_dnsmasq()
+                self.apply_config_changes()
                 return True, "Block list added successfully"
             else:
                 return False, "Failed to download block list"
@@ -266,9 +321,9 @@ class BlockListManager:
             db.session.delete(blocklist)
             db.session.commit()
             
-            # Regenerate configuration
-            self.generate_combined_config()
-            self.dnsmasq_manager.reload_dnsmasq()
+            # Regenerate configuration; the removed list's parsed domains are
+            # pruned once the domain index no longer counts them
+            self.apply_config_changes()
             
             return True, "Block list removed successfully"
             
@@ -287,8 +342,7 @@ class BlockListManager:
             db.session.commit()
             
             # Regenerate configuration
-            self.generate_combined_config()
-            self.dnsmasq_manager.reload_dnsmasq()
+            self.apply_config_changes()
             
             status = "enabled" if blocklist.enabled else "disabled"
             return True, f"Block list {status} successfully"
@@ -300,12 +354,15 @@ class BlockListManager:
     def update_blocklist(self, blocklist_id):
         """Update a specific block list"""
         try:
-            if self.download_blocklist(blocklist_id):
-                self.generate_combined_config()
-                self.dnsmasq_manager.reload_dnsmasq()
-                return True, "Block list updated successfully"
-            else:
+            result = self._download_blocklist(blocklist_id)
+            if result is None:
                 return False, "Failed to update block list"
+            
+            if not result['changed']:
+                return True, "Block list is already up to date"
+            
+            self.apply_config_changes()
+            return True, "Block list updated successfully"
                 
         except Exception as e:
             logger.error(f"Failed to update block list: {e}")
@@ -365,6 +422,11 @@ class BlockListManager:
                     file_path.unlink()
                     logger.info(f"Removed old block list file: {file_path}")
             
+            # Remove parsed-domain artifacts for non-existent block lists
+            for blocklist_id in self.domain_cache.cached_ids() - blocklist_ids:
+                self.domain_cache.remove(blocklist_id)
+                logger.info(f"Removed old domain cache for block list {blocklist_id}")
+            
             return True
             
         except Exception as e:
@@ -378,9 +440,10 @@ def schedule_blocklist_updates(app):
     def update_job():
         with app.app_context():
             try:
-                manager = BlockListManager(app.config)
-                manager.update_all_blocklists()
-                logger.info("Scheduled block list update completed")
+                with BlockListManager(app.config) as manager:
+                    report = manager.update_all_blocklists()
+                logger.info(f"Scheduled block list update completed: {report['updated_count']} updated, "
+                            f"{report['failed_count']} failed")
             except Exception as e:
                 logger.error(f"Scheduled block list update failed: {e}")
     
@@ -0,0 +1,85 @@
+"""
+Block list parser for PiDNS Ad-Blocker
+Streams block list files line by line and yields normalized domains
+"""
+
+import re
+
+# One precompiled alternation covering every supported line format:
+#   0.0.0.0 / 127.0.0.1 / :: hosts entries, AdBlock (||domain.com^) rules
+#   and plain domain lists (optionally followed by more columns)
+DOMAIN_LINE_REGEX = re.compile(
+    r'(?:0\.0\.0\.0|127\.0\.0\.1|::)\s+(?P<host>\S+)'
+    r'|\|\|(?P<adblock>[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})\^'
+    r'|(?P<plain>\S+\.[a-zA-Z]{2,})(?:\s|$)'
+)
+
+# Domains are lowercased before validation, so the character class can
+# stay lowercase. An alphabetic TLD also rules out bare IPv4 addresses.
+VALID_DOMAIN_REGEX = re.compile(r'[a-z0-9.-]+\.[a-z]{2,}')
+
+COMMENT_PREFIXES = ('#', '!')
+LOCAL_SUFFIXES = ('.local', '.localhost')
+
+
+def is_valid_domain(domain):
+    """Check if a normalized (lowercase) domain is valid"""
+    if not domain or len(domain) < 4:
+        return False
+
+    # Skip localhost and local domains
+    if domain.endswith(LOCAL_SUFFIXES):
+        return False
+
+    # Basic domain validation
+    if not VALID_DOMAIN_REGEX.fullmatch(domain):
+        return False
+
+    # Skip domains with too many subdomains
+    if domain.count('.') > 5:
+        return False
+
+    return True
+
+
+def iter_domains(lines):
+    """
+    Yield normalized domains from an iterable of lines.
+
+    Lines may be ``str`` or ``bytes`` (bytes are decoded as UTF-8, ignoring
+    errors), so a file object, a response line iterator or a list of
+    strings can all be passed in. Domains are yielded lazily and may repeat;
+    callers that need a unique set deduplicate themselves.
+    """
+    match_line = DOMAIN_LINE_REGEX.match
+    valid_domain = VALID_DOMAIN_REGEX.fullmatch
+
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='ignore')
+
+        line = line.strip()
+
+        # Skip comments and empty lines
+        if not line or line.startswith(COMMENT_PREFIXES):
+            continue
+
+        match = match_line(line)
+        if not match:
+            continue
+
+        domain = (match.group('host') or match.group('adblock') or match.group('plain')).lower()
+
+        # Inline the cheap checks of is_valid_domain for the hot loop
+        if len(domain) < 4 or domain.endswith(LOCAL_SUFFIXES):
+            continue
+        if domain.count('.') > 5 or not valid_domain(domain):
+            continue
+
+        yield domain
+
+
+def iter_file_domains(file_path):
+    """Yield normalized domains from a block list file on disk"""
+    with open(file_path, 'rb') as f:
+        yield from iter_domains(f)
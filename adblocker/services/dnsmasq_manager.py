@@ -4,6 +4,7 @@ Handles generation and management of dnsmasq configuration files
 """
 
 import os
+import hashlib
 import subprocess
 import logging
 from pathlib import Path
@@ -11,6 +12,72 @@ from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+# Joins reversed labels; sorts below every character allowed in a domain, so
+# all subdomains of a domain directly follow it in reversed-label order
+LABEL_SEPARATOR = ' '
+
+# Generated config files are written in chunks of roughly this many characters
+CONFIG_WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Header line recording the SHA-256 of a generated file's body
+CONFIG_DIGEST_PREFIX = '# Content digest: sha256:'
+CONFIG_HEADER_LINES = 3
+
+# Kept in DNSMASQ_CONFIG_DIR from the moment a generated file changes until
+# dnsmasq reloads successfully, so a failed reload or a restart in between is
+# not forgotten; dnsmasq skips dot files in its conf-dir
+RELOAD_PENDING_MARKER = '.reload-pending'
+
+# Per-domain line templates for adblock.conf
+ADBLOCK_LINE_FORMATS = {
+    # Explicit sinkhole answers for both address families
+    'address': "address=/{domain}/0.0.0.0\naddress=/{domain}/::\n",
+    # Single line answering 0.0.0.0 / :: (NULL) for both families
+    'address-null': "address=/{domain}/#\n",
+    # Single line answering NXDOMAIN
+    'address-nxdomain': "address=/{domain}/\n",
+    # Local-only domain: NXDOMAIN, never forwarded upstream
+    'local': "local=/{domain}/\n",
+}
+
+# Hosts-file backend: adblock.conf only points dnsmasq at ADBLOCK_HOSTS_FILE
+ADBLOCK_HOSTS_FORMAT = 'hosts'
+HOSTS_LINE_FORMAT = "0.0.0.0 {domain}\n:: {domain}\n"
+ADBLOCK_OUTPUT_FORMATS = tuple(ADBLOCK_LINE_FORMATS) + (ADBLOCK_HOSTS_FORMAT,)
+
+def reversed_label_key(domain):
+    """Sort key placing every subdomain directly after its parent domain"""
+    return LABEL_SEPARATOR.join(reversed(domain.split('.')))
+
+def domains_with_parents(domains):
+    """Get the given domains together with every parent domain of them"""
+    result = set()
+    for domain in domains:
+        labels = domain.split('.')
+        for i in range(len(labels)):
+            result.add('.'.join(labels[i:]))
+    return result
+
+def collapse_subdomains(domains, protected=frozenset()):
+    """
+    Drop domains already covered by a blocked parent domain.
+    
+    dnsmasq address=/example.com/ also matches every subdomain, so listing
+    ads.example.com next to it is redundant. domains must be unique and in
+    reversed_label_key order; walking them in that order is a depth-first
+    walk of the reversed-label trie, so a single "current cover" prefix is
+    enough. Domains in protected (whitelisted domains and their parents)
+    never cover their subdomains, keeping the whitelist exceptions intact.
+    """
+    cover = None
+    for domain in domains:
+        key = reversed_label_key(domain)
+        if cover is not None and key.startswith(cover):
+            continue
+        
+        yield domain
+        cover = None if domain in protected else key + LABEL_SEPARATOR
+
 class DnsmasqManager:
     """Manages dnsmasq configuration for ad-blocking"""
     
@@ -18,54 +85,226 @@ class DnsmasqManager:
         self.config = config
         self.config_dir = Path(config.DNSMASQ_CONFIG_DIR)
         self.adblock_config = Path(config.ADBLOCK_CONFIG_FILE)
+        self.adblock_hosts = Path(config.ADBLOCK_HOSTS_FILE)
         self.whitelist_config = Path(config.WHITELIST_CONFIG_FILE)
         self.blacklist_config = Path(config.BLACKLIST_CONFIG_FILE)
         self.service_name = config.DNSMASQ_SERVICE
+        self.output_format = config.ADBLOCK_OUTPUT_FORMAT
+        self.collapse_subdomains = config.ADBLOCK_COLLAPSE_SUBDOMAINS
+        self.reload_marker = self.config_dir / RELOAD_PENDING_MARKER
         
         # Ensure config directory exists
         self.config_dir.mkdir(parents=True, exist_ok=True)
     
-    def generate_adblock_config(self, blocked_domains):
-        """Generate dnsmasq configuration for blocked domains"""
+    @property
+    def reload_needed(self):
+        """Whether a generated config file changed since dnsmasq last reloaded successfully"""
+        return self.reload_marker.exists()
+    
+    @property
+    def blocklist_uses_whitelist(self):
+        """Whether the generated block list has to be rebuilt when the whitelist changes"""
+        # The hosts backend leaves whitelisted domains out, collapsing keeps blocked subdomains below them
+        return self.output_format == ADBLOCK_HOSTS_FORMAT or self.collapse_subdomains
+    
+    def _mark_reload_pending(self):
+        """Durably record that dnsmasq has to be reloaded"""
+        if self.reload_marker.exists():
+            return
+        
+        self.reload_marker.touch()
+        dir_fd = os.open(self.config_dir, os.O_RDONLY)
         try:
-            with open(self.adblock_config, 'w') as f:
-                f.write("# PiDNS Ad-Blocker Configuration\n")
-                f.write(f"# Generated on {datetime.now().isoformat()}\n\n")
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    
+    def _read_config_digest(self, path):
+        """Read the content digest recorded in the header of a generated config file"""
+        try:
+            with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+                for _ in range(CONFIG_HEADER_LINES):
+                    line = f.readline()
+                    if line.startswith(CONFIG_DIGEST_PREFIX):
+                        return line[len(CONFIG_DIGEST_PREFIX):].strip()
+        except FileNotFoundError:
+            pass
+        return None
+    
+    def write_config_file(self, path, title, lines):
+        """
+        Atomically write a generated configuration file
+        
+        The body is written in large buffered chunks to a hidden temp file in
+        the same directory (dnsmasq skips dot files), while a SHA-256 of the
+        body is computed. If it matches the digest recorded in the current
+        file, the temp file is dropped and nothing changes; otherwise it is
+        fsynced and renamed over the live file, after the pending-reload
+        marker has been recorded. Returns True when the file changed.
+        """
+        path = Path(path)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        digest = hashlib.sha256()
+        
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(f"# {title}\n# Generated on {datetime.now().isoformat()}\n".encode('utf-8'))
+                digest_offset = f.tell() + len(CONFIG_DIGEST_PREFIX)
+                f.write(f"{CONFIG_DIGEST_PREFIX}{'0' * 64}\n\n".encode('utf-8'))
                 
-                # Add sinkhole IP configuration
-                f.write("# Sinkhole IP address\n")
-                f.write("address=/#/0.0.0.0\n")
-                f.write("address=/#/::\n\n")
+                buffer = []
+                buffered = 0
+                for line in lines:
+                    buffer.append(line)
+                    buffered += len(line)
+                    if buffered >= CONFIG_WRITE_BUFFER_SIZE:
+                        chunk = ''.join(buffer).encode('utf-8')
+                        digest.update(chunk)
+                        f.write(chunk)
+                        buffer = []
+                        buffered = 0
                 
-                # Add blocked domains
-                f.write("# Blocked domains\n")
-                for domain in sorted(set(blocked_domains)):
-                    if domain and not domain.startswith('#'):
-                        f.write(f"address=/{domain}/0.0.0.0\n")
-                        f.write(f"address=/{domain}/::\n")
+                chunk = ''.join(buffer).encode('utf-8')
+                digest.update(chunk)
+                f.write(chunk)
                 
-                logger.info(f"Generated adblock config with {len(blocked_domains)} domains")
-                return True
+                content_digest = digest.hexdigest()
+                changed = content_digest != self._read_config_digest(path)
+                
+                if changed:
+                    f.seek(digest_offset)
+                    f.write(content_digest.encode('utf-8'))
+                    f.flush()
+                    os.fsync(f.fileno())
+            
+            if not changed:
+                tmp_path.unlink()
+                logger.info(f"{path.name} unchanged, keeping current file")
+                return False
+            
+            # Before the rename, so a crash right after it still reloads
+            self._mark_reload_pending()
+            os.replace(tmp_path, path)
+            
+            # Persist the rename itself
+            dir_fd = os.open(path.parent, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+            return True
+            
+        except Exception:
+            tmp_path.unlink(missing_ok=True)
+            raise
+    
+    def adblock_output_exists(self):
+        """Check that every file of the configured adblock backend exists"""
+        if self.output_format == ADBLOCK_HOSTS_FORMAT and not self.adblock_hosts.exists():
+            return False
+        return self.adblock_config.exists()
+    
+    def generate_adblock_config(self, blocked_domains, presorted=False, whitelist_domains=()):
+        """
+        Generate dnsmasq configuration for blocked domains
+        
+        Pass presorted=True when blocked_domains is already unique and in
+        reversed_label_key order (e.g. streamed from the domain index) to skip
+        materializing it. whitelist_domains keeps subdomain collapsing from
+        hiding blocked domains that sit below a whitelisted one.
+        """
+        try:
+            if self.output_format not in ADBLOCK_OUTPUT_FORMATS:
+                raise ValueError(f"Unknown adblock output format: {self.output_format}")
+            
+            if not presorted:
+                blocked_domains = sorted(set(blocked_domains), key=reversed_label_key)
+            
+            if self.output_format == ADBLOCK_HOSTS_FORMAT:
+                domain_count = self._generate_adblock_hosts(blocked_domains, whitelist_domains)
+            else:
+                domain_count = self._generate_adblock_conf(blocked_domains, whitelist_domains)
+                # Don't leave a stale hosts file behind after switching backends
+                self.adblock_hosts.unlink(missing_ok=True)
+            
+            logger.info(f"Generated adblock config with {domain_count} domains ({self.output_format} format)")
+            return True
                 
         except Exception as e:
             logger.error(f"Failed to generate adblock config: {e}")
             return False
     
+    def _generate_adblock_conf(self, blocked_domains, whitelist_domains):
+        """Write one config line template per blocked domain into adblock.conf"""
+        line_format = ADBLOCK_LINE_FORMATS[self.output_format]
+        
+        if self.collapse_subdomains:
+            blocked_domains = collapse_subdomains(blocked_domains, domains_with_parents(whitelist_domains))
+        
+        domain_count = 0
+        
+        def config_lines():
+            nonlocal domain_count
+            
+            if self.output_format == 'address':
+                # Add sinkhole IP configuration
+                yield "# Sinkhole IP address\n"
+                yield "address=/#/0.0.0.0\n"
+                yield "address=/#/::\n\n"
+            
+            # Add blocked domains
+            yield "# Blocked domains\n"
+            for domain in blocked_domains:
+                if domain and not domain.startswith('#'):
+                    yield line_format.format(domain=domain)
+                    domain_count += 1
+        
+        self.write_config_file(self.adblock_config, "PiDNS Ad-Blocker Configuration", config_lines())
+        return domain_count
+    
+    def _generate_adblock_hosts(self, blocked_domains, whitelist_domains):
+        """
+        Write blocked domains to a hosts file loaded through addn-hosts
+        
+        Hosts entries match exact names only, so subdomains are never
+        collapsed, and they take precedence over server= whitelist rules, so
+        whitelisted domains are left out. The hosts file lives outside the
+        dnsmasq conf-dir, which would otherwise try to parse it as config.
+        """
+        whitelist_domains = set(whitelist_domains)
+        domain_count = 0
+        
+        def hosts_lines():
+            nonlocal domain_count
+            
+            for domain in blocked_domains:
+                if domain and not domain.startswith('#') and domain not in whitelist_domains:
+                    yield HOSTS_LINE_FORMAT.format(domain=domain)
+                    domain_count += 1
+        
+        self.adblock_hosts.parent.mkdir(parents=True, exist_ok=True)
+        self.write_config_file(self.adblock_hosts, "PiDNS Ad-Blocker Hosts", hosts_lines())
+        self.write_config_file(
+            self.adblock_config, "PiDNS Ad-Blocker Configuration", [f"addn-hosts={self.adblock_hosts}\n"]
+        )
+        return domain_count
+    
     def generate_whitelist_config(self, whitelist_domains):
         """Generate dnsmasq configuration for whitelisted domains"""
         try:
-            with open(self.whitelist_config, 'w') as f:
-                f.write("# PiDNS Ad-Blocker Whitelist Configuration\n")
-                f.write(f"# Generated on {datetime.now().isoformat()}\n\n")
-                
+            def config_lines():
                 # Add whitelist entries
-                f.write("# Whitelisted domains (bypass ad-blocking)\n")
+                yield "# Whitelisted domains (bypass ad-blocking)\n"
                 for domain in sorted(set(whitelist_domains)):
                     if domain and not domain.startswith('#'):
-                        f.write(f"server=/{domain}/#\n")
-                
-                logger.info(f"Generated whitelist config with {len(whitelist_domains)} domains")
-                return True
+                        yield f"server=/{domain}/#\n"
+            
+            self.write_config_file(
+                self.whitelist_config, "PiDNS Ad-Blocker Whitelist Configuration", config_lines()
+            )
+            
+            logger.info(f"Generated whitelist config with {len(whitelist_domains)} domains")
+            return True
                 
         except Exception as e:
             logger.error(f"Failed to generate whitelist config: {e}")
@@ -74,24 +313,36 @@ class DnsmasqManager:
     def generate_blacklist_config(self, blacklist_domains):
         """Generate dnsmasq configuration for blacklisted domains"""
         try:
-            with open(self.blacklist_config, 'w') as f:
-                f.write("# PiDNS Ad-Blocker Blacklist Configuration\n")
-                f.write(f"# Generated on {datetime.now().isoformat()}\n\n")
-                
+            def config_lines():
                 # Add blacklist entries
-                f.write("# Explicitly blacklisted domains\n")
+                yield "# Explicitly blacklisted domains\n"
                 for domain in sorted(set(blacklist_domains)):
                     if domain and not domain.startswith('#'):
-                        f.write(f"address=/{domain}/0.0.0.0\n")
-                        f.write(f"address=/{domain}/::\n")
-                
-                logger.info(f"Generated blacklist config with {len(blacklist_domains)} domains")
-                return True
+                        yield f"address=/{domain}/0.0.0.0\n"
+                        yield f"address=/{domain}/::\n"
+            
+            self.write_config_file(
+                self.blacklist_config, "PiDNS Ad-Blocker Blacklist Configuration", config_lines()
+            )
+            
+            logger.info(f"Generated blacklist config with {len(blacklist_domains)} domains")
+            return True
                 
         except Exception as e:
             logger.error(f"Failed to generate blacklist config: {e}")
             return False
     
+    def reload_if_needed(self):
+        """Reload dnsmasq only if a generated config file actually changed"""
+        if not self.reload_needed:
+            logger.info("dnsmasq configuration unchanged, skipping reload")
+            return True
+        
+        if self.reload_dnsmasq():
+            self.reload_marker.unlink(missing_ok=True)
+            return True
+        return False
+    
     def reload_dnsmasq(self):
         """Reload dnsmasq service to apply configuration changes"""
         try:
@@ -319,8 +570,9 @@ class DnsmasqManager:
                 logger.error(f"Failed to restore dnsmasq config: {result.stderr}")
                 return False
             
-            # Reload dnsmasq
-            return self.reload_dnsmasq()
+            # Reload dnsmasq; the marker keeps a failed reload pending
+            self._mark_reload_pending()
+            return self.reload_if_needed()
             
         except Exception as e:
             logger.error(f"Failed to restore dnsmasq config: {e}")
@@ -0,0 +1,153 @@
+"""
+Parsed-domain cache for PiDNS Ad-Blocker
+Stores the normalized domains of each block list next to its raw file
+"""
+
+import hashlib
+import heapq
+import logging
+import os
+from contextlib import ExitStack
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Domains held in memory per sorted run before spilling to disk
+SORT_RUN_SIZE = 250000
+
+
+def hash_file(file_path):
+    """Return the SHA-256 hex digest of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DomainCache:
+    """
+    Per block list artifacts holding sorted, deduplicated domains.
+
+    Artifacts are written once when a list is downloaded and are keyed by
+    the SHA-256 of the raw list content, so an unchanged download maps to
+    the artifact that already exists and never needs parsing again.
+
+    Domains are sorted externally in bounded runs, so writing an artifact
+    never holds more than sort_run_size domains in memory.
+    """
+
+    def __init__(self, cache_dir, sort_run_size=SORT_RUN_SIZE):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.sort_run_size = sort_run_size
+
+    def artifact_path(self, blocklist_id, content_hash):
+        """Get the artifact path for a block list content hash"""
+        return self.cache_dir / f"blocklist_{blocklist_id}.{content_hash[:16]}.domains"
+
+    def has(self, blocklist_id, content_hash):
+        """Check whether an artifact exists for a block list content hash"""
+        if not content_hash:
+            return False
+        return self.artifact_path(blocklist_id, content_hash).exists()
+
+    def write(self, blocklist_id, content_hash, domains):
+        """Write the sorted, deduplicated domains atomically and return their count"""
+        pending_path, count = self.write_pending(blocklist_id, domains)
+        self.publish(pending_path, blocklist_id, content_hash)
+        return count
+
+    def write_pending(self, blocklist_id, domains):
+        """
+        Sort and deduplicate domains into a pending artifact.
+
+        Used when the content hash is only known once the domains have been
+        consumed (e.g. while streaming a download). Returns (pending_path,
+        count); hand the path to publish() or discard() afterwards.
+        """
+        pending_path = self.cache_dir / f"blocklist_{blocklist_id}.pending.tmp"
+        run_paths = []
+
+        try:
+            run = set()
+            for domain in domains:
+                run.add(domain)
+                if len(run) >= self.sort_run_size:
+                    run_paths.append(self._write_run(blocklist_id, len(run_paths), run))
+                    run = set()
+
+            if not run_paths:
+                count = self._write_sorted(pending_path, sorted(run))
+            else:
+                if run:
+                    run_paths.append(self._write_run(blocklist_id, len(run_paths), run))
+                del run
+                count = self._write_sorted(pending_path, self._merge_runs(run_paths))
+
+        except Exception:
+            self.discard(pending_path)
+            raise
+
+        finally:
+            for run_path in run_paths:
+                run_path.unlink()
+
+        logger.debug(f"Cached {count} domains for block list {blocklist_id}")
+        return pending_path, count
+
+    def publish(self, pending_path, blocklist_id, content_hash):
+        """Atomically move a pending artifact into place for a content hash"""
+        os.replace(pending_path, self.artifact_path(blocklist_id, content_hash))
+
+    def discard(self, pending_path):
+        """Remove a pending artifact that will not be published"""
+        Path(pending_path).unlink(missing_ok=True)
+
+    def _write_run(self, blocklist_id, run_number, domains):
+        """Spill one sorted run to disk"""
+        run_path = self.cache_dir / f"blocklist_{blocklist_id}.run{run_number}.tmp"
+        self._write_sorted(run_path, sorted(domains))
+        return run_path
+
+    def _merge_runs(self, run_paths):
+        """Merge sorted run files into one sorted stream"""
+        with ExitStack() as stack:
+            files = [stack.enter_context(open(path, 'r', encoding='utf-8')) for path in run_paths]
+            for line in heapq.merge(*files):
+                yield line.rstrip('\n')
+
+    def _write_sorted(self, path, sorted_domains):
+        """Write sorted domains one per line, dropping adjacent duplicates"""
+        count = 0
+        previous = None
+        with open(path, 'w', encoding='utf-8', buffering=HASH_CHUNK_SIZE) as f:
+            for domain in sorted_domains:
+                if domain != previous:
+                    f.write(domain)
+                    f.write('\n')
+                    count += 1
+                    previous = domain
+        return count
+
+    def iter_domains(self, blocklist_id, content_hash):
+        """Yield the cached domains of a block list in sorted order"""
+        with open(self.artifact_path(blocklist_id, content_hash), 'r', encoding='utf-8') as f:
+            for line in f:
+                yield line.rstrip('\n')
+
+    def remove(self, blocklist_id, keep_hash=None):
+        """Remove the artifacts of a block list, optionally keeping one hash"""
+        keep_path = self.artifact_path(blocklist_id, keep_hash) if keep_hash else None
+        for path in self.cache_dir.glob(f"blocklist_{blocklist_id}.*.domains"):
+            if path != keep_path:
+                path.unlink()
+
+    def cached_ids(self):
+        """Get the block list IDs that have at least one artifact"""
+        ids = set()
+        for path in self.cache_dir.glob("blocklist_*.domains"):
+            ids.add(path.name.split('.', 1)[0].replace("blocklist_", ""))
+        return ids
@@ -0,0 +1,298 @@
+"""
+Reference-counted domain index for PiDNS Ad-Blocker
+Tracks how many enabled block lists contain each domain so that enabling,
+disabling or updating a list only touches that list's domains, and which
+lists those are so blocked queries can be attributed to a list
+"""
+
+import logging
+import sqlite3
+from itertools import islice
+from pathlib import Path
+
+from adblocker.services.dnsmasq_manager import reversed_label_key
+
+logger = logging.getLogger(__name__)
+
+# Bumped when the schema changes in a way that needs the index recounted
+INDEX_SCHEMA_VERSION = 1
+
+# Domains written per executemany, so a list of any size is applied in bounded memory
+WRITE_BATCH_SIZE = 10000
+
+
+def domain_suffixes(domain):
+    """Get a domain followed by each of its parent domains, most specific first"""
+    labels = domain.split('.')
+    return ['.'.join(labels[i:]) for i in range(len(labels))]
+
+
+def batched(iterable, size=WRITE_BATCH_SIZE):
+    """Yield lists of up to size items from an iterable"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def diff_sorted(old_domains, new_domains):
+    """Compare two sorted domain iterables, yielding (domain, True) if added and (domain, False) if removed"""
+    old_iter = iter(old_domains)
+    new_iter = iter(new_domains)
+    old = next(old_iter, None)
+    new = next(new_iter, None)
+
+    while old is not None and new is not None:
+        if old == new:
+            old = next(old_iter, None)
+            new = next(new_iter, None)
+        elif old < new:
+            yield old, False
+            old = next(old_iter, None)
+        else:
+            yield new, True
+            new = next(new_iter, None)
+
+    while old is not None:
+        yield old, False
+        old = next(old_iter, None)
+    while new is not None:
+        yield new, True
+        new = next(new_iter, None)
+
+
+class DomainIndex:
+    """
+    SQLite-backed map of domain -> number of enabled block lists containing it.
+
+    Alongside the counts, domain_lists records which lists contain each
+    domain, which QueryLogger reads through DomainListLookup.
+
+    The index remembers which content hash of each list it has counted, so
+    sync() can work out per-list deltas from the parsed-domain artifacts in
+    the DomainCache and apply only those. Keeping the index on disk avoids
+    holding millions of Python strings in RAM and lets it survive restarts.
+    """
+
+    def __init__(self, index_path, domain_cache):
+        self.index_path = Path(index_path)
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        self.domain_cache = domain_cache
+
+        # Autocommit mode; transactions are managed explicitly in sync()
+        self.connection = sqlite3.connect(str(self.index_path), timeout=30, isolation_level=None)
+        self.connection.create_function('label_key', 1, reversed_label_key, deterministic=True)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS domain_refs (
+                domain TEXT PRIMARY KEY,
+                refs INTEGER NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS indexed_lists (
+                blocklist_id INTEGER PRIMARY KEY,
+                content_hash TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS domain_lists (
+                domain TEXT NOT NULL,
+                blocklist_id INTEGER NOT NULL,
+                PRIMARY KEY (domain, blocklist_id)
+            ) WITHOUT ROWID;
+        """)
+
+        # Indexes built before domain_lists existed have to be recounted
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version < INDEX_SCHEMA_VERSION:
+            self.connection.executescript(f"""
+                BEGIN IMMEDIATE;
+                DELETE FROM domain_refs;
+                DELETE FROM domain_lists;
+                DELETE FROM indexed_lists;
+                PRAGMA user_version = {INDEX_SCHEMA_VERSION};
+                COMMIT;
+            """)
+
+    def close(self):
+        """Close the index database connection"""
+        self.connection.close()
+
+    def indexed_lists(self):
+        """Get the block lists currently counted in the index as {id: content_hash}"""
+        rows = self.connection.execute('SELECT blocklist_id, content_hash FROM indexed_lists')
+        return {blocklist_id: content_hash for blocklist_id, content_hash in rows}
+
+    def count(self):
+        """Get the number of effectively blocked domains"""
+        return self.connection.execute('SELECT COUNT(*) FROM domain_refs').fetchone()[0]
+
+    def iter_domains(self):
+        """Yield the effectively blocked domains in reversed-label order"""
+        rows = self.connection.execute('SELECT domain FROM domain_refs ORDER BY label_key(domain)')
+        for (domain,) in rows:
+            yield domain
+
+    def sync(self, desired_lists):
+        """
+        Bring the index in line with the given {blocklist_id: content_hash} map.
+
+        Returns True when the effective set of blocked domains changed.
+        """
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            current_lists = self.indexed_lists()
+
+            if self._can_apply_deltas(current_lists, desired_lists):
+                changed = self._apply_deltas(current_lists, desired_lists)
+            else:
+                logger.warning("Domain index is missing cached artifacts, rebuilding from scratch")
+                changed = self._rebuild(desired_lists)
+
+            self.connection.execute('COMMIT')
+            return changed
+
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def _can_apply_deltas(self, current_lists, desired_lists):
+        """Check that every artifact needed to compute the deltas is available"""
+        for blocklist_id, content_hash in current_lists.items():
+            if desired_lists.get(blocklist_id) == content_hash:
+                continue
+            if not self.domain_cache.has(blocklist_id, content_hash):
+                return False
+        return True
+
+    def _apply_deltas(self, current_lists, desired_lists):
+        """Apply added, removed and updated lists as per-domain reference changes"""
+        changed = False
+
+        for blocklist_id, content_hash in desired_lists.items():
+            old_hash = current_lists.get(blocklist_id)
+            if old_hash == content_hash:
+                continue
+
+            new_domains = self.domain_cache.iter_domains(blocklist_id, content_hash)
+            if old_hash is None:
+                changed |= self._add_domains(blocklist_id, new_domains)
+                logger.debug(f"Indexed block list {blocklist_id}")
+            else:
+                old_domains = self.domain_cache.iter_domains(blocklist_id, old_hash)
+                added_count = removed_count = 0
+                for batch in batched(diff_sorted(old_domains, new_domains)):
+                    added = [domain for domain, is_added in batch if is_added]
+                    removed = [domain for domain, is_added in batch if not is_added]
+                    changed |= self._add_domains(blocklist_id, added)
+                    changed |= self._remove_domains(blocklist_id, removed)
+                    added_count += len(added)
+                    removed_count += len(removed)
+                logger.debug(f"Re-indexed block list {blocklist_id}: +{added_count} -{removed_count}")
+
+            self.connection.execute(
+                'INSERT OR REPLACE INTO indexed_lists (blocklist_id, content_hash) VALUES (?, ?)',
+                (blocklist_id, content_hash)
+            )
+
+        # Removals come last so a domain moving between lists never drops to zero
+        for blocklist_id, content_hash in current_lists.items():
+            if blocklist_id in desired_lists:
+                continue
+
+            changed |= self._remove_domains(blocklist_id, self.domain_cache.iter_domains(blocklist_id, content_hash))
+            self.connection.execute('DELETE FROM indexed_lists WHERE blocklist_id = ?', (blocklist_id,))
+            logger.debug(f"Removed block list {blocklist_id} from domain index")
+
+        return changed
+
+    def _rebuild(self, desired_lists):
+        """Recount every desired list from its artifact"""
+        self.connection.execute('DELETE FROM domain_refs')
+        self.connection.execute('DELETE FROM domain_lists')
+        self.connection.execute('DELETE FROM indexed_lists')
+        self._apply_deltas({}, desired_lists)
+        return True
+
+    def _add_domains(self, blocklist_id, domains):
+        """Increment reference counts; returns True if any domain became blocked"""
+        changed = False
+        for batch in batched(domains):
+            params = [(domain,) for domain in batch]
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO domain_lists (domain, blocklist_id) VALUES (?, ?)',
+                [(domain, blocklist_id) for domain in batch]
+            )
+            cursor = self.connection.executemany(
+                'INSERT OR IGNORE INTO domain_refs (domain, refs) VALUES (?, 0)', params
+            )
+            changed |= cursor.rowcount > 0
+            self.connection.executemany(
+                'UPDATE domain_refs SET refs = refs + 1 WHERE domain = ?', params
+            )
+        return changed
+
+    def _remove_domains(self, blocklist_id, domains):
+        """Decrement reference counts; returns True if any domain became unblocked"""
+        changed = False
+        for batch in batched(domains):
+            params = [(domain,) for domain in batch]
+            self.connection.executemany(
+                'DELETE FROM domain_lists WHERE domain = ? AND blocklist_id = ?',
+                [(domain, blocklist_id) for domain in batch]
+            )
+            self.connection.executemany(
+                'UPDATE domain_refs SET refs = refs - 1 WHERE domain = ?', params
+            )
+            cursor = self.connection.executemany(
+                'DELETE FROM domain_refs WHERE domain = ? AND refs <= 0', params
+            )
+            changed |= cursor.rowcount > 0
+        return changed
+
+
+class DomainListLookup:
+    """
+    Read-only view of the domain index for attributing blocked queries.
+
+    dnsmasq blocks a listed domain together with all of its subdomains, so
+    a query is attributed to the lists containing its most specific listed
+    suffix. Each lookup is one primary-key probe per label of the domain;
+    nothing is loaded into memory. The connection is opened lazily because
+    the index is created by the block list manager.
+    """
+
+    def __init__(self, index_path):
+        self.index_path = Path(index_path)
+        self.connection = None
+
+    def close(self):
+        """Close the index database connection"""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def lookup(self, domains):
+        """Map each domain to the lowest block list ID of its most specific listed suffix"""
+        if not self._connect():
+            return {}
+
+        mapping = {}
+        for domain in domains:
+            for suffix in domain_suffixes(domain):
+                row = self.connection.execute(
+                    'SELECT MIN(blocklist_id) FROM domain_lists WHERE domain = ?', (suffix,)
+                ).fetchone()
+                if row[0] is not None:
+                    mapping[domain] = row[0]
+                    break
+        return mapping
+
+    def _connect(self):
+        """Open the index read-only once it exists"""
+        if self.connection is None:
+            if not self.index_path.exists():
+                return False
+            # Flushes may run on the logger thread or the thread stopping it
+            self.connection = sqlite3.connect(
+                f"file:{self.index_path}?mode=ro", uri=True, timeout=5, check_same_thread=False
+            )
+        return True
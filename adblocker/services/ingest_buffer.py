@@ -0,0 +1,229 @@
+"""
+Ingest buffer for PiDNS Ad-Blocker
+Bounded queue of parsed query records waiting to be flushed to the database
+"""
+
+import json
+import logging
+import random
+import threading
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# What happens to a record that arrives while the buffer is full
+OVERFLOW_DROP = 'drop'  # discard the new record
+OVERFLOW_DROP_OLDEST = 'drop_oldest'  # discard the oldest buffered record
+OVERFLOW_SAMPLE = 'sample'  # keep a uniform random sample (reservoir) of everything offered
+OVERFLOW_SPILL = 'spill'  # append to a spill file on disk, up to spill_max_bytes
+OVERFLOW_POLICIES = (OVERFLOW_DROP, OVERFLOW_DROP_OLDEST, OVERFLOW_SAMPLE, OVERFLOW_SPILL)
+
+
+def _encode_record(record):
+    """Serialize a record for the spill file"""
+    return json.dumps(record, default=lambda value: value.isoformat()) + '\n'
+
+
+def _decode_record(line):
+    """Restore a record from the spill file"""
+    record = json.loads(line)
+    record['timestamp'] = datetime.fromisoformat(record['timestamp'])
+    return record
+
+
+class IngestBuffer:
+    """
+    Fixed-capacity FIFO of query records with an explicit overflow policy.
+
+    Records that do not fit are dropped, sampled or spilled to disk
+    according to `overflow_policy`, and every outcome is counted. Spilled
+    records are drained after the in-memory ones, at most `capacity` per
+    drain, and records requeued beyond capacity go back to disk, so memory
+    stays bounded while the database is unavailable. The spill file only
+    outlives a flush, never a restart: records are re-read from the log
+    after a restart because the log offset is saved only once the buffer
+    is empty.
+    """
+
+    def __init__(self, capacity, overflow_policy=OVERFLOW_DROP_OLDEST, spill_file=None,
+                 spill_max_bytes=64 * 1024 * 1024):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        if overflow_policy == OVERFLOW_SPILL and not spill_file:
+            raise ValueError("The spill overflow policy needs a spill file")
+
+        self.capacity = capacity
+        self.overflow_policy = overflow_policy
+        self.spill_file = Path(spill_file) if spill_file else None
+        self.spill_max_bytes = spill_max_bytes
+
+        self._records = deque()
+        self._lock = threading.Lock()
+        self._spill_bytes = 0
+        self._spill_count = 0
+        self._spill_offset = 0
+        self._offered_while_full = 0
+
+        self.offered = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.last_flush_rows = 0
+        self.last_flush_seconds = None
+        self.max_flush_seconds = None
+        self.total_flush_seconds = 0.0
+        self.last_flush_at = None
+
+        if self.spill_file:
+            self.spill_file.parent.mkdir(parents=True, exist_ok=True)
+            self.spill_file.unlink(missing_ok=True)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._records) + self._spill_count
+
+    def is_full(self):
+        """Check whether the in-memory part of the buffer is at capacity"""
+        with self._lock:
+            return len(self._records) >= self.capacity
+
+    def put(self, record):
+        """Add a record, applying the overflow policy when full; returns False if it was dropped"""
+        with self._lock:
+            self.offered += 1
+            if len(self._records) < self.capacity:
+                self._records.append(record)
+                self._offered_while_full = 0
+                return True
+
+            self._offered_while_full += 1
+
+            if self.overflow_policy == OVERFLOW_DROP_OLDEST:
+                self._records.popleft()
+                self._records.append(record)
+                self.dropped += 1
+                return True
+
+            if self.overflow_policy == OVERFLOW_SAMPLE:
+                # Reservoir sampling over everything offered since the buffer filled up
+                self.dropped += 1
+                slot = random.randrange(self.capacity + self._offered_while_full)
+                if slot < self.capacity:
+                    self._records[slot] = record
+                    return True
+                return False
+
+            if self.overflow_policy == OVERFLOW_SPILL and self._spill([record]):
+                self.spilled += 1
+                return True
+
+            self.dropped += 1
+            return False
+
+    def drain(self):
+        """Remove and return the in-memory records and up to `capacity` spilled ones, oldest first"""
+        with self._lock:
+            records = list(self._records)
+            self._records.clear()
+            self._offered_while_full = 0
+
+            if self._spill_count:
+                records.extend(self._read_spill(self.capacity))
+            return records
+
+    def requeue(self, records):
+        """Put records from a failed flush back at the front of the buffer"""
+        with self._lock:
+            self._records.extendleft(reversed(records))
+            if self.overflow_policy != OVERFLOW_SPILL or len(self._records) <= self.capacity:
+                return
+
+            # Keep the oldest in memory and write the rest back to disk
+            excess = [self._records.pop() for _ in range(len(self._records) - self.capacity)]
+            excess.reverse()
+            self.dropped += len(excess) - self._spill(excess)
+
+    def record_flush(self, rows, seconds, success=True):
+        """Account for one flush attempt"""
+        with self._lock:
+            self.flushes += 1
+            if not success:
+                self.flush_errors += 1
+            self.last_flush_rows = rows
+            self.last_flush_seconds = round(seconds, 4)
+            self.max_flush_seconds = max(self.max_flush_seconds or 0, self.last_flush_seconds)
+            self.total_flush_seconds += seconds
+            self.last_flush_at = datetime.now()
+
+    def get_metrics(self):
+        """Get queue depth, flush latency and drop counters"""
+        with self._lock:
+            return {
+                'depth': len(self._records),
+                'capacity': self.capacity,
+                'spilled_pending': self._spill_count,
+                'spill_bytes': self._spill_bytes,
+                'overflow_policy': self.overflow_policy,
+                'offered': self.offered,
+                'dropped': self.dropped,
+                'spilled': self.spilled,
+                'flushes': self.flushes,
+                'flush_errors': self.flush_errors,
+                'last_flush_rows': self.last_flush_rows,
+                'last_flush_seconds': self.last_flush_seconds,
+                'max_flush_seconds': self.max_flush_seconds,
+                'avg_flush_seconds': round(self.total_flush_seconds / self.flushes, 4) if self.flushes else None,
+                'last_flush_at': self.last_flush_at.isoformat() if self.last_flush_at else None
+            }
+
+    def _spill(self, records):
+        """Append records to the spill file up to its size limit; returns how many were written"""
+        lines = []
+        size = self._spill_bytes
+        for record in records:
+            line = _encode_record(record)
+            if size + len(line) > self.spill_max_bytes:
+                break
+            lines.append(line)
+            size += len(line)
+        if not lines:
+            return 0
+
+        try:
+            with open(self.spill_file, 'a', encoding='utf-8') as f:
+                f.writelines(lines)
+        except OSError as e:
+            logger.error(f"Failed to spill query records: {e}")
+            return 0
+        self._spill_bytes = size
+        self._spill_count += len(lines)
+        return len(lines)
+
+    def _read_spill(self, limit):
+        """Read back up to `limit` spilled records; the file is removed once all are read"""
+        records = []
+        try:
+            # Binary mode so the read position can be kept between calls
+            with open(self.spill_file, 'rb') as f:
+                f.seek(self._spill_offset)
+                while len(records) < limit:
+                    line = f.readline()
+                    if not line:
+                        break
+                    records.append(_decode_record(line))
+                self._spill_offset = f.tell()
+            self._spill_count -= len(records)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to read spilled query records: {e}")
+            self.dropped += self._spill_count - len(records)
+            self._spill_count = 0
+
+        if self._spill_count <= 0:
+            self.spill_file.unlink(missing_ok=True)
+            self._spill_bytes = 0
+            self._spill_count = 0
+            self._spill_offset = 0
+        return records
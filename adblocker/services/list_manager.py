@@ -8,15 +8,16 @@ from datetime import datetime, timedelta
 
 from adblocker.models.database import Whitelist, Blacklist, db
 from adblocker.services.dnsmasq_manager import DnsmasqManager
+from adblocker.services.reload_coordinator import request_reload, WHITELIST, BLACKLIST
 
 logger = logging.getLogger(__name__)
 
 class ListManager:
     """Manages whitelist and blacklist entries"""
     
-    def __init__(self, config):
+    def __init__(self, config, dnsmasq_manager=None):
         self.config = config
-        self.dnsmasq_manager = DnsmasqManager(config)
+        self.dnsmasq_manager = dnsmasq_manager or DnsmasqManager(config)
     
     def add_whitelist_entry(self, domain, category='custom', expires_at=None, notes=''):
         """Add a domain to the whitelist"""
@@ -220,20 +221,49 @@ class ListManager:
             logger.error(f"Failed to get blacklist entries: {e}")
             return []
     
+    def write_whitelist_config(self):
+        """Write the dnsmasq whitelist configuration without reloading; returns False if it failed"""
+        # Get all non-expired whitelist entries
+        entries = Whitelist.query.all()
+        whitelist_domains = [entry.domain for entry in entries if not entry.is_expired()]
+        
+        # Generate configuration
+        if not self.dnsmasq_manager.generate_whitelist_config(whitelist_domains):
+            return False
+        
+        logger.info(f"Updated whitelist configuration with {len(whitelist_domains)} domains")
+        return True
+    
+    def write_blacklist_config(self):
+        """Write the dnsmasq blacklist configuration without reloading; returns False if it failed"""
+        # Get all non-expired blacklist entries
+        entries = Blacklist.query.all()
+        blacklist_domains = [entry.domain for entry in entries if not entry.is_expired()]
+        
+        # Generate configuration
+        if not self.dnsmasq_manager.generate_blacklist_config(blacklist_domains):
+            return False
+        
+        logger.info(f"Updated blacklist configuration with {len(blacklist_domains)} domains")
+        return True
+    
     def update_whitelist_config(self):
         """Update dnsmasq whitelist configuration"""
         try:
-            # Get all non-expired whitelist entries
-            entries = Whitelist.query.all()
-            whitelist_domains = [entry.domain for entry in entries if not entry.is_expired()]
+            # Let the reload coordinator batch this with other changes when running
+            if request_reload(WHITELIST):
+                return True
             
-            # Generate configuration
-            self.dnsmasq_manager.generate_whitelist_config(whitelist_domains)
+            self.write_whitelist_config()
             
-            # Reload dnsmasq
-            self.dnsmasq_manager.reload_dnsmasq()
+            # Hosts-format and collapsed block lists depend on the whitelist, so regenerate them too
+            if self.dnsmasq_manager.blocklist_uses_whitelist:
+                from adblocker.services.blocklist_manager import BlockListManager
+                with BlockListManager(self.config, self.dnsmasq_manager) as blocklist_manager:
+                    blocklist_manager.generate_combined_config(force=True)
             
-            logger.info(f"Updated whitelist configuration with {len(whitelist_domains)} domains")
+            # Reload dnsmasq
+            self.dnsmasq_manager.reload_if_needed()
             return True
             
         except Exception as e:
@@ -243,17 +273,14 @@ class ListManager:
     def update_blacklist_config(self):
         """Update dnsmasq blacklist configuration"""
         try:
-            # Get all non-expired blacklist entries
-            entries = Blacklist.query.all()
-            blacklist_domains = [entry.domain for entry in entries if not entry.is_expired()]
+            # Let the reload coordinator batch this with other changes when running
+            if request_reload(BLACKLIST):
+                return True
             
-            # Generate configuration
-            self.dnsmasq_manager.generate_blacklist_config(blacklist_domains)
+            self.write_blacklist_config()
             
             # Reload dnsmasq
-            self.dnsmasq_manager.reload_dnsmasq()
-            
-            logger.info(f"Updated blacklist configuration with {len(blacklist_domains)} domains")
+            self.dnsmasq_manager.reload_if_needed()
             return True
             
         except Exception as e:
@@ -0,0 +1,304 @@
+"""
+Log tailer for PiDNS Ad-Blocker
+Follows the dnsmasq log across rotations, woken by inotify instead of polling
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# inotify event masks (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_EVENT = struct.Struct('iIII')
+INOTIFY_READ_SIZE = 64 * 1024
+
+# Bytes of log read per chunk
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+class Inotify:
+    """Minimal ctypes binding to the Linux inotify API"""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path, mask):
+        """Watch a path and return its watch descriptor"""
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(path))
+        return wd
+
+    def rm_watch(self, wd):
+        """Stop watching; the kernel may already have dropped the watch"""
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Drain pending events as (wd, mask, name) tuples"""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, INOTIFY_READ_SIZE)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'surrogateescape')
+                offset += length
+                events.append((wd, mask, name))
+
+    def close(self):
+        """Close the inotify descriptor"""
+        os.close(self.fd)
+
+
+class LogTailer:
+    """
+    Follows an append-only log file, keeping its descriptor open.
+
+    wait() blocks on inotify (IN_MODIFY / IN_MOVE_SELF on the file,
+    IN_CREATE / IN_MOVED_TO on its directory) and falls back to sleeping
+    poll_interval when inotify is unavailable. Rotation is detected by the
+    path pointing at a new inode (the old file is drained first) and
+    truncation by the file shrinking below the read position.
+
+    The offset of the last complete line is persisted together with the
+    file's inode at most every checkpoint_interval seconds, so a restart
+    resumes where it left off without writing the offset on every read.
+    """
+
+    def __init__(self, log_file, offset_file, checkpoint_interval=5.0, poll_interval=1.0):
+        self.log_file = Path(log_file)
+        self.offset_file = Path(offset_file)
+        self.checkpoint_interval = checkpoint_interval
+        self.poll_interval = poll_interval
+
+        self.file = None
+        self.inode = None
+        self.position = 0
+        self._pending = b''
+
+        self._saved_state = None
+        self._last_checkpoint = 0.0
+
+        self._inotify = None
+        self._file_wd = None
+        self._dir_wd = None
+        self._wake_r = self._wake_w = None
+
+    def open(self):
+        """Open the log file, resuming from the persisted offset when it still applies"""
+        # Self-pipe so wake() can interrupt a blocking wait()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+
+        try:
+            self._inotify = Inotify()
+            self._dir_wd = self._inotify.add_watch(self.log_file.parent, IN_CREATE | IN_MOVED_TO)
+        except (OSError, AttributeError) as e:
+            logger.warning(f"inotify unavailable, polling {self.log_file} every {self.poll_interval}s: {e}")
+            if self._inotify:
+                self._inotify.close()
+            self._inotify = None
+
+        offset, inode = self._load_offset()
+        if self._reopen() and (inode is None or inode == self.inode):
+            if offset <= os.fstat(self.file.fileno()).st_size:
+                self.file.seek(offset)
+                self.position = offset
+        self._saved_state = (self.position, self.inode)
+
+    def close(self):
+        """Persist the offset and release every descriptor"""
+        self.checkpoint(force=True)
+        if self.file:
+            self.file.close()
+            self.file = None
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
+        if self._wake_r is not None:
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            self._wake_r = self._wake_w = None
+
+    def wake(self):
+        """Interrupt a blocking wait() from another thread"""
+        if self._wake_w is None:
+            return
+        try:
+            os.write(self._wake_w, b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def wait(self, timeout=None):
+        """Block until the log may have changed, wake() is called or timeout expires"""
+        if self._inotify is None:
+            timeout = self.poll_interval if timeout is None else min(timeout, self.poll_interval)
+            select.select([self._wake_r], [], [], timeout)
+            self._drain_wake()
+            return
+
+        readable, _, _ = select.select([self._inotify.fd, self._wake_r], [], [], timeout)
+        if self._wake_r in readable:
+            self._drain_wake()
+        if self._inotify.fd in readable:
+            # Only whether something happened matters; iter_chunks() works out what
+            self._inotify.read_events()
+
+    def iter_chunks(self, chunk_size=READ_CHUNK_SIZE):
+        """
+        Yield the complete lines appended since the last call, one list per chunk.
+
+        At most chunk_size bytes are read at a time, so a backlog of any size
+        is processed in bounded memory. position covers exactly the lines
+        yielded so far, so checkpointing between chunks makes catch-up
+        resumable.
+        """
+        while True:
+            if self.file is None and not self._reopen():
+                return
+
+            self._check_truncated()
+            while True:
+                lines = self._read_chunk(chunk_size)
+                if lines is None:
+                    break
+                if lines:
+                    yield lines
+
+            if not self._rotated():
+                return
+
+            # Everything in the old file has been read; continue with the new one
+            logger.info(f"{self.log_file} was rotated, reopening")
+            if self._pending:
+                yield [self._pending]
+            self._reopen()
+
+    def checkpoint_due(self):
+        """Whether the offset changed and the checkpoint interval has passed"""
+        if (self.position, self.inode) == self._saved_state:
+            return False
+        return time.monotonic() - self._last_checkpoint >= self.checkpoint_interval
+
+    def checkpoint(self, force=False):
+        """Persist the offset if it changed and the checkpoint interval has passed"""
+        state = (self.position, self.inode)
+        if state == self._saved_state:
+            return
+        if not force and not self.checkpoint_due():
+            return
+
+        tmp_path = self.offset_file.with_name(self.offset_file.name + '.tmp')
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(f"{self.position} {self.inode or 0}")
+            os.replace(tmp_path, self.offset_file)
+            self._saved_state = state
+            self._last_checkpoint = time.monotonic()
+        except OSError as e:
+            logger.error(f"Failed to save log offset: {e}")
+
+    def _load_offset(self):
+        """Read the persisted (offset, inode); older files hold just the offset"""
+        try:
+            fields = self.offset_file.read_text().split()
+            offset = int(fields[0])
+            inode = int(fields[1]) if len(fields) > 1 and int(fields[1]) else None
+            return offset, inode
+        except (OSError, ValueError, IndexError):
+            return 0, None
+
+    def _reopen(self):
+        """(Re)open the log file from its start; returns False if it does not exist"""
+        if self.file:
+            self.file.close()
+            self.file = None
+        if self._inotify and self._file_wd is not None:
+            self._inotify.rm_watch(self._file_wd)
+            self._file_wd = None
+
+        try:
+            self.file = open(self.log_file, 'rb')
+        except FileNotFoundError:
+            return False
+
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.position = 0
+        self._pending = b''
+
+        if self._inotify:
+            try:
+                self._file_wd = self._inotify.add_watch(self.log_file, IN_MODIFY | IN_MOVE_SELF | IN_DELETE_SELF)
+            except OSError as e:
+                logger.warning(f"Failed to watch {self.log_file}: {e}")
+        return True
+
+    def _check_truncated(self):
+        """Start over if the open file shrank below the read position"""
+        if os.fstat(self.file.fileno()).st_size < self.position + len(self._pending):
+            logger.info(f"{self.log_file} was truncated, reading from the start")
+            self.file.seek(0)
+            self.position = 0
+            self._pending = b''
+
+    def _read_chunk(self, chunk_size):
+        """Read one chunk and split off its complete lines; None at end of file"""
+        data = self.file.read(chunk_size)
+        if not data:
+            return None
+
+        lines = (self._pending + data).split(b'\n')
+        self._pending = lines.pop()
+
+        # A runaway line without newline must not grow the carry-over forever
+        if len(self._pending) > chunk_size:
+            lines.append(self._pending)
+            self._pending = b''
+
+        self.position = self.file.tell() - len(self._pending)
+        return lines
+
+    def _rotated(self):
+        """Check whether the log path now refers to a different file"""
+        try:
+            return os.stat(self.log_file).st_ino != self.inode
+        except FileNotFoundError:
+            # Moved away and not recreated yet; keep draining the old file
+            return False
+
+    def _drain_wake(self):
+        """Empty the self-pipe"""
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
@@ -0,0 +1,228 @@
+"""
+Query correlator for PiDNS Ad-Blocker
+Merges the log events of one DNS lookup into a single query record
+"""
+
+from collections import OrderedDict, deque
+from datetime import timedelta
+
+from adblocker.services.log_parser import QUERY, FORWARDED, REPLY, CACHED, CONFIG
+
+# How a query was answered
+OUTCOME_BLOCKED = 'blocked'
+OUTCOME_CACHED = 'cached'
+OUTCOME_FORWARDED = 'forwarded'
+OUTCOME_LOCAL = 'local'
+
+# Seconds a query may wait for its answer before it is emitted as is
+CORRELATION_WINDOW = 10
+
+# Queries waiting for an answer, beyond which the oldest are emitted early
+MAX_PENDING = 10000
+
+# Seconds an answered query keeps absorbing the rest of its answer lines
+ANSWER_WINDOW = 1
+
+# Answer value of a CNAME line; the next answer line names its target
+CNAME_RESULT = '<CNAME>'
+
+ANSWER_KINDS = (REPLY, CACHED, CONFIG)
+
+
+class QueryCorrelator:
+    """
+    Stateful merge of query / forwarded / reply / cached / config events.
+
+    With log-queries=extra every event carries dnsmasq's serial number and
+    events are matched on it exactly. Without it, events are matched to the
+    oldest waiting query for the same domain (dnsmasq logs a lookup's lines
+    in order), within a window of `window` seconds of log time.
+
+    feed() returns the records completed by an event. A record is complete
+    once it is answered from cache, by local config (blocked or not) or by
+    an upstream reply; queries that see no answer within the window are
+    emitted with what is known. Answers whose query was never seen (e.g.
+    the log was opened mid-lookup) are emitted on their own.
+
+    dnsmasq logs one answer line per address and follows a <CNAME> line
+    with the answers for its target. For `answer_window` seconds after a
+    query is answered, further answer lines with its serial or domain, and
+    the line right after a <CNAME>, belong to that query and are dropped
+    instead of being counted as queries of their own.
+    """
+
+    def __init__(self, window=CORRELATION_WINDOW, max_pending=MAX_PENDING, answer_window=ANSWER_WINDOW):
+        self.window = timedelta(seconds=window)
+        self.max_pending = max_pending
+        self.answer_window = timedelta(seconds=answer_window)
+
+        self._next_id = 0
+        self._pending = OrderedDict()
+        self._by_serial = {}
+        self._by_domain = {}
+        # Serial or domain of recently answered lookups -> time of their last answer line
+        self._answered = OrderedDict()
+        self._cname_at = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def feed(self, event):
+        """Add one parsed log event and return the records it completed"""
+        completed = self.expire(event['timestamp'])
+
+        # Only the line right after a <CNAME> answer can name its target; with
+        # serials the target's lines carry the query's serial instead
+        follows_cname = (self._cname_at is not None and event['serial'] is None
+                         and event['timestamp'] - self._cname_at <= self.answer_window)
+        self._cname_at = None
+
+        kind = event['type']
+        if kind == QUERY:
+            self._add(event)
+            if len(self._pending) > self.max_pending:
+                completed.append(self._pop(next(iter(self._pending))))
+            return completed
+
+        record_id = self._match(event)
+        if record_id is None:
+            if kind not in ANSWER_KINDS:
+                return completed
+            if follows_cname or self._answer_key(event) in self._answered:
+                # Another address or the CNAME target of an answered query
+                self._remember(event)
+                return completed
+            # Answer without a query we know of; still count it
+            if kind == CONFIG or kind == CACHED:
+                record = self._new_record(event)
+                self._answer(record, event)
+                self._remember(event)
+                completed.append(record)
+            return completed
+
+        record = self._pending[record_id]
+        if kind == FORWARDED:
+            record['upstream'] = event['upstream']
+            record['forwarded_at'] = event['timestamp']
+            return completed
+
+        self._answer(record, event)
+        completed.append(self._pop(record_id))
+        self._remember(event)
+        return completed
+
+    def flush(self):
+        """Emit every waiting query, e.g. on shutdown or before the log offset is saved"""
+        completed = [self._finish(record) for record in self._pending.values()]
+        for record in completed:
+            # Their answers may still follow; they must not count as new queries
+            self._answered[self._answer_key(record)] = record['timestamp']
+        self._pending.clear()
+        self._by_serial.clear()
+        self._by_domain.clear()
+        return completed
+
+    def expire(self, now):
+        """Emit queries that have waited longer than the window as of `now`"""
+        expired = []
+        cutoff = now - self.window
+        while self._pending:
+            record_id = next(iter(self._pending))
+            if self._pending[record_id]['timestamp'] >= cutoff:
+                break
+            expired.append(self._pop(record_id))
+
+        answer_cutoff = now - self.answer_window
+        while self._answered:
+            key, answered_at = next(iter(self._answered.items()))
+            if answered_at >= answer_cutoff:
+                break
+            del self._answered[key]
+        return expired
+
+    def _new_record(self, event):
+        """Create a query record from the event that opened it"""
+        return {
+            'timestamp': event['timestamp'],
+            'domain': event['domain'],
+            'client_ip': event['client_ip'],
+            'query_type': event.get('qtype'),
+            'serial': event['serial'],
+            'outcome': None,
+            'blocked': False,
+            'upstream': None,
+            'forwarded_at': None,
+            'response_ms': None
+        }
+
+    def _add(self, event):
+        """Start waiting for the answer to a query"""
+        record_id = self._next_id
+        self._next_id += 1
+        self._pending[record_id] = self._new_record(event)
+
+        if event['serial'] is not None:
+            self._by_serial[event['serial']] = record_id
+        else:
+            self._by_domain.setdefault(event['domain'], deque()).append(record_id)
+
+    def _match(self, event):
+        """Find the waiting query an event belongs to"""
+        if event['serial'] is not None:
+            return self._by_serial.get(event['serial'])
+
+        waiting = self._by_domain.get(event['domain'])
+        if not waiting:
+            return None
+        if event['type'] == FORWARDED:
+            # The first query of this name that has not been forwarded yet
+            for record_id in waiting:
+                if self._pending[record_id]['upstream'] is None:
+                    return record_id
+            return None
+        return waiting[0]
+
+    def _answer_key(self, event):
+        """Key that ties an answer line to the lookup it belongs to"""
+        return event['serial'] if event['serial'] is not None else event['domain']
+
+    def _remember(self, event):
+        """Let the remaining answer lines of a lookup find it after it was emitted"""
+        key = self._answer_key(event)
+        # Re-insert so the dict stays ordered by time of the last answer
+        self._answered.pop(key, None)
+        self._answered[key] = event['timestamp']
+        if event['result'] == CNAME_RESULT:
+            self._cname_at = event['timestamp']
+
+    def _answer(self, record, event):
+        """Record how a query was answered"""
+        kind = event['type']
+        if kind == CONFIG:
+            record['blocked'] = event['blocked']
+            record['outcome'] = OUTCOME_BLOCKED if event['blocked'] else OUTCOME_LOCAL
+        elif kind == CACHED:
+            record['outcome'] = OUTCOME_CACHED
+        elif kind == REPLY:
+            record['outcome'] = OUTCOME_FORWARDED
+            if record['forwarded_at'] is not None:
+                elapsed = event['timestamp'] - record['forwarded_at']
+                record['response_ms'] = round(elapsed.total_seconds() * 1000, 3)
+
+    def _pop(self, record_id):
+        """Stop waiting for a query and return its finished record"""
+        record = self._pending.pop(record_id)
+        if record['serial'] is not None:
+            self._by_serial.pop(record['serial'], None)
+        else:
+            waiting = self._by_domain[record['domain']]
+            waiting.remove(record_id)
+            if not waiting:
+                del self._by_domain[record['domain']]
+        return self._finish(record)
+
+    def _finish(self, record):
+        """Fill in the outcome of a query that saw no answer"""
+        if record['outcome'] is None and record['upstream'] is not None:
+            record['outcome'] = OUTCOME_FORWARDED
+        return record
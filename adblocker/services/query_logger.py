@@ -3,16 +3,49 @@ Query logging service for PiDNS Ad-Blocker
 Handles logging and processing of DNS queries
 """
 
-import re
-import json
 import time
+from collections import Counter
 from datetime import datetime, timedelta
 from pathlib import Path
 from threading import Thread, Event
-from queue import Queue, Empty
 
-from adblocker.models.database import QueryStat, SummaryStat, db
-from adblocker.models.database import BlockList, Whitelist, Blacklist
+from adblocker.models.database import QueryStat, db
+from adblocker.models.database import add_summary_counts, top_blocked_domains
+from adblocker.models.database import insert_query_stat_rows, add_hourly_rollups
+from adblocker.services.log_tailer import LogTailer, READ_CHUNK_SIZE
+from adblocker.services.log_parser import DnsmasqLogParser
+from adblocker.services.stats_queries import bucket_counts
+from adblocker.services.sketches import HyperLogLog, SpaceSaving, add_query_sketches, day_summary_sketches
+from adblocker.services.query_correlator import QueryCorrelator, CORRELATION_WINDOW
+from adblocker.services.ingest_buffer import IngestBuffer, OVERFLOW_DROP_OLDEST
+from adblocker.services.domain_index import DomainListLookup
+
+# QueryLogger whose ingest metrics the API reports
+_active_logger = None
+
+
+def get_active_query_logger():
+    """Get the running query logger, if any"""
+    return _active_logger
+
+
+def build_query_stat_rows(queries, block_list_mapping):
+    """Turn queued query records into QueryStat column dicts"""
+    rows = []
+    for query in queries:
+        blocked = query['type'] == 'blocked'
+        rows.append({
+            'timestamp': query['timestamp'],
+            'domain': query['domain'],
+            'client_ip': query['client_ip'] or 'unknown',
+            'query_type': query['query_type'] or 'A',
+            'outcome': query['outcome'],
+            'upstream': query['upstream'],
+            'response_ms': query['response_ms'],
+            'blocked': blocked,
+            'block_list_id': block_list_mapping.get(query['domain']) if blocked else None
+        })
+    return rows
 
 
 class QueryLogger:
@@ -26,26 +59,45 @@ class QueryLogger:
         self.processed_log_file = Path(config['PROCESSED_LOG_FILE'])
         self.batch_size = config.get('QUERY_LOG_BATCH_SIZE', 100)
         self.flush_interval = config.get('QUERY_LOG_FLUSH_INTERVAL', 60)  # seconds
+        self.read_chunk_size = config.get('QUERY_LOG_READ_CHUNK_SIZE', READ_CHUNK_SIZE)  # bytes
         
         self.running = False
         self.thread = None
         self.stop_event = Event()
-        self.query_queue = Queue()
-        self.last_position = 0
         
-        # Regular expressions for parsing dnsmasq log entries
-        self.query_regex = re.compile(
-            r'(?P<timestamp>\w+\s+\d+\s+\d+:\d+:\d+).*query\[.*?\] (?P<domain>\S+) from (?P<client_ip>\S+)'
+        # Bounded hand-off between the log reader and the database flush
+        self.buffer = IngestBuffer(
+            config.get('QUERY_LOG_BUFFER_SIZE', 50000),
+            overflow_policy=config.get('QUERY_LOG_OVERFLOW_POLICY', OVERFLOW_DROP_OLDEST),
+            spill_file=config.get('QUERY_LOG_SPILL_FILE'),
+            spill_max_bytes=config.get('QUERY_LOG_SPILL_MAX_BYTES', 64 * 1024 * 1024)
         )
-        self.blocked_regex = re.compile(
-            r'(?P<timestamp>\w+\s+\d+\s+\d+:\d+:\d+).*config (?P<domain>\S+) is (?P<result>\S+)'
+        self.flush_failing = False
+        
+        # Per-day (unique clients, top blocked domains) sketches behind SummaryStat
+        self.day_sketches = {}
+        
+        # Follows the dnsmasq log; wakes on inotify events rather than polling
+        self.tailer = LogTailer(
+            self.log_file,
+            self.processed_log_file,
+            checkpoint_interval=config.get('QUERY_LOG_CHECKPOINT_INTERVAL', 5)  # seconds
         )
         
+        # Merges the query, forwarded, reply, cached and config lines of a lookup
+        self.log_parser = DnsmasqLogParser(hosts_files=[config['ADBLOCK_HOSTS_FILE']])
+        self.correlator = QueryCorrelator(window=config.get('QUERY_LOG_CORRELATION_WINDOW', CORRELATION_WINDOW))
+        
+        # Domain -> block list attribution maintained by BlockListManager
+        self.attribution = DomainListLookup(config['DOMAIN_INDEX_FILE'])
+        
     def start(self):
         """Start the query logger"""
+        global _active_logger
         if self.running:
             return
             
+        _active_logger = self
         self.running = True
         self.stop_event.clear()
         self.thread = Thread(target=self._run, daemon=True)
@@ -53,280 +105,237 @@ class QueryLogger:
         
     def stop(self):
         """Stop the query logger"""
+        global _active_logger
         if not self.running:
             return
             
+        if _active_logger is self:
+            _active_logger = None
         self.running = False
         self.stop_event.set()
+        self.tailer.wake()
         
         if self.thread and self.thread.is_alive():
             self.thread.join(timeout=5)
             
         # Process any remaining queries
         self._process_queue()
+        self.attribution.close()
         
     def _run(self):
         """Main thread function"""
-        # Initialize last position
-        self._initialize_position()
+        self.tailer.open()
         
         # Set up flush timer
         last_flush = time.time()
         
-        while self.running and not self.stop_event.is_set():
-            try:
-                # Check for new log entries
-                self._check_log_file()
-                
-                # Process queued queries
-                if time.time() - last_flush >= self.flush_interval:
-                    self._process_queue()
-                    last_flush = time.time()
+        try:
+            while self.running and not self.stop_event.is_set():
+                try:
+                    # Process new log entries
+                    self._check_log_file()
                     
-                # Sleep briefly
-                time.sleep(1)
-                
-            except Exception as e:
-                print(f"Error in query logger: {e}")
-                time.sleep(5)
-                
-    def _initialize_position(self):
-        """Initialize the last read position in the log file"""
-        if self.processed_log_file.exists():
-            try:
-                with open(self.processed_log_file, 'r') as f:
-                    self.last_position = int(f.read().strip())
-            except (ValueError, IOError):
-                self.last_position = 0
-                
-        # If log file doesn't exist or is smaller than last position, reset
-        if not self.log_file.exists() or self.log_file.stat().st_size < self.last_position:
-            self.last_position = 0
+                    # Process queued queries
+                    if time.time() - last_flush >= self.flush_interval:
+                        # Don't hold back lookups that never got an answer logged
+                        for record in self.correlator.expire(datetime.now()):
+                            self._queue_record(record)
+                        self._flush_and_checkpoint()
+                        last_flush = time.time()
+                        
+                    # Sleep until the log changes or the next flush is due
+                    self.tailer.wait(max(0, last_flush + self.flush_interval - time.time()))
+                    
+                except Exception as e:
+                    print(f"Error in query logger: {e}")
+                    self.stop_event.wait(5)
+        finally:
+            for record in self.correlator.flush():
+                self._queue_record(record)
+            self._process_queue()
+            self.tailer.close()
             
     def _check_log_file(self):
-        """Check for new log entries and process them"""
-        if not self.log_file.exists():
-            return
-            
-        current_size = self.log_file.stat().st_size
-        
-        if current_size <= self.last_position:
-            return
-            
-        try:
-            with open(self.log_file, 'r') as f:
-                f.seek(self.last_position)
-                new_lines = f.readlines()
-                self.last_position = f.tell()
-                
-            # Process new lines
-            for line in new_lines:
-                self._process_log_line(line.strip())
+        """Read new log entries chunk by chunk and process them"""
+        for lines in self.tailer.iter_chunks(self.read_chunk_size):
+            for line in lines:
+                self._process_log_line(line.decode('utf-8', errors='replace').strip())
                 
-            # Update position file
-            with open(self.processed_log_file, 'w') as f:
-                f.write(str(self.last_position))
+            # Flush while catching up so a large backlog never piles up in the
+            # buffer
+            if len(self.buffer) >= self.batch_size:
+                self._flush_and_checkpoint()
+                    
+            # While flushes are failing, leave the rest of the log unread
+            # instead of overflowing the buffer
+            if self.flush_failing and self.buffer.is_full():
+                break
+            
+    def _flush_and_checkpoint(self):
+        """Flush buffered queries, then save the log offset once every line read is in the database"""
+        if self.tailer.checkpoint_due():
+            # Lookups still waiting for an answer would be skipped on restart,
+            # so emit them with what is known before their lines are passed
+            for record in self.correlator.flush():
+                self._queue_record(record)
                 
-        except IOError as e:
-            print(f"Error reading log file: {e}")
+        if self._process_queue() and not len(self.buffer):
+            self.tailer.checkpoint()
             
     def _process_log_line(self, line):
         """Process a single log line"""
-        # Check if it's a query
-        query_match = self.query_regex.search(line)
-        if query_match:
-            timestamp_str = query_match.group('timestamp')
-            domain = query_match.group('domain').lower()
-            client_ip = query_match.group('client_ip')
-            
-            # Convert timestamp
-            try:
-                # Add current year to timestamp
-                current_year = datetime.now().year
-                timestamp = datetime.strptime(f"{current_year} {timestamp_str}", "%Y %b %d %H:%M:%S")
-            except ValueError:
-                timestamp = datetime.now()
-                
-            # Add to queue for processing
-            self.query_queue.put({
-                'type': 'query',
-                'timestamp': timestamp,
-                'domain': domain,
-                'client_ip': client_ip
-            })
+        event = self.log_parser.parse(line)
+        if event is None:
             return
             
-        # Check if it's a blocked query
-        blocked_match = self.blocked_regex.search(line)
-        if blocked_match:
-            timestamp_str = blocked_match.group('timestamp')
-            domain = blocked_match.group('domain').lower()
-            result = blocked_match.group('result')
+        for record in self.correlator.feed(event):
+            self._queue_record(record)
             
-            # Check if it was blocked
-            if result in ('0.0.0.0', '::', 'blocked'):
-                # Convert timestamp
-                try:
-                    current_year = datetime.now().year
-                    timestamp = datetime.strptime(f"{current_year} {timestamp_str}", "%Y %b %d %H:%M:%S")
-                except ValueError:
-                    timestamp = datetime.now()
-                    
-                # Add to queue for processing
-                self.query_queue.put({
-                    'type': 'blocked',
-                    'timestamp': timestamp,
-                    'domain': domain,
-                    'client_ip': None  # Not available in blocked log entry
-                })
-                
-    def _process_queue(self):
-        """Process queued queries and save to database"""
-        if self.query_queue.empty():
-            return
+    def _queue_record(self, record):
+        """Add a completed query record to the buffer for processing"""
+        # Flush rather than overflow, unless the database is already failing;
+        # the next timed flush retries and the overflow policy applies meanwhile
+        if self.buffer.is_full() and not self.flush_failing:
+            self._process_queue()
             
-        queries = []
-        blocked_domains = {}
+        self.buffer.put({
+            'type': 'blocked' if record['blocked'] else 'query',
+            'timestamp': record['timestamp'],
+            'domain': record['domain'],
+            'client_ip': record['client_ip'],
+            'query_type': record['query_type'],
+            'outcome': record['outcome'],
+            'upstream': record['upstream'],
+            'response_ms': record['response_ms']
+        })
         
-        # Get all queries from queue
-        while not self.query_queue.empty():
-            try:
-                query = self.query_queue.get_nowait()
-                queries.append(query)
-                
-                # Track blocked domains
-                if query['type'] == 'blocked':
-                    blocked_domains[query['domain']] = query['timestamp']
-                    
-            except Empty:
-                break
+    def _process_queue(self):
+        """Flush buffered queries to the database; returns False if a flush failed"""
+        # Spilled queries come back at most one buffer's worth per drain
+        while True:
+            queries = self.buffer.drain()
+            if not queries:
+                return True
+            if not self._flush_queries(queries):
+                return False
                 
-        if not queries:
-            return
-            
+    def _flush_queries(self, queries):
+        """Write one drained batch in a single transaction; requeues it on failure"""
+        # Track blocked domains
+        blocked_domains = {query['domain'] for query in queries if query['type'] == 'blocked'}
+        
         # Process in database session
         from adblocker.app import app
+        started = time.perf_counter()
         with app.app_context():
             try:
                 # Get block list mapping for blocked domains
                 block_list_mapping = {}
                 if blocked_domains:
-                    block_list_mapping = self._get_block_list_mapping(blocked_domains.keys())
-                    
-                # Save query stats
-                query_stats = []
-                for query in queries:
-                    blocked = query['type'] == 'blocked'
-                    block_list_id = None
-                    
-                    if blocked and query['domain'] in block_list_mapping:
-                        block_list_id = block_list_mapping[query['domain']]
-                        
-                    stat = QueryStat(
-                        timestamp=query['timestamp'],
-                        domain=query['domain'],
-                        client_ip=query['client_ip'] or 'unknown',
-                        blocked=blocked,
-                        block_list_id=block_list_id
-                    )
-                    query_stats.append(stat)
-                    
-                # Batch insert
-                if query_stats:
-                    db.session.bulk_save_objects(query_stats)
+                    block_list_mapping = self._get_block_list_mapping(blocked_domains)
                     
-                # Update summary stats
-                self._update_summary_stats()
+                rows = build_query_stat_rows(queries, block_list_mapping)
                 
-                # Commit transaction
-                db.session.commit()
+                # Update summary stats, hourly rollups and sketches incrementally from this batch
+                day_sketches = self._update_summary_stats(rows)
+                add_hourly_rollups(rows)
+                add_query_sketches(rows)
+                
+                # Save query stats with one executemany per day partition in this transaction
+                insert_query_stat_rows(rows)
                 
-                # Clean up old data
-                self._cleanup_old_data()
+                # Commit transaction; retention runs as a scheduled job
+                db.session.commit()
+                self._set_day_sketches(day_sketches)
                 
             except Exception as e:
                 db.session.rollback()
+                # Keep the batch for the next flush; overflow is then handled by the buffer
+                self.buffer.requeue(queries)
+                self.buffer.record_flush(len(queries), time.perf_counter() - started, success=False)
+                self.flush_failing = True
                 print(f"Error processing query queue: {e}")
+                return False
                 
+        self.buffer.record_flush(len(queries), time.perf_counter() - started)
+        self.flush_failing = False
+        return True
+        
     def _get_block_list_mapping(self, domains):
         """Get mapping of domains to block list IDs"""
         if not domains:
             return {}
             
-        # Query block lists that contain these domains
-        from sqlalchemy import or_
-        block_lists = BlockList.query.filter(
-            BlockList.enabled == True
-        ).all()
-        
-        mapping = {}
-        
-        for block_list in block_lists:
-            # Check if domain is in this block list
-            # This is a simplified check - in a real implementation,
-            # you might want to use a more efficient method
-            block_list_file = Path(self.config['BLOCKLISTS_DIR']) / f"{block_list.id}.txt"
+        try:
+            return self.attribution.lookup(domains)
+        except Exception as e:
+            # Attribution is best effort; never hold back the batch for it
+            print(f"Error looking up block lists for blocked domains: {e}")
+            return {}
             
-            if block_list_file.exists():
-                try:
-                    with open(block_list_file, 'r') as f:
-                        block_list_domains = set(line.strip().lower() for line in f if line.strip())
-                        
-                    for domain in domains:
-                        if domain in block_list_domains:
-                            mapping[domain] = block_list.id
-                            
-                except IOError:
-                    pass
-                    
-        return mapping
-        
-    def _update_summary_stats(self):
-        """Update daily summary statistics"""
-        today = datetime.now().date()
-        
-        # Check if summary already exists for today
-        summary = SummaryStat.query.filter_by(date=today).first()
-        
-        if not summary:
-            # Create new summary
-            total_queries = QueryStat.query.filter(
-                QueryStat.timestamp >= datetime.combine(today, datetime.min.time())
-            ).count()
+    def _update_summary_stats(self, rows):
+        """
+        Add a batch of query stat rows to the daily summary statistics
+        
+        Returns the updated day sketches without keeping them; the caller
+        stores them with _set_day_sketches once the batch is committed.
+        """
+        batches = {}
+        for row in rows:
+            day = row['timestamp'].date()
+            if day not in batches:
+                batches[day] = {'total': 0, 'blocked': 0, 'clients': set(), 'blocked_domains': Counter()}
+            batch = batches[day]
+            batch['total'] += 1
+            batch['clients'].add(row['client_ip'])
+            if row['blocked']:
+                batch['blocked'] += 1
+                batch['blocked_domains'][row['domain']] += 1
+                
+        day_sketches = {}
+        for day, batch in batches.items():
+            day_clients, day_blocked = self._get_day_sketches(day)
             
-            blocked_queries = QueryStat.query.filter(
-                QueryStat.timestamp >= datetime.combine(today, datetime.min.time()),
-                QueryStat.blocked == True
-            ).count()
+            batch_clients = HyperLogLog()
+            for client_ip in batch['clients']:
+                batch_clients.add(client_ip)
+            day_clients = HyperLogLog.merge_all([day_clients, batch_clients])
+            day_blocked = SpaceSaving.merge_all([day_blocked, SpaceSaving.from_counts(batch['blocked_domains'])])
+            day_sketches[day] = (day_clients, day_blocked)
             
-            summary = SummaryStat(
-                date=today,
-                total_queries=total_queries,
-                blocked_queries=blocked_queries
+            add_summary_counts(
+                day,
+                batch['total'],
+                batch['blocked'],
+                unique_clients=day_clients.count(),
+                top_blocked_domains=top_blocked_domains(day_blocked.counts)
             )
-            db.session.add(summary)
-        else:
-            # Update existing summary
-            summary.total_queries = QueryStat.query.filter(
-                QueryStat.timestamp >= datetime.combine(today, datetime.min.time())
-            ).count()
+        return day_sketches
             
-            summary.blocked_queries = QueryStat.query.filter(
-                QueryStat.timestamp >= datetime.combine(today, datetime.min.time()),
-                QueryStat.blocked == True
-            ).count()
-            
-    def _cleanup_old_data(self):
-        """Clean up old query statistics"""
-        retention_days = self.config.get('QUERY_LOG_RETENTION_DAYS', 90)
-        cutoff_date = datetime.now() - timedelta(days=retention_days)
-        
-        # Delete old query stats
-        QueryStat.query.filter(QueryStat.timestamp < cutoff_date).delete()
-        
-        # Delete old summary stats
-        cutoff_summary_date = cutoff_date.date()
-        SummaryStat.query.filter(SummaryStat.date < cutoff_summary_date).delete()
+    def _get_day_sketches(self, day):
+        """Get the unique-client and top-blocked-domain sketches of a day"""
+        if day not in self.day_sketches:
+            # Seeded once per day from the stored daily sketches (must run
+            # before the current batch is added to them)
+            return day_summary_sketches(day)
+        return self.day_sketches[day]
+        
+    def _set_day_sketches(self, day_sketches):
+        """Keep the day sketches of a committed batch"""
+        self.day_sketches.update(day_sketches)
+        if day_sketches:
+            # Only the current and previous day still receive queries
+            latest = max(self.day_sketches)
+            for old_day in [d for d in self.day_sketches if d < latest - timedelta(days=1)]:
+                del self.day_sketches[old_day]
+        
+    def get_ingest_metrics(self):
+        """Get ingest buffer depth, flush latency and drop counters"""
+        metrics = self.buffer.get_metrics()
+        metrics['running'] = self.running
+        metrics['batch_size'] = self.batch_size
+        metrics['flush_interval'] = self.flush_interval
+        return metrics
         
     def get_query_statistics(self, days=7):
         """Get query statistics for the specified number of days"""
@@ -419,26 +428,19 @@ class QueryLogger:
             for result in results
         ]
         
-    def get_hourly_stats(self, hours=24):
-        """Get hourly statistics"""
-        start_date = datetime.now() - timedelta(hours=hours)
+    def get_hourly_stats(self, hours=24, unit='hour'):
+        """Get query counts per time bucket (hour by default)"""
+        end_date = datetime.now()
+        start_date = end_date - timedelta(hours=hours)
         
-        results = db.session.query(
-            db.func.date_trunc('hour', QueryStat.timestamp).label('hour'),
-            db.func.count(QueryStat.id).label('total_queries'),
-            db.func.sum(db.case([(QueryStat.blocked == True, 1)], else_=0)).label('blocked_queries')
-        ).filter(
-            QueryStat.timestamp >= start_date
-        ).group_by(
-            db.func.date_trunc('hour', QueryStat.timestamp)
-        ).order_by('hour').all()
+        results = bucket_counts(start_date, end_date, unit)
         
         return [
             {
-                'hour': result.hour.isoformat(),
-                'total_queries': result.total_queries,
-                'blocked_queries': result.blocked_queries or 0,
-                'block_percentage': round((result.blocked_queries or 0) / result.total_queries * 100, 2) if result.total_queries > 0 else 0
+                'hour': bucket_start.isoformat(),
+                'total_queries': total_queries,
+                'blocked_queries': blocked_queries,
+                'block_percentage': round(blocked_queries / total_queries * 100, 2) if total_queries > 0 else 0
             }
-            for result in results
+            for bucket_start, total_queries, blocked_queries in results
         ]
\ No newline at end of file
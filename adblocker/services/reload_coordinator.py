@@ -0,0 +1,238 @@
+"""
+Reload coordinator for PiDNS Ad-Blocker
+Coalesces configuration rebuilds and dnsmasq reloads on a background thread
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+logger = logging.getLogger(__name__)
+
+# Parts of the dnsmasq configuration that can be marked dirty
+BLOCKLISTS = 'blocklists'
+WHITELIST = 'whitelist'
+BLACKLIST = 'blacklist'
+RELOAD_TARGETS = (BLOCKLISTS, WHITELIST, BLACKLIST)
+
+# Seconds before a failed pass is retried, doubling per consecutive failure
+RETRY_SECONDS = 5.0
+MAX_RETRY_SECONDS = 300.0
+
+_coordinator = None
+
+
+class ReloadCoordinator:
+    """
+    Runs config rebuilds and dnsmasq reloads for mutating requests.
+
+    Callers only mark parts of the configuration dirty and return. The
+    worker waits until no new request has arrived for debounce_seconds, then
+    rebuilds everything that is dirty in one pass and reloads dnsmasq at most
+    once. Only one rebuild runs at a time; requests that arrive while it runs
+    are picked up by the next pass.
+
+    A pass fails when a config file could not be generated or dnsmasq did
+    not reload. Its targets are then marked dirty again and retried after
+    retry_seconds, doubling per consecutive failure up to max_retry_seconds.
+    reload_pending stays set until dnsmasq has reloaded successfully.
+    """
+
+    def __init__(self, app, debounce_seconds=2.0, retry_seconds=RETRY_SECONDS, max_retry_seconds=MAX_RETRY_SECONDS):
+        self.app = app
+        self.debounce_seconds = debounce_seconds
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+
+        self._condition = threading.Condition()
+        self._dirty = set()
+        self._deadline = None
+        self._in_flight = set()
+        self._stopping = False
+        self._thread = None
+        self._failures = 0
+
+        self.reload_pending = False
+        self.requested_count = 0
+        self.rebuild_count = 0
+        self.reload_count = 0
+        self.last_started = None
+        self.last_completed = None
+        self.last_success = None
+        self.last_error = None
+
+    def start(self):
+        """Start the background worker thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='reload-coordinator', daemon=True)
+        self._thread.start()
+        logger.info(f"Reload coordinator started ({self.debounce_seconds}s debounce)")
+
+    def stop(self, timeout=None):
+        """Stop the worker after it finishes any pending work"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def request(self, *targets):
+        """Mark parts of the configuration dirty and (re)start the debounce window"""
+        unknown = set(targets) - set(RELOAD_TARGETS)
+        if unknown:
+            raise ValueError(f"Unknown reload targets: {', '.join(sorted(unknown))}")
+
+        with self._condition:
+            self._dirty.update(targets)
+            self._deadline = time.monotonic() + self.debounce_seconds
+            self.requested_count += 1
+            self._condition.notify_all()
+
+    def wait_idle(self, timeout=None):
+        """Block until nothing is pending or in flight; returns False on timeout"""
+        end = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._dirty or self._in_flight:
+                remaining = None if end is None else end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def get_status(self):
+        """Get pending and in-flight reload state"""
+        with self._condition:
+            return {
+                'running': bool(self._thread and self._thread.is_alive()),
+                'debounce_seconds': self.debounce_seconds,
+                'pending': sorted(self._dirty),
+                'in_flight': sorted(self._in_flight),
+                'reload_pending': self.reload_pending,
+                'consecutive_failures': self._failures,
+                'requested_count': self.requested_count,
+                'rebuild_count': self.rebuild_count,
+                'reload_count': self.reload_count,
+                'last_started': self.last_started.isoformat() if self.last_started else None,
+                'last_completed': self.last_completed.isoformat() if self.last_completed else None,
+                'last_success': self.last_success,
+                'last_error': self.last_error
+            }
+
+    def _run(self):
+        """Worker loop: wait out the debounce window, then rebuild what is dirty"""
+        while True:
+            with self._condition:
+                while True:
+                    if self._dirty:
+                        remaining = self._deadline - time.monotonic()
+                        if remaining <= 0 or self._stopping:
+                            break
+                        self._condition.wait(remaining)
+                    elif self._stopping:
+                        return
+                    else:
+                        self._condition.wait()
+
+                targets = self._dirty
+                self._dirty = set()
+                self._in_flight = set(targets)
+                self.last_started = datetime.now()
+
+            success, error = False, None
+            try:
+                success = self._rebuild(targets)
+            except Exception as e:
+                error = str(e)
+                logger.error(f"Failed to rebuild dnsmasq configuration: {e}")
+
+            with self._condition:
+                self._in_flight = set()
+                self.rebuild_count += 1
+                self.last_completed = datetime.now()
+                self.last_success = success
+                self.last_error = error
+
+                if success:
+                    self._failures = 0
+                elif not self._stopping:
+                    # Retry the failed targets with backoff; a new request may start it sooner
+                    self._failures += 1
+                    delay = min(self.retry_seconds * 2 ** (self._failures - 1), self.max_retry_seconds)
+                    self._dirty.update(targets)
+                    self._deadline = max(self._deadline or 0, time.monotonic() + delay)
+                    logger.warning(f"dnsmasq configuration not applied, retrying in {delay:g}s")
+                self._condition.notify_all()
+
+    def _rebuild(self, targets):
+        """Regenerate the dirty config files and reload dnsmasq if any of them changed; False on failure"""
+        from adblocker.services.blocklist_manager import BlockListManager
+        from adblocker.services.dnsmasq_manager import DnsmasqManager
+        from adblocker.services.list_manager import ListManager
+
+        logger.info(f"Rebuilding dnsmasq configuration: {', '.join(sorted(targets))}")
+
+        with self.app.app_context():
+            # The managers read settings as attributes, not dict keys
+            config = SimpleNamespace(**self.app.config)
+            dnsmasq_manager = DnsmasqManager(config)
+            list_manager = ListManager(config, dnsmasq_manager)
+
+            generated = True
+            if WHITELIST in targets:
+                generated &= list_manager.write_whitelist_config()
+            if BLACKLIST in targets:
+                generated &= list_manager.write_blacklist_config()
+
+            # Hosts-format and collapsed block lists depend on the whitelist, so regenerate them too
+            whitelist_changed = WHITELIST in targets and dnsmasq_manager.blocklist_uses_whitelist
+            if BLOCKLISTS in targets or whitelist_changed:
+                with BlockListManager(config, dnsmasq_manager) as blocklist_manager:
+                    generated &= blocklist_manager.generate_combined_config(force=whitelist_changed)
+
+            # Also covers a reload that failed in an earlier pass or process
+            if not dnsmasq_manager.reload_needed:
+                logger.info("dnsmasq configuration unchanged, skipping reload")
+                self.reload_pending = False
+                return generated
+
+            with self._condition:
+                self.reload_count += 1
+            reloaded = dnsmasq_manager.reload_if_needed()
+            self.reload_pending = not reloaded
+            return reloaded and generated
+
+
+def init_reload_coordinator(app):
+    """Create and start the application's reload coordinator"""
+    global _coordinator
+    if _coordinator is None:
+        _coordinator = ReloadCoordinator(
+            app,
+            app.config.get('RELOAD_DEBOUNCE_SECONDS', 2.0),
+            retry_seconds=app.config.get('RELOAD_RETRY_SECONDS', RETRY_SECONDS),
+            max_retry_seconds=app.config.get('RELOAD_MAX_RETRY_SECONDS', MAX_RETRY_SECONDS)
+        )
+        _coordinator.start()
+    return _coordinator
+
+
+def get_reload_coordinator():
+    """Get the running reload coordinator, or None when changes are applied synchronously"""
+    return _coordinator
+
+
+def request_reload(*targets):
+    """
+    Queue a rebuild and reload with the coordinator.
+
+    Returns False when no coordinator is running, in which case the caller
+    should apply the change itself.
+    """
+    if _coordinator is None:
+        return False
+    _coordinator.request(*targets)
+    return True
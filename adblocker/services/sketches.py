@@ -0,0 +1,390 @@
+"""
+Query sketches for PiDNS Ad-Blocker
+Fixed-size summaries of each hour and day of queries, kept up to date at
+ingest and merged across a window to answer approximate statistics in time
+independent of the number of queries in it
+
+Error bounds, for a window of N queries:
+- Distinct counts (HyperLogLog, 2^HLL_PRECISION registers) have a relative
+  standard error of 1.04 / sqrt(2^HLL_PRECISION), about 1.6%; 95% of
+  estimates are within about 3.3% of the true count.
+- Top domains and clients (Space-Saving, TOP_K_CAPACITY counters) never
+  undercount. Each count overestimates by at most its reported error,
+  which is at most N / TOP_K_CAPACITY (0.5% of N). Any key with more than
+  N / TOP_K_CAPACITY queries is guaranteed to be listed.
+- Query totals are exact.
+
+A window covers every hour it overlaps: whole days are read from the daily
+sketches and the hours at either edge from the hourly ones.
+"""
+
+import hashlib
+import heapq
+import json
+import math
+from collections import Counter
+from datetime import timedelta
+from operator import itemgetter
+
+from sqlalchemy import and_, or_
+
+from adblocker.models.database import QuerySketch, db, day_bounds, get_day_blocked_counts, get_day_clients, hour_floor
+
+# 4096 one-byte registers per HyperLogLog
+HLL_PRECISION = 12
+
+# Counters per Space-Saving sketch
+TOP_K_CAPACITY = 200
+
+# Sketches are kept per hour and per day
+SKETCH_PERIOD_HOUR = 'hour'
+SKETCH_PERIOD_DAY = 'day'
+
+# Sketch names stored in QuerySketch.name
+SKETCH_UNIQUE_DOMAINS = 'unique_domains'
+SKETCH_UNIQUE_CLIENTS = 'unique_clients'
+SKETCH_TOP_DOMAINS = 'top_domains'
+SKETCH_TOP_BLOCKED_DOMAINS = 'top_blocked_domains'
+SKETCH_TOP_CLIENTS = 'top_clients'
+
+
+def day_floor(timestamp):
+    """Get the start of the day a datetime falls in"""
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _hash64(value):
+    """Stable 64-bit hash of a string"""
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+def _register_max(registers, other, size):
+    """
+    Byte-wise max of two register arrays packed into ints, all bytes at once
+
+    Registers stay below 0x80, so with the top bit of every byte of
+    `registers` set the subtraction never borrows across bytes, and the top
+    bit left in a byte says whether it was the larger one.
+    """
+    high_bits = int.from_bytes(b'\x80' * size, 'big')
+    larger = (((registers | high_bits) - other) & high_bits) >> 7
+    mask = larger * 0xFF
+    return (registers & mask) | (other & ~mask)
+
+
+class HyperLogLog:
+    """Mergeable distinct-count estimator (Flajolet et al.) with a linear counting correction"""
+
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        self.precision = precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(1 << precision)
+
+    @property
+    def relative_error(self):
+        """Relative standard error of count()"""
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def add(self, value):
+        """Add a value; adding it again has no effect"""
+        hashed = _hash64(value)
+        bits = 64 - self.precision
+        index = hashed >> bits
+        rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """Fold in another sketch of the same precision; returns self"""
+        self.registers = self.merge_all([self, other]).registers
+        return self
+
+    @classmethod
+    def merge_all(cls, sketches):
+        """Merge sketches of the same precision into a new one, register by register"""
+        precisions = {sketch.precision for sketch in sketches}
+        if len(precisions) != 1:
+            raise ValueError("Cannot merge HyperLogLog sketches of different precision")
+        size = len(sketches[0].registers)
+        merged = int.from_bytes(sketches[0].registers, 'big')
+        for sketch in sketches[1:]:
+            merged = _register_max(merged, int.from_bytes(sketch.registers, 'big'), size)
+        return cls(precisions.pop(), merged.to_bytes(size, 'big'))
+
+    def count(self):
+        """Estimated number of distinct values added"""
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Small cardinalities: linear counting over the empty registers
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+    def to_bytes(self):
+        """Serialize as the precision byte followed by the registers"""
+        return bytes([self.precision]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Restore a sketch serialized with to_bytes"""
+        return cls(data[0], data[1:])
+
+
+class SpaceSaving:
+    """
+    Mergeable heavy-hitter summary (Metwally et al.) of at most `capacity` counters.
+
+    A key arriving when every counter is taken replaces the smallest one and
+    inherits its count as error, so counts are upper bounds and
+    count - error is a lower bound. Counts and errors are kept in two dicts
+    of ints rather than a pair per key, so loading and merging hundreds of
+    sketches allocates no per-key containers for the garbage collector.
+    """
+
+    def __init__(self, capacity=TOP_K_CAPACITY):
+        self.capacity = capacity
+        self.total = 0
+        self.counts = {}  # key -> count
+        self.errors = {}  # key -> overcount bound
+
+    def _floor(self):
+        """Count any key without a counter may have reached"""
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(self.counts.values())
+
+    def update(self, key, count=1):
+        """Add `count` occurrences of a key"""
+        self.total += count
+        if key in self.counts:
+            self.counts[key] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = count
+            self.errors[key] = 0
+        else:
+            smallest = min(self.counts, key=self.counts.get)
+            floor = self.counts.pop(smallest)
+            del self.errors[smallest]
+            self.counts[key] = floor + count
+            self.errors[key] = floor
+
+    def merge(self, other):
+        """Fold in another sketch; returns self"""
+        merged = self.merge_all([self, other])
+        self.total, self.counts, self.errors = merged.total, merged.counts, merged.errors
+        return self
+
+    @classmethod
+    def merge_all(cls, sketches):
+        """
+        Merge sketches into a new one with the capacity of the first
+
+        A key missing from a sketch may have had up to that sketch's floor
+        there, which is added to both its count and its error, so the merged
+        error stays within the combined total / capacity.
+        """
+        floors = 0
+        counts = Counter()  # beyond the floors
+        errors = Counter()
+        for sketch in sketches:
+            floor = sketch._floor()
+            floors += floor
+            counts.update(sketch.counts)
+            errors.update(sketch.errors)
+            if floor:
+                for key in sketch.counts:
+                    counts[key] -= floor
+                    errors[key] -= floor
+
+        merged = cls(sketches[0].capacity)
+        merged.total = sum(sketch.total for sketch in sketches)
+        for key, count in heapq.nlargest(merged.capacity, counts.items(), key=itemgetter(1)):
+            merged.counts[key] = count + floors
+            merged.errors[key] = errors[key] + floors
+        return merged
+
+    @classmethod
+    def from_counts(cls, counts, capacity=TOP_K_CAPACITY):
+        """
+        Summarize exact counts (a Counter) by keeping the largest `capacity`
+
+        Every dropped key counted no more than the smallest kept one, which is
+        all the floor used in merging assumes, so the kept counts carry no error.
+        """
+        sketch = cls(capacity)
+        sketch.total = sum(counts.values())
+        sketch.counts = dict(counts.most_common(capacity))
+        sketch.errors = dict.fromkeys(sketch.counts, 0)
+        return sketch
+
+    def top(self, limit):
+        """The `limit` largest counters as (key, count, error), largest first"""
+        ranked = sorted(self.counts, key=lambda key: (-self.counts[key], key))
+        return [(key, self.counts[key], self.errors[key]) for key in ranked[:limit]]
+
+    def to_bytes(self):
+        """Serialize as JSON with parallel key, count and error lists"""
+        keys = list(self.counts)
+        return json.dumps({
+            'capacity': self.capacity,
+            'total': self.total,
+            'keys': keys,
+            'counts': [self.counts[key] for key in keys],
+            'errors': [self.errors[key] for key in keys]
+        }, separators=(',', ':')).encode()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Restore a sketch serialized with to_bytes"""
+        state = json.loads(data)
+        sketch = cls(state['capacity'])
+        sketch.total = state['total']
+        sketch.counts = dict(zip(state['keys'], state['counts']))
+        sketch.errors = dict(zip(state['keys'], state['errors']))
+        return sketch
+
+
+# Sketch type per name
+SKETCH_TYPES = {
+    SKETCH_UNIQUE_DOMAINS: HyperLogLog,
+    SKETCH_UNIQUE_CLIENTS: HyperLogLog,
+    SKETCH_TOP_DOMAINS: SpaceSaving,
+    SKETCH_TOP_BLOCKED_DOMAINS: SpaceSaving,
+    SKETCH_TOP_CLIENTS: SpaceSaving,
+}
+
+
+def _batch_sketches(rows):
+    """Build the sketches of a batch of rows from one hour"""
+    domains = Counter(row['domain'] for row in rows)
+    clients = Counter(row['client_ip'] for row in rows if row['client_ip'])
+
+    unique_domains = HyperLogLog()
+    for domain in domains:
+        unique_domains.add(domain)
+    unique_clients = HyperLogLog()
+    for client_ip in clients:
+        unique_clients.add(client_ip)
+
+    # The batch is counted exactly, so its top keys need no Space-Saving updates
+    return {
+        SKETCH_UNIQUE_DOMAINS: unique_domains,
+        SKETCH_UNIQUE_CLIENTS: unique_clients,
+        SKETCH_TOP_DOMAINS: SpaceSaving.from_counts(domains),
+        SKETCH_TOP_BLOCKED_DOMAINS: SpaceSaving.from_counts(Counter(row['domain'] for row in rows if row['blocked'])),
+        SKETCH_TOP_CLIENTS: SpaceSaving.from_counts(clients),
+    }
+
+
+def _merge_stored(stored, period, start, name, sketch):
+    """Merge a sketch into the stored one for (period, start, name), or store it"""
+    existing = stored.get((period, start, name))
+    if existing is None:
+        db.session.add(QuerySketch(period=period, start=start, name=name, data=sketch.to_bytes()))
+    else:
+        sketch_type = SKETCH_TYPES[name]
+        existing.data = sketch_type.merge_all([sketch, sketch_type.from_bytes(existing.data)]).to_bytes()
+
+
+def add_query_sketches(rows):
+    """Merge a batch of QueryStat column dicts into the stored hourly and daily sketches (caller commits)"""
+    hours = {}
+    for row in rows:
+        hours.setdefault(hour_floor(row['timestamp']), []).append(row)
+    if not hours:
+        return
+
+    hour_sketches = {hour: _batch_sketches(hour_rows) for hour, hour_rows in hours.items()}
+    days = {}
+    for hour, sketches in hour_sketches.items():
+        days.setdefault(day_floor(hour), []).append(sketches)
+
+    stored = {
+        (sketch.period, sketch.start, sketch.name): sketch
+        for sketch in QuerySketch.query.filter(or_(
+            and_(QuerySketch.period == SKETCH_PERIOD_HOUR, QuerySketch.start.in_(list(hour_sketches))),
+            and_(QuerySketch.period == SKETCH_PERIOD_DAY, QuerySketch.start.in_(list(days)))
+        ))
+    }
+    for hour, sketches in hour_sketches.items():
+        for name, sketch in sketches.items():
+            _merge_stored(stored, SKETCH_PERIOD_HOUR, hour, name, sketch)
+    for day, day_hours in days.items():
+        for name, sketch_type in SKETCH_TYPES.items():
+            _merge_stored(stored, SKETCH_PERIOD_DAY, day, name, sketch_type.merge_all([sketches[name] for sketches in day_hours]))
+
+
+def merged_sketches(start, end, names):
+    """
+    Merge the stored sketches of every hour overlapping [start, end), per name
+
+    Whole days come from the daily sketches and the hours at either edge
+    from the hourly ones, so a window reads at most 48 hourly sketches
+    however many days it spans.
+    """
+    start_hour = hour_floor(start)
+    first_day = day_floor(start_hour)
+    if first_day < start_hour:
+        first_day += timedelta(days=1)
+    last_day = day_floor(end)
+
+    if first_day < last_day:
+        window = or_(
+            and_(QuerySketch.period == SKETCH_PERIOD_DAY, QuerySketch.start >= first_day, QuerySketch.start < last_day),
+            and_(QuerySketch.period == SKETCH_PERIOD_HOUR, QuerySketch.start >= start_hour, QuerySketch.start < first_day),
+            and_(QuerySketch.period == SKETCH_PERIOD_HOUR, QuerySketch.start >= last_day, QuerySketch.start < end)
+        )
+    else:
+        window = and_(QuerySketch.period == SKETCH_PERIOD_HOUR, QuerySketch.start >= start_hour, QuerySketch.start < end)
+
+    stored = {name: [] for name in names}
+    rows = db.session.query(QuerySketch.name, QuerySketch.data).filter(window, QuerySketch.name.in_(names))
+    for name, data in rows:
+        stored[name].append(SKETCH_TYPES[name].from_bytes(data))
+    return {
+        name: SKETCH_TYPES[name].merge_all(sketches) if sketches else SKETCH_TYPES[name]()
+        for name, sketches in stored.items()
+    }
+
+
+def day_summary_sketches(day):
+    """
+    Get the unique-client and top-blocked-domain sketches of a date
+
+    Reads the stored daily sketches; a day that has queries but no sketches
+    (ingested before they existed) is summarized from query_stats instead.
+    """
+    start, _ = day_bounds(day)
+    rows = db.session.query(QuerySketch.name, QuerySketch.data).filter(
+        QuerySketch.period == SKETCH_PERIOD_DAY,
+        QuerySketch.start == start,
+        QuerySketch.name.in_([SKETCH_UNIQUE_CLIENTS, SKETCH_TOP_BLOCKED_DOMAINS])
+    )
+    stored = {name: SKETCH_TYPES[name].from_bytes(data) for name, data in rows}
+    if len(stored) == 2:
+        return stored[SKETCH_UNIQUE_CLIENTS], stored[SKETCH_TOP_BLOCKED_DOMAINS]
+
+    unique_clients = HyperLogLog()
+    for client_ip in get_day_clients(day):
+        unique_clients.add(client_ip)
+    return unique_clients, SpaceSaving.from_counts(Counter(get_day_blocked_counts(day)))
+
+
+def approx_overview(start, end):
+    """Approximate overview statistics for a window, see the module docstring for error bounds"""
+    sketches = merged_sketches(start, end, [
+        SKETCH_UNIQUE_DOMAINS, SKETCH_UNIQUE_CLIENTS, SKETCH_TOP_DOMAINS, SKETCH_TOP_BLOCKED_DOMAINS
+    ])
+    unique_domains = sketches[SKETCH_UNIQUE_DOMAINS]
+    return {
+        'total_queries': sketches[SKETCH_TOP_DOMAINS].total,
+        'blocked_queries': sketches[SKETCH_TOP_BLOCKED_DOMAINS].total,
+        'unique_domains': unique_domains.count(),
+        'unique_clients': sketches[SKETCH_UNIQUE_CLIENTS].count(),
+        'unique_relative_error': round(unique_domains.relative_error, 4)
+    }
+
+
+def approx_top(name, start, end, limit=20):
+    """Approximate top keys of a Space-Saving sketch for a window as (key, count, max_overcount) rows"""
+    return merged_sketches(start, end, [name])[name].top(limit)
@@ -0,0 +1,147 @@
+"""
+Windowed statistics queries for PiDNS Ad-Blocker
+Answers time-window aggregates from the hourly rollups, reading raw query
+stats only for the partial hours at the edges of the window
+"""
+
+from datetime import timedelta
+
+from sqlalchemy import case, func, select, union_all
+
+from adblocker.models.database import BlockList, HourlyRollup, QueryStat, db, hour_floor, time_bucket
+from adblocker.models.database import ROLLUP_NO_BLOCK_LIST, ROLLUP_NO_CLIENT
+
+# Raw QueryStat expressions matching the rollup key columns
+RAW_KEY_COLUMNS = {
+    'domain': QueryStat.domain,
+    'client_ip': func.coalesce(QueryStat.client_ip, ROLLUP_NO_CLIENT),
+    'block_list_id': func.coalesce(QueryStat.block_list_id, ROLLUP_NO_BLOCK_LIST),
+}
+
+
+def split_window(start, end):
+    """
+    Split [start, end) into the whole hours the rollups cover and the partial
+    hours at either edge, which have to come from raw rows.
+
+    Returns (rollup_start, rollup_end, raw_ranges); the rollup bounds are
+    None when the window does not contain a whole hour.
+    """
+    rollup_start = hour_floor(start)
+    if rollup_start < start:
+        rollup_start += timedelta(hours=1)
+    rollup_end = hour_floor(end)
+
+    if rollup_start > rollup_end:
+        # Within a single hour
+        return None, None, [(start, end)]
+
+    raw_ranges = []
+    if start < rollup_start:
+        raw_ranges.append((start, rollup_start))
+    if rollup_end < end:
+        raw_ranges.append((rollup_end, end))
+    if rollup_start == rollup_end:
+        return None, None, raw_ranges
+    return rollup_start, rollup_end, raw_ranges
+
+
+def windowed_counts(key, start, end, blocked_only=False):
+    """Subquery of (key, count) rows for [start, end); a key may appear once per source"""
+    rollup_start, rollup_end, raw_ranges = split_window(start, end)
+    parts = []
+
+    if rollup_start is not None:
+        rollup_key = getattr(HourlyRollup, key)
+        rollups = select(
+            rollup_key.label(key),
+            func.sum(HourlyRollup.count).label('count')
+        ).where(
+            HourlyRollup.hour >= rollup_start,
+            HourlyRollup.hour < rollup_end
+        ).group_by(rollup_key)
+        if blocked_only:
+            rollups = rollups.where(HourlyRollup.blocked == True)
+        parts.append(rollups)
+
+    raw_key = RAW_KEY_COLUMNS[key]
+    for raw_start, raw_end in raw_ranges:
+        raw = select(
+            raw_key.label(key),
+            func.count(QueryStat.id).label('count')
+        ).where(
+            QueryStat.timestamp >= raw_start,
+            QueryStat.timestamp < raw_end
+        ).group_by(raw_key)
+        if blocked_only:
+            raw = raw.where(QueryStat.blocked == True)
+        parts.append(raw)
+
+    return (union_all(*parts) if len(parts) > 1 else parts[0]).subquery()
+
+
+def top_counts(key, start, end, blocked_only=False, limit=20):
+    """Get the most frequent domains or clients in a window as (key, count) rows"""
+    counts = windowed_counts(key, start, end, blocked_only)
+    total = func.sum(counts.c['count']).label('count')
+    return db.session.execute(
+        select(counts.c[key], total).group_by(counts.c[key]).order_by(total.desc()).limit(limit)
+    ).all()
+
+
+def blocklist_counts(start, end):
+    """Get blocked queries per block list in a window as (name, category, blocked_count) rows"""
+    counts = windowed_counts('block_list_id', start, end, blocked_only=True)
+    total = func.sum(counts.c['count']).label('blocked_count')
+    return db.session.execute(
+        select(BlockList.name, BlockList.category, total).join(
+            counts, BlockList.id == counts.c['block_list_id']
+        ).group_by(BlockList.id).order_by(total.desc())
+    ).all()
+
+
+def bucket_counts(start, end, unit='hour'):
+    """
+    Get (bucket, total_queries, blocked_queries) per minute, hour, day or week
+    of a window, oldest first
+
+    Whole hours are grouped from the rollups and the edges from raw rows,
+    both with time_bucket, and merged per bucket. Minute buckets are finer
+    than the rollups and always come from raw rows.
+    """
+    if unit == 'minute':
+        rollup_start, rollup_end, raw_ranges = None, None, [(start, end)]
+    else:
+        rollup_start, rollup_end, raw_ranges = split_window(start, end)
+    parts = []
+
+    if rollup_start is not None:
+        # Rollup hours are already hour buckets
+        bucket = HourlyRollup.hour if unit == 'hour' else time_bucket(HourlyRollup.hour, unit)
+        parts.append(db.session.query(
+            bucket,
+            func.sum(HourlyRollup.count),
+            func.sum(case((HourlyRollup.blocked == True, HourlyRollup.count), else_=0))
+        ).filter(
+            HourlyRollup.hour >= rollup_start,
+            HourlyRollup.hour < rollup_end
+        ).group_by(bucket))
+
+    bucket = time_bucket(QueryStat.timestamp, unit)
+    for raw_start, raw_end in raw_ranges:
+        parts.append(db.session.query(
+            bucket,
+            func.count(QueryStat.id),
+            func.sum(case((QueryStat.blocked == True, 1), else_=0))
+        ).filter(
+            QueryStat.timestamp >= raw_start,
+            QueryStat.timestamp < raw_end
+        ).group_by(bucket))
+
+    buckets = {}
+    for query in parts:
+        for bucket_start, total, blocked in query:
+            previous_total, previous_blocked = buckets.get(bucket_start, (0, 0))
+            buckets[bucket_start] = (previous_total + total, previous_blocked + (blocked or 0))
+
+    return [(bucket_start, total, blocked) for bucket_start, (total, blocked) in sorted(buckets.items())]